@@ -0,0 +1,242 @@
+"""
+Benchmark suite for the pypreg entry points.
+
+Copyright (C) 2023 Dave Walsh
+
+Times process_outcomes, smm (with and without indicators), apo, and calc_index
+on seeded synthetic claims of increasing size and writes the results as JSON.
+Each result records wall time, throughput, peak traced memory, and the output
+size. A log-log slope of time against rows is reported per benchmark so that
+changes in scaling are visible, and a previous result file can be given as a
+baseline to fail the run when a benchmark slows down past a tolerance.
+
+Usage:
+    python benchmarks/run_benchmarks.py --sizes 10000 100000 --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json --tolerance 0.25
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from pypreg import process_outcomes, smm, apo, calc_index  # noqa: E402
+from pypreg.synthetic import synthetic_claims  # noqa: E402
+
+DEFAULT_SIZES = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7, 10 ** 8]
+
+
+def _process_outcomes(df):
+    return process_outcomes(df, 'patient_id', 'encounter_id', 'admit_date',
+                            'code_version', 'code_type', 'code')
+
+
+def _smm(df):
+    return smm(df, 'encounter_id', 'code_type', 'code_version', 'code')
+
+
+def _smm_indicators(df):
+    return smm(df, 'encounter_id', 'code_type', 'code_version', 'code', indicators=True)
+
+
+def _apo(df):
+    return apo(df, 'patient_id', 'preg_id', 'code_type', 'code_version', 'code')
+
+
+def _calc_index(df):
+    return calc_index(df, 'patient_id', 'preg_id', 'code', 'code_version', 'bateman', 'age')
+
+
+# The adverse outcome and comorbidity methods expect data already restricted to pregnancies
+BENCHMARKS = {'process_outcomes': (_process_outcomes, False),
+              'smm': (_smm, False),
+              'smm_indicators': (_smm_indicators, False),
+              'apo': (_apo, True),
+              'calc_index': (_calc_index, True)}
+
+
+def _call(func, df: pd.DataFrame):
+    """
+    Utility to run a benchmark function with its warnings collected instead of printed.
+    """
+
+    with warnings.catch_warnings(record=True):
+        return func(df)
+
+
+def run_one(func, df: pd.DataFrame, memory: bool = True):
+    """
+    Runs a single benchmark on a copy of the data. The entry points rename
+    columns of their input so every run receives a fresh copy.
+
+    :param func: Benchmark function
+    :param df: Input data
+    :param memory: Trace peak memory in a second run
+
+    :return: Returns a dictionary with seconds, peak_memory_bytes, and output_rows
+    """
+
+    data = df.copy()
+    gc.collect()
+    start = time.perf_counter()
+    output = _call(func, data)
+    seconds = time.perf_counter() - start
+
+    # Tracing slows the code down, memory is measured separately from time
+    peak = None
+    if memory:
+        data = df.copy()
+        gc.collect()
+        tracemalloc.start()
+        _call(func, data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {'seconds': seconds,
+            'peak_memory_bytes': peak,
+            'output_rows': int(len(output))}
+
+
+def scaling(results: list):
+    """
+    Estimates the scaling exponent of each benchmark as the slope of
+    log(seconds) against log(rows). A slope of 1 is linear scaling.
+
+    :param results: List of result dictionaries
+
+    :return: Returns a dictionary of benchmark name to slope
+    """
+
+    output = {}
+    frame = pd.DataFrame(results)
+    for name, group in frame.groupby('benchmark'):
+        group = group[group['seconds'] > 0]
+        if group['rows'].nunique() < 2:
+            continue
+        slope = np.polyfit(np.log(group['rows']), np.log(group['seconds']), 1)[0]
+        output[name] = round(float(slope), 3)
+
+    return output
+
+
+def compare(results: list, baseline: dict, tolerance: float):
+    """
+    Compares the results to a baseline run.
+
+    :param results: List of result dictionaries
+    :param baseline: Contents of a previous result file
+    :param tolerance: Allowed relative slow down, 0.25 allows a run to be 25% slower
+
+    :return: Returns a list of regressions, empty when there are none
+    """
+
+    previous = {(result['benchmark'], result['rows']): result
+                for result in baseline['results']}
+    regressions = []
+    for result in results:
+        key = (result['benchmark'], result['rows'])
+        if key not in previous:
+            continue
+        ratio = result['seconds'] / previous[key]['seconds']
+        if ratio > 1 + tolerance:
+            regressions.append({'benchmark': result['benchmark'],
+                                'rows': result['rows'],
+                                'baseline_seconds': previous[key]['seconds'],
+                                'seconds': result['seconds'],
+                                'ratio': round(ratio, 3)})
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Numbers of code rows to benchmark')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS),
+                        choices=list(BENCHMARKS))
+    parser.add_argument('--pregnancy-density', type=float, default=0.3,
+                        help='Share of synthetic patients with a pregnancy')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per benchmark, the fastest is kept')
+    parser.add_argument('--time-budget', type=float, default=600,
+                        help='Skip larger sizes of a benchmark once a run takes longer than this many seconds')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the traced memory run')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', type=Path, default=None,
+                        help='Previous result file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = []
+    over_budget = set()
+    for rows in sorted(args.sizes):
+        benchmarks = [name for name in args.benchmarks if name not in over_budget]
+        if not benchmarks:
+            break
+
+        df = synthetic_claims(rows, pregnancy_density=args.pregnancy_density, seed=args.seed)
+        pregnancies = df[df['preg_id'] > 0].reset_index(drop=True)
+
+        for name in benchmarks:
+            func, pregnancy_only = BENCHMARKS[name]
+            data = pregnancies if pregnancy_only else df
+
+            runs = [run_one(func, data, memory=False) for _ in range(args.repeat - 1)]
+            runs.append(run_one(func, data, memory=not args.no_memory))
+            result = runs[-1]
+            result['seconds'] = min(run['seconds'] for run in runs)
+
+            results.append({'benchmark': name,
+                            'rows': int(len(df)),
+                            'input_rows': int(len(data)),
+                            'seconds': round(result['seconds'], 6),
+                            'rows_per_second': round(len(data) / result['seconds'], 1),
+                            'peak_memory_bytes': result['peak_memory_bytes'],
+                            'output_rows': result['output_rows']})
+            print(f"{name:>18} {len(data):>11,} rows {result['seconds']:>10.3f}s",
+                  file=sys.stderr)
+
+            if result['seconds'] > args.time_budget:
+                over_budget.add(name)
+
+    report = {'environment': {'python': platform.python_version(),
+                              'pandas': pd.__version__,
+                              'numpy': np.__version__,
+                              'machine': platform.machine(),
+                              'processor': platform.processor()},
+              'parameters': {'pregnancy_density': args.pregnancy_density,
+                             'seed': args.seed,
+                             'repeat': args.repeat},
+              'results': results,
+              'scaling': scaling(results)}
+
+    exit_code = 0
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        report['regressions'] = regressions
+        exit_code = 1 if regressions else 0
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Differential verification of the pypreg engines.
+
+Copyright (C) 2023 Dave Walsh
+
+Runs the reference entry points and every registered engine on a seeded
+synthetic cohort and on the edge case cohorts, and fails when any engine
+returns different rows. The differences are written as CSV for review.
+
+Usage:
+    python benchmarks/verify_engines.py --rows 1000000 --seeds 0 1 2
+    python benchmarks/verify_engines.py --engines partitioned --output differences.csv
+"""
+
+import argparse
+import sys
+import warnings
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src'))
+
+from pypreg.verify import ENGINES, REFERENCE, SYNTHETIC_ARGS, verify_synthetic  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('--rows', type=int, default=1_000_000,
+                        help='Number of code rows of the synthetic cohort')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--analyses', nargs='+', default=list(SYNTHETIC_ARGS),
+                        choices=list(SYNTHETIC_ARGS))
+    parser.add_argument('--engines', nargs='+', default=None,
+                        choices=[name for name in ENGINES if name != REFERENCE])
+    parser.add_argument('--edge-patients', type=int, default=10_000,
+                        help='Number of patients in each edge case cohort')
+    parser.add_argument('--output', type=Path, default=None,
+                        help='Write the differences to this CSV file')
+    args = parser.parse_args(argv)
+
+    found = []
+    for seed in args.seeds:
+        # The code type and version warnings are expected on synthetic data
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            differences = verify_synthetic(args.rows,
+                                           seed=seed,
+                                           analyses=args.analyses,
+                                           engines=args.engines,
+                                           edge_patients=args.edge_patients,
+                                           strict=False)
+        found.append(differences.assign(seed=seed))
+        print(f'seed {seed}: {len(differences):,} differences', file=sys.stderr)
+
+    differences = pd.concat(found, ignore_index=True)
+    if len(differences):
+        print(differences.groupby(['seed', 'cohort', 'analysis', 'engine', 'kind']).size().to_string(),
+              file=sys.stderr)
+    if args.output:
+        differences.to_csv(args.output, index=False)
+
+    return 1 if len(differences) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,19 +4,70 @@ identifying severe maternal morbidity, adverse pregnancy OUTCOMES,
 and calculating obstetric comorbidity scores.
 
 Pregnancy classification:
- -OUTCOMES, OUTCOME_LIST, map_version_split, process_outcomes
+ -OUTCOMES, OUTCOME_LIST, OUTCOME_DTYPE, map_version_split, process_outcomes, spacing_config, assign_pregnancy,
+  window_join
 
  SMM:
- -smm
+ -smm, smm_postpartum
 
  APO:
  -apo
 
  Obstetric comorbidity score:
- - calc_index
+ - calc_index, index_indicators, decode_flags
+
+ In-database execution:
+ - connect, create_code_tables, outcome_sql, smm_sql, apo_sql, index_sql, run_sql
+
+ Instrumentation:
+ - instrument, StageReport
+
+ Out-of-core and parallel execution:
+ - partition_data, run_partitioned, run_shared, ResultCache
+
+ Match provenance:
+ - pattern_table
+
+ Cohort summaries:
+ - CohortSummary, summarize
+
+ Memory budgets:
+ - estimate_memory, run_within
+
+ Differential verification:
+ - verify, register_engine, EngineMismatch
+
+ Scoring service:
+ - ScoringService, MicroBatcher, serve
+
+ Categorical dtypes:
+ - CODE_TYPE_DTYPE, VERSION_DTYPE
+
+ Arrow input:
+ - arrow_frame
+
+ Registered code sets:
+ - register_code_set, unregister_code_set, registered_code_sets
+
+ Pregnancy window flags:
+ - window_flags
 """
 
 from .adverse_pregnancy_outcomes import *
 from .smm import *
 from .pregnancy_outcome import *
 from .obstetric_comorbidity import *
+from .sql import *
+from .instrument import instrument, StageReport
+from .partition import partition_data, run_partitioned
+from .shared import run_shared
+from .cache import ResultCache
+from .provenance import pattern_table
+from .summary import CohortSummary, summarize
+from .budget import estimate_memory, run_within
+from .verify import verify, register_engine, EngineMismatch
+from .service import ScoringService, MicroBatcher, serve
+from .dtypes import CODE_TYPE_DTYPE, VERSION_DTYPE
+from .arrow import arrow_frame
+from .code_sets import register_code_set, unregister_code_set, registered_code_sets
+from .pregnancy_window import window_flags
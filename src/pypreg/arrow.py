@@ -0,0 +1,162 @@
+"""
+Arrow tables and IPC files as input to the entry points.
+
+Copyright (C) 2023 Dave Walsh
+
+process_outcomes, smm, apo, and calc_index accept a pyarrow Table or the path
+of an Arrow IPC file (Feather version 2) in place of a dataframe. The file is
+memory mapped and only the columns the entry point reads are selected, the
+other columns of a wide extract are never read and the selected ones are held
+in the pages of the file rather than copied. process_outcomes carries the
+other columns of its input to its output, so it selects every column.
+
+The prefix screen of the entry point is applied to the Arrow columns before
+any pandas object is made. The codes are compared once per distinct value and
+only the rows that pass are taken into the dataframe the entry point works
+on, so most rows of a general claims extract are never converted. The first
+row of each distinct code type and version (and of each pregnancy for apo,
+whose output lists every pregnancy) is taken as well, so the label warnings
+and the output are the same as for the whole extract as a dataframe.
+
+The entry points report the conversion as a 'read_arrow' stage to instrument,
+its rows_in less its rows_out is the number of rows left in the file.
+
+Available functions
+arrow_columns : Reads the columns of an Arrow IPC file or table
+arrow_frame : Makes the dataframe an entry point works on from an Arrow IPC file or table
+"""
+
+import numpy as np
+
+from .instrument import Stages
+from .partition import ID_ARGS, VALUE_ARGS
+from .screen import screen_codes
+
+# Arguments of the screened entry points: the code, and the columns each distinct value
+# of which is kept whatever its codes
+SCREENED = {'process_outcomes': ('code_col', ['type_col', 'version_col']),
+            'smm': ('code', ['code_type', 'version']),
+            'apo': ('code', ['patient_id', 'preg_id', 'code_type', 'version'])}
+
+ROW_COL = '_pypreg_row'
+
+
+def _screen(analysis: str):
+    """
+    Utility to look up the prefixes of an entry point, with those of its registered code sets,
+    and whether its codes are upper cased before they are screened. The dots of the codes are
+    ignored by every screen.
+    """
+
+    from .code_sets import with_registered_prefixes
+
+    if analysis == 'process_outcomes':
+        from .pregnancy_outcome.attach_map import OUTCOME_PREFIXES
+        return OUTCOME_PREFIXES, False
+    if analysis == 'smm':
+        from .smm.smm import SMM_PREFIXES
+        return with_registered_prefixes(SMM_PREFIXES, 'smm'), True
+    from .adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import APO_PREFIXES
+    return with_registered_prefixes(APO_PREFIXES, 'apo'), True
+
+
+def arrow_columns(source,
+                  columns: list):
+    """
+    Reads the columns of an Arrow IPC file or table. A file is memory mapped, so the columns
+    are not copied unless the file is compressed.
+
+    :param source: pyarrow Table, or path of an Arrow IPC file (Feather version 2)
+    :param columns: Columns to select, those missing from the source are left out. None selects
+        every column
+
+    :return: Returns a pyarrow Table with the columns present in the source
+    """
+
+    import pyarrow as pa
+    from pyarrow import feather
+
+    if isinstance(source, pa.Table):
+        names = source.column_names
+    else:
+        source = str(source)
+        with pa.memory_map(source) as file:
+            names = pa.ipc.open_file(file).schema.names
+
+    if columns is not None:
+        columns = [col for col in columns if col in names]
+    if isinstance(source, pa.Table):
+        return source if columns is None else source.select(columns)
+
+    return feather.read_table(source, columns=columns, memory_map=True)
+
+
+def arrow_frame(analysis: str,
+                source,
+                **kwargs):
+    """
+    Makes the dataframe an entry point works on from an Arrow IPC file or table. The columns
+    the entry point reads are selected and screened by code prefix in Arrow, and only the rows
+    that can change the result are converted to pandas.
+
+    :param analysis: Name of the entry point: 'process_outcomes', 'smm', 'apo', or 'calc_index'
+    :param source: pyarrow Table, or path of an Arrow IPC file (Feather version 2)
+    :param kwargs: Column arguments of the entry point
+
+    :return: Returns a pandas dataframe of the columns the entry point reads, in the order of
+    the source rows
+
+    :raises: ValueError
+        If the analysis does not exist
+    """
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if analysis not in ID_ARGS:
+        raise ValueError(f'Analysis must be one of {list(ID_ARGS)}')
+
+    # process_outcomes carries the other columns of the input to its output
+    if analysis == 'process_outcomes':
+        columns = None
+    else:
+        columns = list(dict.fromkeys(kwargs[arg] for arg in ID_ARGS[analysis] + VALUE_ARGS[analysis]
+                                     if kwargs.get(arg) is not None))
+    table = arrow_columns(source, columns)
+    stages = Stages(analysis, table)
+
+    screened = analysis in SCREENED \
+        and {kwargs[arg] for arg in [SCREENED[analysis][0], *SCREENED[analysis][1]]}.issubset(table.column_names)
+    if screened:
+        code_arg, key_args = SCREENED[analysis]
+        codes = table[kwargs[code_arg]]
+        if pa.types.is_dictionary(codes.type):
+            codes = codes.cast(codes.type.value_type)
+        screened = pa.types.is_string(codes.type) or pa.types.is_large_string(codes.type)
+
+    # Codes of other types are left for the entry point to handle
+    if screened:
+        prefixes, upper = _screen(analysis)
+
+        # Write the distinct codes as the entry point would before its screen
+        uniques = pc.unique(codes)
+        forms = uniques.to_pandas().astype(object).str.replace('.', '', regex=False)
+        if upper:
+            forms = forms.str.upper()
+        kept = uniques.filter(pa.array(screen_codes(forms, prefixes)))
+        mask = pc.is_in(codes, value_set=kept).to_numpy(zero_copy_only=False)
+
+        # The first row of each distinct key is kept whatever its code
+        keys = [kwargs[arg] for arg in key_args]
+        first = table.select(keys)\
+            .append_column(ROW_COL, pa.array(np.arange(len(table))))\
+            .group_by(keys, use_threads=False)\
+            .aggregate([(ROW_COL, 'min')])[f'{ROW_COL}_min']
+
+        rows = np.union1d(np.flatnonzero(mask), first.to_numpy())
+        table = table.take(pa.array(rows))
+
+    df = table.to_pandas()
+    stages.done('read_arrow', df)
+
+    return df
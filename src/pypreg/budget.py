@@ -0,0 +1,255 @@
+"""
+Memory budgets for the pypreg entry points.
+
+Copyright (C) 2023 Dave Walsh
+
+The working set of each stage of an entry point grows with the bytes of its
+input rows. STAGE_COST holds the peak of each stage as a multiple of the
+input bytes, measured with instrument(memory=True) on synthetic claims and
+rounded up. The estimate of a stage adds the input itself and the working
+copy the entry point makes of it.
+
+With a memory_limit the input is split into chunks of whole patients (whole
+encounters for smm) that stay under the limit. The chunks run one after the
+other and their results are combined in the order of the single call. The
+chunks are sized from the estimates alone. Every run reports the peak
+resident memory of the process, which costs a system call per chunk, and
+the allocations are only traced when the caller asks for their peak with
+trace_memory=True.
+
+Chunking only shrinks the working set of the stages. The caller's dataframe
+is held throughout, so a warning is given when it alone is over the limit.
+
+Available functions
+estimate_memory : Estimates the working set of each stage of an entry point
+run_within : Runs an entry point in chunks that fit a memory limit
+"""
+
+import sys
+import tracemalloc
+import warnings
+import numpy as np
+import pandas as pd
+
+from .partition import ENTRY_POINTS, ID_ARGS, VALUE_ARGS, ROW_COL, _combine, _entry_point, _first_rows
+
+# Peak of each stage as a multiple of the input bytes
+STAGE_COST = {'process_outcomes': {'standardize': 2.5,
+                                   'screen': 0.5,
+                                   'attach_map': 2.0,
+                                   'collapse': 0.5,
+                                   'spacing': 0.5,
+                                   'validate_outcomes': 1.0,
+                                   'set_preg_window': 0.5,
+                                   'check_window': 1.0},
+              'smm': {'standardize': 2.5,
+                      'screen': 0.5,
+                      'match': 1.0,
+                      'indicators': 1.0,
+                      'output': 0.5},
+              'apo': {'standardize': 2.5,
+                      'screen': 0.5,
+                      'match': 2.0,
+                      'output': 0.5},
+              'calc_index': {'standardize': 2.0,
+                             'assign_weights': 1.0,
+                             'score': 0.5}}
+
+# The caller's dataframe and the entry point's working copy are held through every stage
+RETAINED = 2.0
+
+# Rows sampled to measure the bytes of text columns
+SAMPLE_ROWS = 10_000
+
+
+def _row_bytes(df: pd.DataFrame,
+               columns: list):
+    """
+    Utility to measure the average bytes per row of the columns an entry point reads,
+    text columns are measured on a sample.
+    """
+
+    if not len(df):
+        return 0.0
+
+    sample = df[columns]
+    if len(sample) > SAMPLE_ROWS:
+        sample = sample.sample(SAMPLE_ROWS, random_state=0)
+
+    return sample.memory_usage(deep=True, index=False).sum() / len(sample)
+
+
+def _read_cols(analysis: str,
+               df: pd.DataFrame,
+               kwargs: dict):
+    """
+    Utility to list the input columns an entry point carries through its stages.
+    """
+
+    if analysis == 'process_outcomes':
+        return list(df.columns)
+
+    return [kwargs[arg] for arg in ID_ARGS[analysis] + VALUE_ARGS[analysis] if kwargs.get(arg) is not None]
+
+
+def estimate_memory(analysis: str,
+                    df: pd.DataFrame,
+                    **kwargs):
+    """
+    Estimates the working set of each stage of an entry point on the data.
+
+    :param analysis: Name of the entry point: 'process_outcomes', 'smm', 'apo', or 'calc_index'
+    :param df: Pandas dataframe that would be passed to the entry point
+    :param kwargs: Arguments of the entry point other than the dataframe
+
+    :return: Returns a dictionary of stage name to estimated bytes
+
+    :raises: ValueError
+        If the analysis does not exist
+    """
+
+    _entry_point(analysis)
+    input_bytes = _row_bytes(df, _read_cols(analysis, df, kwargs)) * len(df)
+
+    return {stage: int(input_bytes * (RETAINED + cost))
+            for stage, cost in STAGE_COST[analysis].items()}
+
+
+def _max_rss():
+    """
+    Utility to read the peak resident memory of the process in bytes, None where the
+    resource module is missing (Windows).
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    # Linux reports kilobytes, macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _chunks(keys: np.ndarray,
+            rows_per_chunk: int):
+    """
+    Utility to cut rows sorted by key into chunks of at most rows_per_chunk rows without
+    splitting a key. A key with more rows than that is kept whole in its own chunk.
+    """
+
+    size = len(keys)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    cuts = [0]
+    while cuts[-1] < size:
+        reach = cuts[-1] + rows_per_chunk
+        if reach >= size:
+            cuts.append(size)
+            continue
+
+        # The last key start within reach, or the next key start when a key alone is too large
+        cut = starts[np.searchsorted(starts, reach, side='right') - 1]
+        if cut <= cuts[-1]:
+            later = np.searchsorted(starts, cuts[-1], side='right')
+            cut = starts[later] if later < len(starts) else size
+        cuts.append(int(cut))
+
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def run_within(analysis: str,
+               df: pd.DataFrame,
+               memory_limit: int,
+               trace_memory: bool = False,
+               **kwargs):
+    """
+    Runs an entry point in chunks of whole patients sized from the stage estimates so the
+    working set stays under the limit, and combines the results in the order of a single call.
+
+    The result carries a dictionary in output.attrs['memory'] with the limit, the estimate for
+    the whole input, the number of chunks, the rows per chunk, a list of the peak resident memory
+    of the process after each chunk (rss), and the traced peak in bytes. The resident peak is a high
+    water mark of the whole process, so it includes the memory held before the run, and it is
+    None where the platform can't report it. The traced peak is None unless trace_memory is
+    set. Tracing is global to the process, so the peak is only measured when tracemalloc is
+    not already tracing, and it counts the allocations of every thread.
+
+    :param analysis: Name of the entry point: 'process_outcomes', 'smm', 'apo', or 'calc_index'
+    :param df: Pandas dataframe passed to the entry point
+    :param memory_limit: Memory budget in bytes
+    :param trace_memory: Trace the allocations of the run to report its peak, tracing slows
+        the entry point down
+    :param kwargs: Arguments of the entry point other than the dataframe
+
+    :return: Returns the pandas dataframe returned by the entry point
+
+    :raises: ValueError
+        If the analysis does not exist or the limit is not positive
+    """
+
+    from .instrument import _MEMORY_LOCK
+
+    if memory_limit <= 0:
+        raise ValueError('memory_limit must be positive')
+
+    function = _entry_point(analysis)
+    partition_arg, order_args = ENTRY_POINTS[analysis]
+    order_cols = None if order_args is None \
+        else [kwargs.get(arg, arg) for arg in order_args]
+
+    # The input is held through every chunk, chunking can't bring it under the limit
+    input_bytes = _row_bytes(df, _read_cols(analysis, df, kwargs)) * len(df)
+    if input_bytes > memory_limit:
+        warnings.warn(f'The input alone takes about {int(input_bytes)} bytes, over the memory_limit of '
+                      f'{memory_limit}. Chunking only reduces the working set of the stages.')
+
+    estimate = max(estimate_memory(analysis, df, **kwargs).values(), default=0)
+    rows_per_chunk = len(df) if estimate <= memory_limit \
+        else max(1, int(len(df) * memory_limit / estimate))
+
+    # Only a run that starts tracing may read its peak, tracing started elsewhere is left alone
+    started = False
+    if trace_memory:
+        with _MEMORY_LOCK:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started = True
+
+    peak = None
+    try:
+        if rows_per_chunk >= len(df):
+            chunks = 1
+            output = function(df, **kwargs)
+            rss = [_max_rss()]
+        else:
+            # Rows of a patient are contiguous once sorted, a stable sort keeps their input order
+            keys, _ = pd.factorize(df[kwargs[partition_arg]], sort=False)
+            order = np.argsort(keys, kind='stable')
+            ranges = _chunks(keys[order], rows_per_chunk)
+            chunks = len(ranges)
+
+            results = []
+            rss = []
+            for start, end in ranges:
+                chunk = df.iloc[order[start:end]].assign(**{ROW_COL: order[start:end]})
+                output = function(chunk.drop(columns=ROW_COL), **kwargs)
+                if order_cols is None:
+                    output = _first_rows(output, chunk, kwargs)
+                results.append(output)
+                rss.append(_max_rss())
+                del chunk
+            output = _combine(results, order_cols)
+        if started:
+            peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    output.attrs['memory'] = {'limit': memory_limit,
+                              'estimate': estimate,
+                              'chunks': chunks,
+                              'rows_per_chunk': min(rows_per_chunk, len(df)),
+                              'rss': rss,
+                              'peak': peak}
+
+    return output
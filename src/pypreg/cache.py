@@ -0,0 +1,179 @@
+"""
+On-disk cache of entry point results per patient partition.
+
+Copyright (C) 2023 Dave Walsh
+
+A result is stored under a key that hashes the content of the columns the
+entry point reads from a partition, the entry point and its arguments, the
+version of the package code sets, and any code sets registered for the entry
+point. A rerun over mostly unchanged data finds the results of unchanged
+partitions on disk and only recomputes the partitions whose patients
+changed. Any change to the code maps gives every partition a new key, stale
+results are never served.
+
+The cache is bounded by total size and file count. Reading a result marks it
+as recently used, and the least recently used results are removed first.
+
+Results are stored as pickles, only point the cache at a directory you trust.
+
+Available classes
+ResultCache : Content-addressed result store with LRU eviction
+"""
+
+import hashlib
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+import pandas as pd
+
+from .code_sets import registered_code_sets
+
+SUFFIX = '.pkl'
+
+
+@lru_cache(maxsize=1)
+def code_set_version():
+    """
+    Hashes the package version and every code map so results computed with other code sets get other keys.
+
+    :return: Returns a hexadecimal digest
+    """
+
+    from importlib.metadata import version, PackageNotFoundError
+    from .sql.code_tables import code_set_table, weight_table
+
+    try:
+        package = version('pypreg')
+    except PackageNotFoundError:
+        package = 'unknown'
+
+    digest = hashlib.sha256(package.encode())
+    for table in [code_set_table(), weight_table()]:
+        digest.update(pd.util.hash_pandas_object(table.astype(str), index=False).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Stores entry point results on disk under a hash of their inputs.
+
+    cache = ResultCache('~/.cache/pypreg', max_bytes=2 * 2**30)
+    run_partitioned('smm', 'claims/', cache=cache, ...)
+
+    :param directory: Directory holding the cached results, created if needed
+    :param max_bytes: Optional limit on the total size of the cached results
+    :param max_files: Optional limit on the number of cached results
+    """
+
+    def __init__(self,
+                 directory,
+                 max_bytes: int = None,
+                 max_files: int = None):
+        self.directory = Path(directory).expanduser()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+
+    def key(self,
+            analysis: str,
+            df: pd.DataFrame,
+            kwargs: dict):
+        """
+        Builds the key of an entry point call.
+
+        :param analysis: Name of the entry point
+        :param df: Input data of the call, only the columns the entry point reads should be passed
+        :param kwargs: Arguments of the entry point other than the dataframe
+
+        :return: Returns a hexadecimal digest
+        """
+
+        digest = hashlib.sha256()
+        digest.update(code_set_version().encode())
+        digest.update(json.dumps([analysis, kwargs], sort_keys=True, default=str).encode())
+        digest.update(json.dumps([[str(col), str(dtype)] for col, dtype in df.dtypes.items()]).encode())
+
+        # Code sets registered for the entry point change its result
+        for name, code_map in registered_code_sets(analysis).items():
+            digest.update(name.encode())
+            digest.update(pd.util.hash_pandas_object(code_map.astype(str), index=False).to_numpy().tobytes())
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+        return digest.hexdigest()
+
+    def _path(self, key: str):
+        return self.directory / f'{key}{SUFFIX}'
+
+    def get(self, key: str):
+        """
+        :param key: Key from ResultCache.key
+
+        :return: Returns the cached dataframe, or None when the key is not cached
+        """
+
+        path = self._path(key)
+        try:
+            output = pd.read_pickle(path)
+        except (FileNotFoundError, EOFError):
+            return None
+
+        # The modification time orders the results for eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return output
+
+    def put(self,
+            key: str,
+            output: pd.DataFrame):
+        """
+        Stores a result. The file is written beside its final name first, so readers in
+        other processes never see a partial result.
+
+        :param key: Key from ResultCache.key
+        :param output: Dataframe to store
+        """
+
+        path = self._path(key)
+        temp = path.with_suffix(f'.{os.getpid()}.tmp')
+        output.to_pickle(temp)
+        os.replace(temp, path)
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache is within its limits.
+
+        :return: Returns the number of results removed
+        """
+
+        files = []
+        for path in self.directory.glob(f'*{SUFFIX}'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        while files and ((self.max_bytes is not None and total > self.max_bytes)
+                         or (self.max_files is not None and len(files) > self.max_files)):
+            _, size, path = files.pop(0)
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+
+        return removed
+
+    def clear(self):
+        """
+        Removes every cached result.
+        """
+
+        for path in self.directory.glob(f'*{SUFFIX}'):
+            path.unlink(missing_ok=True)
@@ -0,0 +1,323 @@
+"""
+Command line driver for running the pypreg analyses over a dataset.
+
+Copyright (C) 2023 Dave Walsh
+
+The input dataset, a parquet or CSV file or a directory of them, is
+hash-partitioned by patient into a work directory under the output. Each
+selected analysis is then run on each partition in worker processes and
+written to output/<analysis>/part-NNNNN.parquet (or .csv). Finished
+partitions are recorded in output/manifest.json, so running the same command
+again after an interruption only runs the partitions that are missing.
+
+pypreg claims/ results/ --analyses process_outcomes smm \\
+    --columns patient=PAT_ID encounter=ENC_ID admit_date=ADMIT_DT \\
+              code_type=CODE_TYPE version=CODE_VERSION code=CODE \\
+    --workers 4 --partitions 64
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import pandas as pd
+
+from .cache import ResultCache
+from .partition import ROW_COL, cached_call, partition_data, _entry_point, _read_partition
+
+MANIFEST = 'manifest.json'
+PARTITION_DIR = '_partitions'
+
+# Column roles understood by --columns
+ROLES = ['patient', 'encounter', 'admit_date', 'code_type', 'version', 'code', 'pregnancy', 'age']
+
+# Column roles each analysis needs, and how they map onto its arguments
+ANALYSES = {'process_outcomes': {'patient_col': 'patient',
+                                 'encounter_col': 'encounter',
+                                 'admit_date_col': 'admit_date',
+                                 'version_col': 'version',
+                                 'type_col': 'code_type',
+                                 'code_col': 'code'},
+            'smm': {'enc_id': 'encounter',
+                    'code_type': 'code_type',
+                    'version': 'version',
+                    'code': 'code'},
+            'apo': {'patient_id': 'patient',
+                    'preg_id': 'pregnancy',
+                    'code_type': 'code_type',
+                    'version': 'version',
+                    'code': 'code'},
+            'calc_index': {'patient_col': 'patient',
+                           'pregnancy_col': 'pregnancy',
+                           'code_col': 'code',
+                           'version_col': 'version'}}
+
+
+def _parse_columns(pairs: list):
+    """
+    Utility to turn role=column pairs into a dictionary, unmapped roles keep their own name.
+    """
+
+    columns = {}
+    for pair in pairs or []:
+        role, sep, column = pair.partition('=')
+        if not sep or role not in ROLES:
+            raise ValueError(f'Column mappings must look like role=column with role one of {ROLES}')
+        columns[role] = column
+
+    return columns
+
+
+def analysis_kwargs(analysis: str,
+                    columns: dict,
+                    expanded: bool = False,
+                    indicators: bool = False,
+                    method: str = 'bateman'):
+    """
+    Builds the keyword arguments of an entry point from the column mapping and options.
+
+    :param analysis: Name of the entry point
+    :param columns: Dictionary of column role to dataset column
+    :param expanded: Use the expanded code set in process_outcomes
+    :param indicators: Return the individual SMM indicators from smm
+    :param method: Scoring method of calc_index, 'bateman' or 'leonard'
+
+    :return: Returns a dictionary of keyword arguments
+    """
+
+    kwargs = {arg: columns.get(role, role) for arg, role in ANALYSES[analysis].items()}
+    if analysis == 'process_outcomes':
+        kwargs['expanded'] = expanded
+    elif analysis == 'smm':
+        kwargs['indicators'] = indicators
+    elif analysis == 'calc_index':
+        kwargs['method'] = method
+        if 'age' in columns:
+            kwargs['age_col'] = columns['age']
+
+    return kwargs
+
+
+def _load_manifest(path: Path,
+                   settings: dict,
+                   restart: bool):
+    """
+    Utility to read the manifest of a previous run, or start a new one.
+    """
+
+    if path.exists() and not restart:
+        with open(path) as file:
+            manifest = json.load(file)
+        if manifest['settings'] != settings:
+            raise ValueError(f'{path} was written with different settings, '
+                             f'use --restart to discard the previous run.')
+        return manifest
+
+    return {'settings': settings, 'partitions': None, 'done': {}}
+
+
+def _save_manifest(path: Path,
+                   manifest: dict):
+    """
+    Utility to replace the manifest in a single step so an interruption never leaves it half written.
+    """
+
+    temp = path.with_suffix('.tmp')
+    with open(temp, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temp, path)
+
+
+def _run_task(analysis: str,
+              part: str,
+              kwargs: dict,
+              destination: str,
+              output_format: str,
+              admit_date: str,
+              cache: ResultCache = None):
+    """
+    Runs one analysis on one partition and writes its output. Module level so worker processes can call it.
+    """
+
+    df = _read_partition(part).drop(columns=ROW_COL)
+    if analysis == 'process_outcomes':
+        df[admit_date] = pd.to_datetime(df[admit_date])
+
+    output = cached_call(analysis, df, kwargs, cache)
+
+    # Write beside the destination first so a partial file is never taken as finished
+    temp = destination + '.tmp'
+    if output_format == 'csv':
+        output.to_csv(temp, index=False)
+    else:
+        output.to_parquet(temp, index=False)
+    os.replace(temp, destination)
+
+    return analysis, Path(part).name
+
+
+def run(input_path: str,
+        output_path: str,
+        analyses: list,
+        columns: dict,
+        n_partitions: int = 16,
+        workers: int = 1,
+        output_format: str = 'parquet',
+        expanded: bool = False,
+        indicators: bool = False,
+        method: str = 'bateman',
+        restart: bool = False,
+        keep_partitions: bool = False,
+        cache: ResultCache = None,
+        log=print):
+    """
+    Runs the selected analyses over every partition of a dataset, resuming a previous run when
+    its manifest is found in the output directory.
+
+    :param input_path: Parquet or CSV file, or a directory of parquet or CSV files
+    :param output_path: Directory for the outputs, the manifest, and the temporary partitions
+    :param analyses: Names of the entry points to run
+    :param columns: Dictionary of column role to dataset column
+    :param n_partitions: Number of patient partitions
+    :param workers: Number of partitions processed at once in worker processes
+    :param output_format: 'parquet' or 'csv'
+    :param expanded: Use the expanded code set in process_outcomes
+    :param indicators: Return the individual SMM indicators from smm
+    :param method: Scoring method of calc_index, 'bateman' or 'leonard'
+    :param restart: Discard the outputs of a previous run
+    :param keep_partitions: Keep the partitioned input after every analysis has finished
+    :param cache: Optional ResultCache that serves partitions unchanged since an earlier run
+    :param log: Callable that receives progress messages
+
+    :return: Returns the manifest dictionary
+
+    :raises: ValueError
+        If an analysis does not exist or the manifest was written with other settings
+    """
+
+    for analysis in analyses:
+        _entry_point(analysis)
+
+    output = Path(output_path)
+    output.mkdir(parents=True, exist_ok=True)
+    manifest_path = output / MANIFEST
+    partitions = output / PARTITION_DIR
+
+    settings = {'input': str(Path(input_path).resolve()),
+                'analyses': list(analyses),
+                'columns': columns,
+                'partitions': n_partitions,
+                'format': output_format,
+                'expanded': expanded,
+                'indicators': indicators,
+                'method': method}
+    manifest = _load_manifest(manifest_path, settings, restart)
+
+    if restart:
+        for analysis in analyses:
+            shutil.rmtree(output / analysis, ignore_errors=True)
+
+    # Partition the input once, an interrupted partitioning step starts over. Partitions
+    # removed after an earlier run are rebuilt the same way when work remains.
+    complete = manifest['partitions'] is not None \
+        and all(len(manifest['done'].get(analysis, [])) == len(manifest['partitions'])
+                for analysis in analyses)
+    if manifest['partitions'] is None or (not complete and not (partitions / '.complete').exists()):
+        shutil.rmtree(partitions, ignore_errors=True)
+        patient = columns.get('patient', 'patient')
+        dtype = {columns.get(role, role): str for role in ['code_type', 'version', 'code']}
+        log(f'Partitioning {input_path} by {patient}')
+        parts = partition_data(input_path, patient, partitions, n_partitions, dtype=dtype)
+        (partitions / '.complete').touch()
+        manifest['partitions'] = [Path(part).name for part in parts]
+        _save_manifest(manifest_path, manifest)
+
+    # Every analysis and partition pair not yet recorded as finished
+    tasks = []
+    for analysis in analyses:
+        (output / analysis).mkdir(exist_ok=True)
+        kwargs = analysis_kwargs(analysis, columns, expanded, indicators, method)
+        done = set(manifest['done'].get(analysis, []))
+        for name in manifest['partitions']:
+            if name not in done:
+                destination = str(output / analysis / f'{name}.{output_format}')
+                tasks.append((analysis, str(partitions / name), kwargs, destination,
+                              output_format, columns.get('admit_date', 'admit_date'), cache))
+
+    log(f'{len(tasks)} of {len(analyses) * len(manifest["partitions"])} partitions to run')
+
+    def finished(analysis, name):
+        manifest['done'].setdefault(analysis, []).append(name)
+        _save_manifest(manifest_path, manifest)
+        log(f'{analysis} {name} done')
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_run_task, *task) for task in tasks]
+            for future in as_completed(futures):
+                finished(*future.result())
+    else:
+        for task in tasks:
+            finished(*_run_task(*task))
+
+    if cache is not None:
+        cache.evict()
+
+    if not keep_partitions:
+        shutil.rmtree(partitions, ignore_errors=True)
+
+    return manifest
+
+
+def main(argv=None):
+    """
+    Console entry point for the pypreg command.
+    """
+
+    parser = argparse.ArgumentParser(prog='pypreg',
+                                     description='Run pypreg analyses over a partitioned parquet or CSV dataset.')
+    parser.add_argument('input', help='Parquet or CSV file, or a directory of parquet or CSV files')
+    parser.add_argument('output', help='Output directory, also holds the manifest used to resume')
+    parser.add_argument('--analyses', nargs='+', default=['process_outcomes'], choices=list(ANALYSES))
+    parser.add_argument('--columns', nargs='+', metavar='ROLE=COLUMN',
+                        help=f'Dataset column of each role, roles are {", ".join(ROLES)}')
+    parser.add_argument('--partitions', type=int, default=16, help='Number of patient partitions')
+    parser.add_argument('--workers', type=int, default=1, help='Partitions processed at once')
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet', help='Output format')
+    parser.add_argument('--expanded', action='store_true', help='Expanded code set for process_outcomes')
+    parser.add_argument('--indicators', action='store_true', help='Individual SMM indicators for smm')
+    parser.add_argument('--method', choices=['bateman', 'leonard'], default='bateman',
+                        help='Scoring method for calc_index')
+    parser.add_argument('--restart', action='store_true', help='Discard a previous run in the output directory')
+    parser.add_argument('--keep-partitions', action='store_true',
+                        help='Keep the partitioned input after the run')
+    parser.add_argument('--cache', help='Directory of a result cache reused between runs')
+    parser.add_argument('--cache-size', type=int, help='Largest total size of the result cache in bytes')
+    args = parser.parse_args(argv)
+
+    try:
+        run(args.input,
+            args.output,
+            args.analyses,
+            _parse_columns(args.columns),
+            n_partitions=args.partitions,
+            workers=args.workers,
+            output_format=args.format,
+            expanded=args.expanded,
+            indicators=args.indicators,
+            method=args.method,
+            restart=args.restart,
+            keep_partitions=args.keep_partitions,
+            cache=ResultCache(args.cache, max_bytes=args.cache_size) if args.cache else None,
+            log=lambda message: print(message, file=sys.stderr))
+    except (ValueError, KeyError) as error:
+        parser.exit(2, f'pypreg: error: {error}\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
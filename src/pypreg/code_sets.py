@@ -0,0 +1,307 @@
+"""
+Registry of user code sets matched alongside the package code sets.
+
+Copyright (C) 2023 Dave Walsh
+
+Other conditions can be flagged by apo and smm by registering a code set in
+the layout of the mapping modules, a dictionary keyed by code type, then by
+version, holding a tuple of regular expressions under 'code':
+
+    PPH = {'DX': {'ICD10': {'code': ("^O72.*",)},
+                  'ICD9': {'code': ("^666.*",)}}}
+    register_code_set('postpartum hemorrhage', PPH, entry='apo')
+
+A registered code set adds a boolean column of its name to the output of the
+entry point. Codes are matched as the entry point writes them, without dots
+and upper cased.
+
+Code sets are matched by match_code_rows. The code column is factorized once,
+the patterns of each code set are applied to the distinct codes only, and the
+rows are joined to every code set that flagged their code in a single merge,
+so a registered code set costs a pass over the distinct codes rather than
+another pass over the rows. apo and smm match their own maps and the
+registered code sets together in that one pass. smm takes the matched rows
+from match_code_rows, so its indicators and provenance come from the same
+pass as its flags.
+
+Registered code sets live in the memory of the process. They are seen by the
+worker processes of run_partitioned and run_shared where workers are forked,
+and are not part of the generated SQL.
+
+Available functions
+register_code_set : Adds a code set to the output of an entry point
+unregister_code_set : Removes a registered code set
+registered_code_sets : Lists the code sets registered for an entry point
+code_set_frame : Flattens a code set in the layout of the mapping modules
+with_registered_prefixes : Adds the prefixes of the registered code sets to those of an entry point
+match_code_rows : Finds the rows whose codes match each code set
+flag_code_rows : Flags the units of the rows found by match_code_rows
+match_code_sets : Flags the units whose codes match each code set
+"""
+
+import re
+import numpy as np
+import pandas as pd
+
+from .dtypes import CODE_TYPE_DTYPE, VERSION_DTYPE
+from .screen import code_prefixes
+
+CODE_SET = '_pypreg_code_set'
+POSITION = '_pypreg_position'
+JOIN = '_pypreg_join'
+ROW = '_pypreg_code_row'
+MAP_VERSION = '_pypreg_map_version'
+
+# Registered code sets of each entry point keyed by name, in the order they were registered
+_REGISTRY = {'apo': dict(),
+             'smm': dict()}
+
+
+def _entry_labels(entry: str):
+    """
+    Utility to look up the standard code types and versions of an entry point, and the
+    names of its output columns.
+    """
+
+    if entry == 'apo':
+        from .adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import TYPES, VERSIONS, APO_MAPS
+        return TYPES, VERSIONS, list(APO_MAPS)
+
+    from .smm.smm import TYPES, VERSIONS, SMM_INDICATORS
+    return TYPES, VERSIONS, ['smm', 'transfusion', 'smm_pattern_id', 'transfusion_pattern_id',
+                             *SMM_INDICATORS.indicator.cat.categories]
+
+
+def code_set_frame(code_set):
+    """
+    Flattens a code set in the layout of the mapping modules into a dataframe.
+
+    :param code_set: Dictionary keyed by code type, then version, with a tuple of regular
+        expressions under 'code', or a dataframe with code_type, version, and code columns
+
+    :return: Returns a pandas dataframe with the code_type, version, and code columns
+    """
+
+    if isinstance(code_set, pd.DataFrame):
+        return code_set[['code_type', 'version', 'code']].reset_index(drop=True)
+
+    return pd.DataFrame([(code_type, version, pattern)
+                         for code_type, versions in code_set.items()
+                         for version, codes in versions.items()
+                         for pattern in codes['code']],
+                        columns=['code_type', 'version', 'code'])
+
+
+def register_code_set(name: str,
+                      code_set,
+                      entry: str = 'apo'):
+    """
+    Adds a code set to the output of an entry point. Registering a name again replaces its
+    code set.
+
+    :param name: Name of the output column
+    :param code_set: Dictionary keyed by code type, then version, with a tuple of regular
+        expressions under 'code', or a dataframe with code_type, version, and code columns
+    :param entry: Entry point that flags the code set: 'apo' or 'smm'
+
+    :return: Returns the flattened code set
+
+    :raises: ValueError
+        If the entry point does not take code sets, the name is an output column of the
+        entry point, or a code type, version, or pattern is not valid
+    """
+
+    if entry not in _REGISTRY:
+        raise ValueError(f'Entry must be one of {list(_REGISTRY)}')
+
+    types, versions, reserved = _entry_labels(entry)
+    if name in reserved:
+        raise ValueError(f'{name} is an output column of {entry}')
+
+    code_map = code_set_frame(code_set)
+    if not len(code_map):
+        raise ValueError('The code set has no patterns')
+
+    unknown = set(code_map['code_type']) - set(types)
+    if unknown:
+        raise ValueError(f'Code types {unknown} are not standard forms of {entry}: {list(types)}')
+    unknown = set(code_map['version']) - set(versions)
+    if unknown:
+        raise ValueError(f'Versions {unknown} are not standard forms of {entry}: {list(versions)}')
+
+    for pattern in code_map['code']:
+        try:
+            re.compile(pattern)
+        except (re.error, TypeError) as error:
+            raise ValueError(f'Pattern {pattern!r} is not a regular expression: {error}') from None
+
+    _REGISTRY[entry][name] = code_map.astype({'code_type': CODE_TYPE_DTYPE,
+                                              'version': VERSION_DTYPE})
+
+    return code_map
+
+
+def unregister_code_set(name: str,
+                        entry: str = 'apo'):
+    """
+    Removes a registered code set.
+
+    :param name: Name the code set was registered under
+    :param entry: Entry point the code set was registered for
+
+    :raises: KeyError
+        If no code set is registered under the name
+    """
+
+    if name not in _REGISTRY.get(entry, {}):
+        raise KeyError(f'No code set {name} is registered for {entry}')
+
+    del _REGISTRY[entry][name]
+
+
+def registered_code_sets(entry: str = 'apo'):
+    """
+    Lists the code sets registered for an entry point.
+
+    :param entry: Entry point: 'apo' or 'smm'
+
+    :return: Returns a dictionary of name to a dataframe with the code_type, version, and
+    code columns, in the order the code sets were registered
+    """
+
+    return {name: code_map.copy() for name, code_map in _REGISTRY.get(entry, {}).items()}
+
+
+def with_registered_prefixes(prefixes,
+                             entry: str):
+    """
+    Adds the prefixes of the code sets registered for an entry point to its own prefixes.
+
+    :param prefixes: Tuple of prefixes from code_prefixes, or None
+    :param entry: Entry point: 'apo' or 'smm'
+
+    :return: Returns the tuple of prefixes a code must start with to match any code set of
+    the entry point, or None when no code can be ruled out
+    """
+
+    patterns = [pattern for code_map in _REGISTRY.get(entry, {}).values() for pattern in code_map['code']]
+    if not patterns or prefixes is None:
+        return prefixes
+
+    extra = code_prefixes(patterns)
+    if extra is None:
+        return None
+
+    return code_prefixes([f'^{prefix}' for prefix in [*prefixes, *extra]])
+
+
+def match_code_rows(df: pd.DataFrame,
+                    code_type: str,
+                    version: str,
+                    code: str,
+                    code_sets: dict):
+    """
+    Finds the rows whose codes match each code set. Each code set is matched as the entry
+    points always have: its patterns replace the matching codes in order and a row matches
+    when the result is a pattern of its code type. The code column is factorized once and
+    the patterns of every code set are applied to the distinct codes only.
+
+    :param df: Pandas dataframe of standardized codes
+    :param code_type: Column with the standard code type
+    :param version: Column with the standard version
+    :param code: Column with the code
+    :param code_sets: Dictionary of name to a dataframe with code_type, version, and code
+        columns, the code type and version in the dtypes of the standardized data
+
+    :return: Returns a pandas dataframe with a row per matched row and pattern: the position
+    of the row in df (ROW), its code type and version, the code set (CODE_SET), the pattern
+    (JOIN), and the version of the pattern (MAP_VERSION)
+    """
+
+    positions, uniques = pd.factorize(df[code])
+    uniques = pd.Series(uniques, dtype=object)
+
+    # The patterns are applied to each distinct code once
+    found = []
+    for name, code_map in code_sets.items():
+        patterns = code_map['code'].to_list()
+        joined = uniques.replace(patterns, patterns, regex=True)
+        hit = np.flatnonzero(joined.isin(patterns))
+        found.append(pd.DataFrame({POSITION: hit,
+                                   JOIN: joined.to_numpy()[hit],
+                                   CODE_SET: name}))
+    found = pd.concat(found, ignore_index=True)
+
+    code_maps = pd.concat([code_map[['code_type', 'version', 'code']]
+                          .rename(columns={'code_type': code_type, 'version': MAP_VERSION, 'code': JOIN})
+                          .assign(**{CODE_SET: name})
+                           for name, code_map in code_sets.items()],
+                          ignore_index=True)\
+        .drop_duplicates()
+
+    # Every row is joined to the code sets that flagged its code in a single merge
+    rows = pd.DataFrame({POSITION: positions,
+                         code_type: df[code_type].to_numpy(),
+                         version: df[version].to_numpy()})\
+        .reset_index(names=ROW)\
+        .merge(found, how='inner', on=POSITION)\
+        .merge(code_maps, how='inner', on=[CODE_SET, code_type, JOIN])
+
+    return rows.drop(columns=POSITION)
+
+
+def flag_code_rows(df: pd.DataFrame,
+                   keys: list,
+                   rows: pd.DataFrame,
+                   names: list):
+    """
+    Flags the units of the rows found by match_code_rows for each code set.
+
+    :param df: Pandas dataframe the rows were found in
+    :param keys: Columns identifying the units that are flagged
+    :param rows: Matched rows from match_code_rows
+    :param names: Names of the code sets, one boolean column each
+
+    :return: Returns a pandas dataframe with the keys and a boolean column per code set,
+    with a row for each unit that at least one code set flags
+    """
+
+    matched = df[keys].iloc[rows[ROW].to_numpy()]\
+        .assign(**{CODE_SET: rows[CODE_SET].to_numpy()})\
+        .drop_duplicates()\
+        .reset_index(drop=True)
+
+    output = matched[keys].drop_duplicates().reset_index(drop=True)
+    units = pd.MultiIndex.from_frame(output)
+    for name in names:
+        output[name] = units.isin(pd.MultiIndex.from_frame(matched.loc[matched[CODE_SET] == name, keys]))
+
+    return output
+
+
+def match_code_sets(df: pd.DataFrame,
+                    keys: list,
+                    code_type: str,
+                    version: str,
+                    code: str,
+                    code_sets: dict):
+    """
+    Flags the units whose codes match each code set, with the patterns of the version of
+    each row, see match_code_rows.
+
+    :param df: Pandas dataframe of standardized codes
+    :param keys: Columns identifying the units that are flagged
+    :param code_type: Column with the standard code type
+    :param version: Column with the standard version
+    :param code: Column with the code
+    :param code_sets: Dictionary of name to a dataframe with code_type, version, and code
+        columns, the code type and version in the dtypes of the standardized data
+
+    :return: Returns a pandas dataframe with the keys and a boolean column per code set,
+    with a row for each unit that at least one code set flags
+    """
+
+    rows = match_code_rows(df, code_type, version, code, code_sets)
+    rows = rows[rows[version].to_numpy(dtype=object) == rows[MAP_VERSION].to_numpy(dtype=object)]
+
+    return flag_code_rows(df, keys, rows, list(code_sets))
@@ -0,0 +1,55 @@
+"""
+Categorical dtypes of the code metadata.
+
+Copyright (C) 2023 Dave Walsh
+
+The code type and version columns hold a handful of distinct strings on
+every row of an extract. Once standardized they are held as categoricals with
+a fixed category order shared by every entry point, so equality filters,
+joins, and groupbys work on small integer codes, and results of separate
+partitions concatenate without falling back to strings.
+
+The outcome and schema dtypes are kept with OUTCOME_LIST in outcome_map, and
+the indicator dtypes with their maps.
+
+Available functions
+standard_labels : Replaces the accepted labels of a column with their standard form
+"""
+
+import pandas as pd
+
+# Standard forms of the code type and version, the union of those of the entry points
+CODE_TYPE_DTYPE = pd.CategoricalDtype(['DX', 'PX', 'DRG'])
+VERSION_DTYPE = pd.CategoricalDtype(['ICD9', 'ICD10', 'CPT', 'CPT4', 'DRG'])
+
+
+def standard_labels(values: pd.Series,
+                    labels: dict,
+                    dtype: pd.CategoricalDtype,
+                    fold):
+    """
+    Replaces the accepted labels of a column with their standard form in a categorical dtype.
+    The labels are folded and looked up once per distinct value rather than once per row.
+
+    :param values: Pandas series of labels as given by the user
+    :param labels: Dictionary keyed by the standard form with a tuple of accepted labels
+    :param dtype: Categorical dtype that holds the standard forms
+    :param fold: Function applied to a series of the distinct labels before the lookup, such as
+        lambda labels: labels.str.lower()
+
+    :return: Returns the categorical series, missing where the label is not accepted, and
+    the set of folded labels that are not accepted
+    """
+
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    folded = fold(pd.Series(uniques, dtype=object))
+
+    lookup = {label: standard for standard, accepted in labels.items() for label in accepted}
+    standard = folded.map(lookup)
+    unknown = set(folded[standard.isna()])
+
+    # Category code of each distinct label, -1 where it is not accepted
+    positions = dtype.categories.get_indexer(standard)
+    categorical = pd.Categorical.from_codes(positions[codes], dtype=dtype)
+
+    return pd.Series(categorical, index=values.index, name=values.name), unknown
@@ -0,0 +1,196 @@
+"""
+Stage instrumentation for the pypreg entry points.
+
+Copyright (C) 2023 Dave Walsh
+
+process_outcomes, smm, apo, and calc_index report each stage of their work to
+any listener registered with the instrument context manager. Every event is a
+dictionary with the entry point, the stage name, the wall time of the stage,
+the rows going in and out of the stage, and, when requested, the peak traced
+memory above the memory in use when the stage started.
+
+Listeners are kept per thread and per asyncio task, so instrumenting one call
+does not collect events from calls running elsewhere. Without a listener the
+entry points only pay for a clock read per stage.
+
+Memory is traced with tracemalloc, whose tracing and peak are global to the
+process. Only one context may trace memory at a time: instrument(memory=True)
+is refused while tracemalloc is already tracing for another thread or task,
+or for code outside pypreg. The traced peak counts the allocations of every
+thread, so the memory deltas are only meaningful for single-threaded runs.
+
+Available functions and classes
+instrument : Context manager that sends stage events to a callback
+StageReport : Callback that collects events and writes them as JSON or CSV
+"""
+
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+import pandas as pd
+
+EVENT_COLUMNS = ['entry',
+                 'stage',
+                 'seconds',
+                 'rows_in',
+                 'rows_out',
+                 'peak_memory_delta']
+
+# Registered (callback, memory) pairs for the current context
+_LISTENERS = ContextVar('pypreg_listeners', default=())
+
+# Marker of the instrument block that started tracing memory, set in its context only
+_MEMORY = ContextVar('pypreg_memory', default=None)
+_MEMORY_LOCK = threading.Lock()
+
+
+@contextmanager
+def instrument(callback,
+               memory: bool = False):
+    """
+    Sends an event for every stage run by the pypreg entry points inside the block to a callback.
+
+    :param callback: Callable that accepts a single event dictionary
+    :param memory: Trace memory allocations to report the peak memory delta of each stage.
+        Tracing slows the entry points down, the timings are less accurate when it is on.
+        Blocks nested in one that traces memory share its tracing.
+
+    :return: Returns the callback
+
+    :raises: RuntimeError
+        If memory is requested while tracemalloc is tracing for another context
+    """
+
+    # Tracing is global to the process, only the context that started it may reset its peak
+    owner = None
+    if memory and _MEMORY.get() is None:
+        with _MEMORY_LOCK:
+            if tracemalloc.is_tracing():
+                raise RuntimeError('instrument(memory=True) needs tracemalloc to itself, it is already '
+                                   'tracing for another thread, task, or caller.')
+            tracemalloc.start()
+        owner = object()
+
+    memory_token = _MEMORY.set(owner) if owner is not None else None
+    token = _LISTENERS.set(_LISTENERS.get() + ((callback, memory),))
+    try:
+        yield callback
+    finally:
+        _LISTENERS.reset(token)
+        if owner is not None:
+            _MEMORY.reset(memory_token)
+            tracemalloc.stop()
+
+
+class Stages:
+    """
+    Records consecutive stages of an entry point. Each call to done closes the
+    stage that began when the previous one ended.
+
+    :param entry: Name of the entry point
+    :param df: Input data of the first stage
+    """
+
+    def __init__(self, entry: str, df=None):
+        self.entry = entry
+        self.listeners = _LISTENERS.get()
+        self.memory = any(memory for _, memory in self.listeners) \
+            and _MEMORY.get() is not None \
+            and hasattr(tracemalloc, 'reset_peak')
+        self.rows = None if df is None else len(df)
+        self._start()
+
+    def _start(self):
+        if self.memory:
+            self.baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+
+    def done(self, stage: str, df=None):
+        """
+        Ends a stage and sends its event to the listeners.
+
+        :param stage: Name of the stage
+        :param df: Output data of the stage, used for the row count
+        """
+
+        if not self.listeners:
+            return
+
+        seconds = time.perf_counter() - self.start
+        rows_out = None if df is None else len(df)
+        event = {'entry': self.entry,
+                 'stage': stage,
+                 'seconds': seconds,
+                 'rows_in': self.rows,
+                 'rows_out': rows_out,
+                 'peak_memory_delta': None}
+        if self.memory:
+            event['peak_memory_delta'] = tracemalloc.get_traced_memory()[1] - self.baseline
+
+        for callback, _ in self.listeners:
+            callback(dict(event))
+
+        self.rows = rows_out
+        self._start()
+
+
+class StageReport:
+    """
+    Collects stage events so they can be inspected or written out.
+
+    with instrument(report := StageReport()):
+        process_outcomes(...)
+    report.to_csv('stages.csv')
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, event: dict):
+        self.events.append(event)
+
+    def to_frame(self):
+        """
+        :return: Returns a pandas dataframe with one row per stage event
+        """
+
+        return pd.DataFrame(self.events, columns=EVENT_COLUMNS)
+
+    def summary(self):
+        """
+        :return: Returns a pandas dataframe with the total time and call count of each stage
+        """
+
+        return self.to_frame()\
+            .groupby(['entry', 'stage'], sort=False)\
+            .agg(calls=('seconds', 'size'),
+                 seconds=('seconds', 'sum'),
+                 rows_in=('rows_in', 'sum'),
+                 rows_out=('rows_out', 'sum'))\
+            .reset_index()
+
+    def to_json(self, path=None):
+        """
+        Writes the events as a JSON list.
+
+        :param path: File to write, the JSON text is returned when no path is given
+        """
+
+        text = json.dumps(self.events, indent=2)
+        if path is None:
+            return text
+        with open(path, 'w') as file:
+            file.write(text)
+
+    def to_csv(self, path=None):
+        """
+        Writes the events as CSV with one row per event.
+
+        :param path: File to write, the CSV text is returned when no path is given
+        """
+
+        return self.to_frame().to_csv(path, index=False)
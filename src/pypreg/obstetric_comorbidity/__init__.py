@@ -6,3 +6,4 @@ Batemen or Leonard methods for calculating this score.
 """
 
 from .obstetric_index import calc_index
+from .score import index_indicators, decode_flags
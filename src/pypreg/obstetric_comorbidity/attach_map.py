@@ -6,6 +6,10 @@ attach the comorbidity scores from one of the maps.
 """
 import pandas as pd
 
+# Age bins for each method, the upper edge of each bin is inclusive
+AGE_BINS = {'bateman': [0, 34, 39, 44, 110],
+            'leonard': [0, 34, 110]}
+
 
 def assign_weights(df: pd.DataFrame,
                    patient_col: str,
@@ -31,6 +35,8 @@ def assign_weights(df: pd.DataFrame,
 
     from .bateman_mapping import BATEMAN_MAP
     from .leonard_mapping import LEONARD_MAP
+    from .score import indicator_dtype
+    from ..dtypes import VERSION_DTYPE
 
     map_df = None
     versions = ['ICD9',
@@ -39,10 +45,14 @@ def assign_weights(df: pd.DataFrame,
     # Select the map based on the method chosen
     if method == 'bateman':
         map_df = BATEMAN_MAP
-        df = df[df[version_col] == versions[0]]
+        df = df[df[version_col] == versions[0]].copy()
     elif method == 'leonard':
         map_df = LEONARD_MAP
-        df = df[df[version_col] == versions[1]]
+        df = df[df[version_col] == versions[1]].copy()
+
+    # Version of the map in the dtype of the standardized data, the indicators in the order of the method
+    map_df = map_df.astype({'version': VERSION_DTYPE,
+                            'indicator': indicator_dtype(method)})
 
     # Remove . from the codes to make regex matching easier
     df[code_col] = df[code_col].str.replace('.', '', regex=False)
@@ -93,8 +103,8 @@ def age_category(df: pd.DataFrame,
     from .leonard_mapping import AGE_CATEGORY as leonard_categories
 
     # Set up the age bins for each method
-    bateman_bins = [0, 34, 39, 44, 110]
-    leonard_bins = [0, 34, 110]
+    bateman_bins = AGE_BINS['bateman']
+    leonard_bins = AGE_BINS['leonard']
 
     methods = {'leonard', 'bateman'}
     method = method.lower()
@@ -26,6 +26,18 @@ Codes and scores are attributable to:
 """
 
 import pandas as pd
+from ..dtypes import VERSION_DTYPE, standard_labels
+from ..instrument import Stages
+from .score import FLAG_LAYOUTS
+
+# Versions can accept different coding systems: 9/ICD9, 10/ICD10/ICD10-CM/ICD10-PCS
+VERSIONS = dict()
+VERSIONS['ICD9'] = ("9",
+                    "ICD9")
+VERSIONS['ICD10'] = ("10",
+                     "ICD10",
+                     "ICD10-CM",
+                     "ICD10-PCS")
 
 
 def calc_index(df: pd.DataFrame,
@@ -34,7 +46,10 @@ def calc_index(df: pd.DataFrame,
                code_col: str,
                version_col: str,
                method: str,
-               age_col: str = None):
+               age_col: str = None,
+               flags: str = None,
+               memory_limit: int = None,
+               trace_memory: bool = False):
     """
     Main function. Accepts a pandas dataframe of patient encounter data.
     Only ICD9/ICD10 diagnostic codes are accepted. Appends the Leonard or
@@ -42,7 +57,8 @@ def calc_index(df: pd.DataFrame,
     Leonard returns both a transfusion and non-transfusion score.
 
     :param df: Pandas dataframe containing patient and pregnancy identifiers
-        with ICD9/10 diagnostic codes
+        with ICD9/10 diagnostic codes. A pyarrow Table or the path of an Arrow IPC file is
+        also accepted, see arrow_frame
     :param patient_col: column that gives the patient identifier
     :param pregnancy_col: column that gives the pregnancy identifier
     :param code_col: column that gives the diagnostic codes
@@ -50,15 +66,48 @@ def calc_index(df: pd.DataFrame,
     Accepts 9, ICD9, 10, ICD10, and ICD10-CMS
     :param method: Choice of 'leonard' or 'bateman' for obstetric index scores
     :param age_col: Optional column that gives the age of the patient
+    :param flags: Optional layout of per-indicator flags to return with the score, 'bitmask'
+    for a single int64 column {method}_flags where bit i is the indicator at position i of
+    index_indicators(method), or 'sparse' for a sparse boolean column per indicator. Flags are
+    taken from the same matching pass as the score, see indicator_flags
+    :param memory_limit: Optional memory budget in bytes. Patients are processed in chunks
+    sized so the estimated working set stays under the budget, and the chunking is
+    reported in output.attrs['memory'], see run_within
+    :param trace_memory: Optional boolean to trace the allocations of a run with a memory_limit
+    and report their peak in output.attrs['memory'], tracing slows the entry point down
     :return: Pandas dataframe containing the total index score for each patient's pregnancy
     """
 
+    # Arrow tables and IPC files are read column by column, see arrow_frame
+    if not isinstance(df, pd.DataFrame):
+        from ..arrow import arrow_frame
+        df = arrow_frame('calc_index', df,
+                         patient_col=patient_col,
+                         pregnancy_col=pregnancy_col,
+                         code_col=code_col,
+                         version_col=version_col,
+                         age_col=age_col)
+
     # Error checking to ensure the reported columns are contained in the dataframe
     if not {patient_col, pregnancy_col, code_col, version_col}.issubset(df.columns):
         raise KeyError(f"Ensure that columns "
                        f"{[patient_col, pregnancy_col, code_col, version_col]} "
                        f"are present in the data.")
 
+    if memory_limit is not None:
+        from ..budget import run_within
+        return run_within('calc_index', df, memory_limit,
+                          patient_col=patient_col,
+                          pregnancy_col=pregnancy_col,
+                          code_col=code_col,
+                          version_col=version_col,
+                          method=method,
+                          age_col=age_col,
+                          flags=flags,
+                          trace_memory=trace_memory)
+
+    stages = Stages('calc_index', df)
+
     package_cols = {patient_col: 'group_id',
                     pregnancy_col: 'preg_num',
                     version_col: 'version',
@@ -72,26 +121,22 @@ def calc_index(df: pd.DataFrame,
     version_col = package_cols[version_col]
     code_col = package_cols[code_col]
 
+    # Work on a copy of the needed columns so the caller's dataframe is left untouched
+    if age_col:
+        df = df[[*restore_cols.values(), age_col]].copy()
+    else:
+        df = df[list(restore_cols.values())].copy()
     df.rename(columns=package_cols, inplace=True)
 
-    # Ignore SettingWithCopyWarning
-    pd.options.mode.chained_assignment = None
-
     methods = ['leonard', 'bateman']
     method = method.lower()
 
-    # Versions can accept different coding systems: 9/ICD9, 10/ICD10/ICD10-CM/ICD10-PCS
-    versions = dict()
-    versions['ICD9'] = ("9",
-                        "ICD9")
-    versions['ICD10'] = ("10",
-                         "ICD10",
-                         "ICD10-CM",
-                         "ICD10-PCS")
-
     if method not in methods:
         raise ValueError(f'Method must be one of {methods}')
 
+    if flags is not None and flags not in FLAG_LAYOUTS:
+        raise ValueError(f'Flags must be one of {FLAG_LAYOUTS}')
+
     if patient_col not in df.columns:
         raise ValueError(f'Patient ID column {patient_col} not in dataframe.')
 
@@ -101,51 +146,36 @@ def calc_index(df: pd.DataFrame,
     if code_col not in df.columns:
         raise ValueError(f'Code column {code_col} not in dataframe.')
 
-    # Create a copy to avoid warnings from pandas
-    if age_col:
-        df = df[[patient_col, pregnancy_col, version_col, code_col, age_col]].copy()
-    else:
-        df = df[[patient_col, pregnancy_col, version_col, code_col]].copy()
-
-    # Check the contents of the Version column and warn user if
-    # the contents don't match the expected. This doesn't constitute
-    # an error as the dataset could contain valid codes from other
-    # systems for other uses
-    df[version_col] = df[version_col].astype(str)
-    df[version_col] = df[version_col].str.upper()
-    df_versions = set(df[version_col].unique().flat)
-    this_versions = set([val for value in versions.values() for val in value])
-
     import warnings
 
-    if not df_versions.issubset(this_versions):
-        warnings.warn(f"Some code versions ({df_versions - this_versions})"
+    # Replace Version with a standard form, the labels are checked once per distinct value.
+    # Labels that don't match the expected don't constitute an error as the dataset could
+    # contain valid codes from other systems for other uses, warn the user and leave those rows out.
+    df[version_col], df_versions = standard_labels(df[version_col], VERSIONS, VERSION_DTYPE,
+                                                   lambda labels: labels.astype(str).str.upper())
+    this_versions = set([val for value in VERSIONS.values() for val in value])
+    if df_versions:
+        warnings.warn(f"Some code versions ({df_versions})"
                       f" do not match {this_versions}."
                       f" Ensure these are not in error.", stacklevel=2)
 
-    # Convert dictionary to dataframe
-    versions = pd.DataFrame.from_dict(versions, orient='index').stack().to_frame()
-    versions = pd.DataFrame(versions[0].values.tolist(),
-                            index=versions.index).reset_index().drop('level_1', axis=1)
-    versions.columns = ['version', 'version_match']
-
-    # Replace Version in the provided dataframe with a standard form
-    df = df.merge(versions,
-                  how='inner',
-                  left_on=version_col,
-                  right_on='version_match',
-                  suffixes=('_x', '')) \
-        .drop(columns=['version_x', 'version_match'])
+    df = df[df[version_col].notna()].reset_index(drop=True)
+    stages.done('standardize', df)
 
     # Process comorbidity scoring
     from .attach_map import assign_weights
-    from .score import get_score
-
-    output = assign_weights(df, patient_col, pregnancy_col, code_col, version_col, method, age_col)
-    output = get_score(output, method, patient_col=patient_col, pregnancy_col=pregnancy_col)
-
-    # Restore SettingWithCopyWarning
-    pd.options.mode.chained_assignment = 'warn'
+    from .score import get_score, indicator_flags
+
+    weights = assign_weights(df, patient_col, pregnancy_col, code_col, version_col, method, age_col)
+    stages.done('assign_weights', weights)
+    output = get_score(weights, method, patient_col=patient_col, pregnancy_col=pregnancy_col)
+
+    # The flags come from the indicators the score was computed from
+    if flags is not None:
+        output = output.merge(indicator_flags(weights, method, patient_col, pregnancy_col, flags),
+                              how='left',
+                              on=[patient_col, pregnancy_col])
+    stages.done('score', output)
 
     output.rename(columns=restore_cols, inplace=True)
 
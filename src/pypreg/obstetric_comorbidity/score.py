@@ -3,8 +3,12 @@ Copyright (C) 2023 Dave Walsh
 
 Process the weights by patient and pregnancy number.
 """
+import numpy as np
 import pandas as pd
 
+# Layouts of the per-indicator flags of calc_index
+FLAG_LAYOUTS = ['bitmask', 'sparse']
+
 
 def get_score(df: pd.DataFrame,
               method: str,
@@ -192,7 +196,7 @@ def leonard_score(df: pd.DataFrame,
                  pregnancy_col,
                  indicator_col,
                  score_col[0],
-                 score_col[1]]].fillna(0).drop_duplicates()
+                 score_col[1]]].fillna({score_col[0]: 0, score_col[1]: 0}).drop_duplicates()
     output = output.groupby([patient_col, pregnancy_col])[[score_col[0], score_col[1]]]\
         .apply(lambda x: x.astype(int).sum())\
         .reset_index()
@@ -203,3 +207,113 @@ def leonard_score(df: pd.DataFrame,
                   inplace=True)
 
     return output
+
+
+def index_indicators(method: str):
+    """
+    Lists the indicators of a method in the order of its map, including the age categories.
+    Position i is bit i of the bitmask flags.
+
+    :param method: Choice of 'leonard' or 'bateman' for obstetric index
+
+    :return: Returns a list of indicator names
+
+    :raises: ValueError
+        Given method does not exist
+    """
+
+    from .bateman_mapping import BATEMAN_MAP
+    from .leonard_mapping import LEONARD_MAP
+
+    maps = {'leonard': LEONARD_MAP, 'bateman': BATEMAN_MAP}
+    method = method.lower()
+    if method not in maps:
+        raise ValueError(f'Method must be one of {list(maps)}')
+
+    return maps[method]['indicator'].drop_duplicates().to_list()
+
+
+def indicator_dtype(method: str):
+    """
+    Categorical dtype of the indicators of a method, in the order of index_indicators.
+
+    :param method: Choice of 'leonard' or 'bateman' for obstetric index
+
+    :return: Returns a pandas CategoricalDtype
+    """
+
+    return pd.CategoricalDtype(index_indicators(method))
+
+
+def indicator_flags(df: pd.DataFrame,
+                    method: str,
+                    patient_col: str,
+                    pregnancy_col: str,
+                    layout: str = 'bitmask'):
+    """
+    Collects the indicators matched by assign_weights into flags per patient and pregnancy.
+    Flags record the presence of an indicator before the Bateman exclusions, so mild
+    preeclampsia is flagged next to eclampsia even though only one of them is scored.
+
+    :param df: pandas dataframe returned by assign_weights
+    :param method: Choice of 'leonard' or 'bateman' for obstetric index
+    :param patient_col: column that gives the patient identifier
+    :param pregnancy_col: column that gives the pregnancy identifier
+    :param layout: 'bitmask' for a single int64 column {method}_flags where bit i is the
+        indicator at position i of index_indicators, or 'sparse' for a sparse boolean column
+        per indicator
+
+    :return: Pandas dataframe with the patient and pregnancy identifiers and the flags of
+        every patient and pregnancy in df
+
+    :raises: ValueError
+        Given method or layout does not exist
+    """
+
+    if layout not in FLAG_LAYOUTS:
+        raise ValueError(f'Layout must be one of {FLAG_LAYOUTS}')
+
+    method = method.lower()
+    indicators = index_indicators(method)
+
+    # Position of each matched indicator, -1 where the code matched nothing
+    position = pd.Categorical(df['indicator'], categories=indicators).codes
+    keys = df[[patient_col, pregnancy_col]]
+    found = keys[position >= 0].assign(position=position[position >= 0]).drop_duplicates()
+
+    # Distinct bits sum to their bitwise or
+    found['bits'] = np.left_shift(np.int64(1), found['position'].to_numpy().astype(np.int64))
+    bits = found.groupby([patient_col, pregnancy_col])['bits'].sum()
+    output = keys.drop_duplicates()\
+        .join(bits, on=[patient_col, pregnancy_col])\
+        .fillna({'bits': 0})\
+        .astype({'bits': np.int64})\
+        .rename(columns={'bits': f'{method}_flags'})\
+        .reset_index(drop=True)
+
+    if layout == 'sparse':
+        output = decode_flags(output, method)
+
+    return output
+
+
+def decode_flags(df: pd.DataFrame,
+                 method: str):
+    """
+    Expands the bitmask flags of calc_index into a sparse boolean column per indicator.
+
+    :param df: pandas dataframe with the {method}_flags column
+    :param method: Choice of 'leonard' or 'bateman' for obstetric index
+
+    :return: Returns the dataframe with the bitmask column replaced by a column per
+        indicator in the order of index_indicators
+    """
+
+    method = method.lower()
+    flag_col = f'{method}_flags'
+    bits = df[flag_col].to_numpy().astype(np.int64)
+    flags = {indicator: pd.arrays.SparseArray((bits >> position) & 1 == 1, fill_value=False)
+             for position, indicator in enumerate(index_indicators(method))}
+
+    return pd.concat([df.drop(columns=flag_col),
+                      pd.DataFrame(flags, index=df.index)], axis=1)
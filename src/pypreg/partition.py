@@ -0,0 +1,387 @@
+"""
+Out-of-core execution of the pypreg entry points.
+
+Copyright (C) 2023 Dave Walsh
+
+Rows are hash-partitioned by patient (or encounter for smm) into temporary
+parquet files so that no step needs the whole extract in memory. Each
+partition holds every row of its patients, the entry point is run on one
+partition at a time, or on several at once in worker processes, and the
+results are put back in the order the in-memory call would have returned.
+
+The input may be a dataframe, an iterable of dataframes such as the chunks of
+pd.read_csv(..., chunksize=...), or the path of a parquet file, parquet
+directory, CSV file, or directory of CSV files. Parquet support comes from pyarrow.
+
+Available functions
+partition_data : Writes the rows to hash partitions on disk
+cached_call : Runs an entry point through an optional ResultCache
+run_partitioned : Runs an entry point partition by partition and combines the results
+"""
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# In-memory size of a partition relative to its parquet size while an entry point runs
+WORKING_SET_FACTOR = 10
+
+ROW_COL = '_pypreg_row'
+
+# File in the partition directory holding the columns and types of the input, without rows
+SCHEMA_FILE = 'schema.parquet'
+
+# Argument holding the partition column, and the output columns that order the
+# in-memory result. None orders by first appearance in the input.
+ENTRY_POINTS = {'process_outcomes': ('patient_col', ['config_id', 'schema_id', 'patient_col']),
+                'smm': ('enc_id', ['enc_id']),
+                'apo': ('patient_id', None),
+                'calc_index': ('patient_col', ['patient_col', 'pregnancy_col'])}
+
+# Arguments holding identifier columns, these are handed to shared memory workers as integer codes
+ID_ARGS = {'process_outcomes': ['patient_col', 'encounter_col'],
+           'smm': ['enc_id'],
+           'apo': ['patient_id', 'preg_id'],
+           'calc_index': ['patient_col', 'pregnancy_col']}
+
+# Arguments holding the other columns read by each entry point
+VALUE_ARGS = {'process_outcomes': ['admit_date_col', 'version_col', 'type_col', 'code_col'],
+              'smm': ['code_type', 'version', 'code'],
+              'apo': ['code_type', 'version', 'code'],
+              'calc_index': ['code_col', 'version_col', 'age_col']}
+
+# Arguments holding the code metadata, read as text from CSV files so codes such as 650 keep their form
+CODE_ARGS = {'process_outcomes': ['type_col', 'version_col', 'code_col'],
+             'smm': ['code_type', 'version', 'code'],
+             'apo': ['code_type', 'version', 'code'],
+             'calc_index': ['code_col', 'version_col']}
+
+# Arguments holding the key of the units a summary counts, None when the output rows are the units
+UNITS = {'process_outcomes': None,
+         'smm': ['enc_id'],
+         'apo': ['patient_id', 'preg_id'],
+         'calc_index': ['patient_col', 'pregnancy_col']}
+
+
+def _entry_point(analysis: str):
+    """
+    Utility to look up an entry point function by name.
+    """
+
+    from . import process_outcomes, smm, apo, calc_index
+
+    functions = {'process_outcomes': process_outcomes,
+                 'smm': smm,
+                 'apo': apo,
+                 'calc_index': calc_index}
+
+    if analysis not in functions:
+        raise ValueError(f'Analysis must be one of {list(functions)}')
+
+    return functions[analysis]
+
+
+def _chunks(data, chunksize: int = 1_000_000, dtype: dict = None):
+    """
+    Utility to read the input as a sequence of dataframes.
+    """
+
+    if isinstance(data, pd.DataFrame):
+        yield data
+    elif isinstance(data, (str, os.PathLike)):
+        path = Path(data)
+        csv_files = sorted(path.rglob('*.csv')) if path.is_dir() else [path]
+        if path.is_dir() and not csv_files:
+            csv_files = [path]
+        if all(file.suffix.lower() == '.csv' for file in csv_files):
+            for file in csv_files:
+                yield from pd.read_csv(file, chunksize=chunksize, dtype=dtype)
+        else:
+            import pyarrow.dataset as ds
+            for batch in ds.dataset(path, format='parquet').to_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+    else:
+        yield from data
+
+
+def _partition_keys(values: pd.Series):
+    """
+    Utility to give a value the same hash whatever type its chunk was read as. A CSV file
+    with a missing identifier reads the column as float, so whole floats are written as
+    integers before every value is hashed as a string.
+    """
+
+    if values.dtype.kind == 'f':
+        present = values.dropna()
+        if (present == np.floor(present)).all():
+            values = values.astype('Int64')
+
+    return values.astype('string')
+
+
+def partition_data(data,
+                   partition_col: str,
+                   directory: str,
+                   n_partitions: int = 16,
+                   dtype: dict = None):
+    """
+    Hash-partitions rows by a column into parquet files, one directory per partition.
+    The same value always goes to the same partition, even when chunks read the column
+    as different types, such as 5 and 5.0. A row number column keeps
+    the input order of the rows. The columns of the first chunk are recorded in
+    SCHEMA_FILE, so the layout of the input is known even when it has no rows.
+
+    :param data: Dataframe, iterable of dataframes, or path to a parquet or CSV dataset
+    :param partition_col: Column whose values decide the partition, usually the patient identifier
+    :param directory: Directory the partitions are written to
+    :param n_partitions: Number of partitions
+    :param dtype: Optional column types used when reading CSV files, such as str for code columns
+
+    :return: Returns a list with the directory of each partition that received rows
+
+    :raises: KeyError
+        If the partition column is not present in the data.
+    """
+
+    directory = Path(directory)
+    row = 0
+    for chunk_num, chunk in enumerate(_chunks(data, dtype=dtype)):
+        if partition_col not in chunk.columns:
+            raise KeyError(f'Ensure that column {partition_col} is present in the data.')
+
+        if chunk_num == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+            chunk.head(0).to_parquet(directory / SCHEMA_FILE, index=False)
+
+        chunk = chunk.assign(**{ROW_COL: np.arange(row, row + len(chunk))})
+        row += len(chunk)
+
+        keys = _partition_keys(chunk[partition_col])
+        buckets = pd.util.hash_pandas_object(keys, index=False).to_numpy() % n_partitions
+        for bucket, rows in chunk.groupby(buckets, sort=True):
+            part = directory / f'part-{bucket:05d}'
+            part.mkdir(parents=True, exist_ok=True)
+            rows.to_parquet(part / f'chunk-{chunk_num:06d}.parquet', index=False)
+
+    return sorted(str(part) for part in directory.glob('part-*'))
+
+
+def _empty_input(directory: str,
+                 analysis: str,
+                 kwargs: dict):
+    """
+    Utility to make an input without rows in the layout recorded by partition_data, or
+    of the columns the entry point reads when the input had no chunk at all.
+    """
+
+    schema = Path(directory) / SCHEMA_FILE
+    if schema.exists():
+        return pd.read_parquet(schema)
+
+    return pd.DataFrame(columns=list(dict.fromkeys(kwargs[arg] for arg in ID_ARGS[analysis] + VALUE_ARGS[analysis]
+                                                   if kwargs.get(arg) is not None)))
+
+
+def _read_partition(part: str):
+    """
+    Utility to read every chunk of a partition back in input order.
+    """
+
+    files = sorted(Path(part).glob('chunk-*.parquet'))
+    df = pd.concat([pd.read_parquet(file) for file in files], ignore_index=True)
+
+    return df.sort_values(ROW_COL, kind='stable').reset_index(drop=True)
+
+
+def cached_call(analysis: str,
+                df: pd.DataFrame,
+                kwargs: dict,
+                cache=None):
+    """
+    Runs an entry point, or serves its result from a ResultCache when the columns it reads
+    and its arguments are unchanged.
+
+    :param analysis: Name of the entry point
+    :param df: Pandas dataframe passed to the entry point
+    :param kwargs: Arguments of the entry point other than the dataframe
+    :param cache: Optional ResultCache
+
+    :return: Returns the output of the entry point
+    """
+
+    if cache is None:
+        return _entry_point(analysis)(df, **kwargs)
+
+    # process_outcomes returns every input column, the others only depend on the columns they read
+    if analysis == 'process_outcomes':
+        read_cols = list(df.columns)
+    else:
+        read_cols = [kwargs[arg] for arg in ID_ARGS[analysis] + VALUE_ARGS[analysis]
+                     if kwargs.get(arg) is not None]
+
+    key = cache.key(analysis, df[read_cols], kwargs)
+    output = cache.get(key)
+    if output is None:
+        output = _entry_point(analysis)(df, **kwargs)
+        cache.put(key, output)
+
+    return output
+
+
+def _run_partition(analysis: str,
+                   part: str,
+                   kwargs: dict,
+                   order_cols,
+                   summary: dict = None,
+                   cache=None):
+    """
+    Runs an entry point on a single partition. Module level so worker processes can call it.
+    """
+
+    df = _read_partition(part)
+    output = cached_call(analysis, df.drop(columns=ROW_COL), kwargs, cache)
+
+    # Only the counts leave the partition, every unit of the input is in the denominator
+    if summary is not None:
+        from .summary import summarize
+        if UNITS[analysis] is None:
+            return summarize(output, analysis, **summary)
+        on = [kwargs[arg] for arg in UNITS[analysis]]
+        return summarize(output, analysis, population=df, on=on, **summary)
+
+    if order_cols is None:
+        output = _first_rows(output, df, kwargs)
+
+    return output
+
+
+def _first_rows(output: pd.DataFrame,
+                df: pd.DataFrame,
+                kwargs: dict):
+    """
+    Utility to attach the first input row of each key to output ordered by first appearance.
+    """
+
+    key_cols = [kwargs['patient_id'], kwargs['preg_id']]
+    first_row = df.groupby(key_cols, sort=False)[ROW_COL].min().reset_index()
+
+    return output.merge(first_row, how='left', on=key_cols)
+
+
+def _combine(results: list,
+             order_cols):
+    """
+    Utility to concatenate independent results and restore the order of the in-memory call.
+    """
+
+    output = pd.concat(results, ignore_index=True)
+
+    # Results are independent between partitions, a stable sort restores the in-memory order
+    if order_cols is None:
+        output = output.sort_values(ROW_COL, kind='stable').drop(columns=ROW_COL)
+    else:
+        order_cols = [col for col in order_cols if col in output.columns]
+        output = output.sort_values(order_cols, kind='stable')
+
+    return output.reset_index(drop=True)
+
+
+def _workers(parts: list,
+             workers: int,
+             memory_limit: int):
+    """
+    Utility to limit the number of concurrent partitions to the memory budget.
+    """
+
+    if not memory_limit:
+        return workers
+
+    largest = max(sum(file.stat().st_size for file in Path(part).glob('*.parquet'))
+                  for part in parts)
+    fits = int(memory_limit // max(largest * WORKING_SET_FACTOR, 1))
+
+    return max(1, min(workers, fits))
+
+
+def run_partitioned(analysis: str,
+                    data,
+                    n_partitions: int = 16,
+                    workers: int = 1,
+                    memory_limit: int = None,
+                    temp_dir: str = None,
+                    summary: dict = None,
+                    cache=None,
+                    dtype: dict = None,
+                    **kwargs):
+    """
+    Runs process_outcomes, smm, apo, or calc_index on hash partitions of the data
+    stored on disk, and combines the results in the order of the in-memory call.
+    The index of the combined result is renumbered.
+
+    :param analysis: Name of the entry point: 'process_outcomes', 'smm', 'apo', or 'calc_index'
+    :param data: Dataframe, iterable of dataframes, or path to a parquet or CSV dataset
+    :param n_partitions: Number of partitions, more partitions use less memory each
+    :param workers: Number of partitions processed at once in worker processes
+    :param memory_limit: Optional memory budget in bytes shared by the workers,
+        fewer workers are used when partitions would not fit
+    :param temp_dir: Directory for the temporary partitions, defaults to the system temp directory
+    :param summary: Optional arguments of summarize, such as {'by': ['year']}. Each partition
+        then returns a CohortSummary instead of its rows, with every delivery or pregnancy
+        of the partition's input as the population, and the summaries are merged
+    :param cache: Optional ResultCache, partitions whose input and arguments are unchanged
+        since an earlier run are read from it instead of recomputed
+    :param dtype: Optional column types used when reading CSV files, defaults to str for
+        the code, code type, and version columns of the entry point
+    :param kwargs: Arguments of the entry point other than the dataframe
+
+    :return: Returns the combined pandas dataframe, or the merged CohortSummary
+
+    :raises: ValueError
+        If the analysis does not exist
+    """
+
+    _entry_point(analysis)
+    partition_arg, order_args = ENTRY_POINTS[analysis]
+    partition_col = kwargs[partition_arg]
+    order_cols = None if order_args is None \
+        else [kwargs.get(arg, arg) for arg in order_args]
+
+    directory = tempfile.mkdtemp(prefix='pypreg-', dir=temp_dir)
+    try:
+        if dtype is None:
+            dtype = {kwargs[arg]: str for arg in CODE_ARGS[analysis] if kwargs.get(arg) is not None}
+        parts = partition_data(data, partition_col, directory, n_partitions, dtype=dtype)
+        if not parts:
+            output = _entry_point(analysis)(_empty_input(directory, analysis, kwargs), **kwargs)
+            if summary is not None:
+                from .summary import summarize
+                return summarize(output, analysis, **summary)
+            return output
+
+        workers = _workers(parts, workers, memory_limit)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_run_partition,
+                                        [analysis] * len(parts),
+                                        parts,
+                                        [kwargs] * len(parts),
+                                        [order_cols] * len(parts),
+                                        [summary] * len(parts),
+                                        [cache] * len(parts)))
+        else:
+            results = [_run_partition(analysis, part, kwargs, order_cols, summary, cache) for part in parts]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if cache is not None:
+        cache.evict()
+
+    if summary is not None:
+        from .summary import CohortSummary
+        return CohortSummary.combine(results)
+
+    return _combine(results, order_cols)
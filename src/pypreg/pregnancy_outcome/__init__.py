@@ -4,10 +4,15 @@ pregnancies from diagnostic and PROCEDURE codes.
 
 OUTCOMES exports the full CODE list
 OUTCOME_LIST exports a list of the outcome classifications
+OUTCOME_DTYPE exports the categorical dtype of the outcome column, in OUTCOME_LIST order
 map_version_split exports 4 dataframes of outcome codes based on the CODE code_type
 process_outcomes is the process to pass data in order to identify and classify pregnancy OUTCOMES
+spacing_config completes a spacing configuration for the spacing_configs option of process_outcomes
+assign_pregnancy attaches the pregnancy number to each encounter within a pregnancy window
+window_join repeats each encounter for every pregnancy window, extended by a lookback, that covers it
 """
 
-from .outcome_map import OUTCOMES, OUTCOME_LIST
+from .outcome_map import OUTCOMES, OUTCOME_LIST, OUTCOME_DTYPE
 from .attach_map import map_version_split
-from .process_outcome import process_outcomes
+from .process_outcome import process_outcomes, spacing_config
+from .assign_pregnancy import assign_pregnancy, window_join
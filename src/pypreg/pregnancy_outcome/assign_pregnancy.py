@@ -0,0 +1,258 @@
+"""
+Assigns encounters to the pregnancies found by process_outcomes.
+
+Copyright (C) 2023 Dave Walsh
+
+A pregnancy covers the days from its start_window through its event_date,
+optionally extended by a postpartum span. Every code row of a patient that
+falls within one of the patient's pregnancies receives that pregnancy number,
+which is the pregnancy identifier expected by apo and calc_index.
+
+Patients and dates are packed into a single sorted integer key per pregnancy
+start, each encounter is then placed with a binary search over those keys.
+Nothing is joined per patient, so the work grows with the number of rows
+rather than with the number of encounter and pregnancy pairs.
+
+window_join extends the windows back by a lookback for chronic conditions.
+Extended windows of a patient can overlap, so the search is turned around:
+the rows are sorted by the same packed key and each window finds the range
+of rows it covers with two binary searches. A row is returned once for every
+window that covers it.
+
+Available functions
+assign_pregnancy : Attaches the pregnancy number of the containing pregnancy to each row
+window_join : Repeats each row for every pregnancy window, extended by a lookback, that covers it
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _day_number(dates: pd.Series):
+    """
+    Utility to convert dates, datetimes, or date strings to whole days since the epoch.
+
+    :return: Returns a numpy int64 array and a boolean array that is True for missing dates
+    """
+
+    dates = pd.to_datetime(dates)
+    missing = dates.isna().to_numpy()
+    days = dates.to_numpy().astype('datetime64[D]').astype(np.int64)
+
+    return days, missing
+
+
+def assign_pregnancy(df: pd.DataFrame,
+                     pregnancies: pd.DataFrame,
+                     patient_col: str,
+                     admit_date_col: str,
+                     postpartum: int = 0,
+                     preg_col: str = 'preg_num',
+                     start_col: str = 'start_window',
+                     end_col: str = 'event_date',
+                     how: str = 'inner'):
+    """
+    Attaches the pregnancy number of the containing pregnancy to each row of encounter data.
+
+    Pregnancy windows of a patient do not overlap, though a postpartum span may
+    reach into the next pregnancy's window. A row in both is given to the later pregnancy.
+
+    :param df: Pandas dataframe with encounter data, rows may be unique to each code
+    :param pregnancies: Pandas dataframe with one row per pregnancy, as returned by process_outcomes
+    :param patient_col: Column containing the unique patient identifier in both dataframes
+    :param admit_date_col: Column in df containing the admit date for the encounter
+    :param postpartum: Number of days after the event date that still belong to the pregnancy
+    :param preg_col: Column in pregnancies containing the pregnancy number, the column
+        is added to the output under the same name
+    :param start_col: Column in pregnancies containing the first day of the pregnancy
+    :param end_col: Column in pregnancies containing the outcome date of the pregnancy
+    :param how: 'inner' to only return rows within a pregnancy, 'left' to return every row
+        with a missing pregnancy number for rows outside a pregnancy
+
+    :return: Returns a copy of df with the pregnancy number column added
+
+    :raises: KeyError
+        If column names are supplied that are not present in the data.
+    :raises: ValueError
+        If how is not 'inner' or 'left', or the postpartum span is negative
+    """
+
+    if not {patient_col, admit_date_col}.issubset(df.columns):
+        raise KeyError(f"Ensure that columns {[patient_col, admit_date_col]}"
+                       f" are present in the data.")
+
+    if not {patient_col, preg_col, start_col, end_col}.issubset(pregnancies.columns):
+        raise KeyError(f"Ensure that columns {[patient_col, preg_col, start_col, end_col]}"
+                       f" are present in the pregnancies.")
+
+    hows = ['inner', 'left']
+    if how not in hows:
+        raise ValueError(f'how must be one of {hows}')
+
+    if postpartum < 0:
+        raise ValueError('postpartum must not be negative')
+
+    # Give both sides the same integer code for a patient
+    patient_codes, _ = pd.factorize(pd.concat([pregnancies[patient_col], df[patient_col]],
+                                              ignore_index=True))
+    preg_patient = patient_codes[:len(pregnancies)].astype(np.int64)
+    enc_patient = patient_codes[len(pregnancies):].astype(np.int64)
+
+    start, start_missing = _day_number(pregnancies[start_col])
+    end, end_missing = _day_number(pregnancies[end_col])
+    admit, admit_missing = _day_number(df[admit_date_col])
+
+    keep = ~(start_missing | end_missing)
+    preg_patient = preg_patient[keep]
+    start = start[keep]
+    end = end[keep] + postpartum
+    preg_num = pregnancies[preg_col].to_numpy()[keep]
+
+    # Pack patient and day into one key so a single sorted array covers every patient,
+    # days are counted from the earliest date so the keys never go negative
+    valid_admit = admit[~admit_missing]
+    first_day = min(start.min(initial=0), valid_admit.min(initial=0))
+    last_day = max(start.max(initial=0), valid_admit.max(initial=0))
+    span = np.int64(last_day - first_day + 1)
+
+    preg_key = preg_patient * span + (start - first_day)
+    order = np.argsort(preg_key, kind='stable')
+    preg_key = preg_key[order]
+    preg_patient = preg_patient[order]
+    end = end[order]
+    preg_num = preg_num[order]
+
+    # The latest pregnancy starting on or before the admit date is the only candidate
+    enc_key = enc_patient * span + (np.where(admit_missing, first_day, admit) - first_day)
+    candidate = np.searchsorted(preg_key, enc_key, side='right') - 1
+    found = candidate >= 0
+    candidate = np.where(found, candidate, 0)
+    found &= ~admit_missing
+    if len(preg_key):
+        found &= (preg_patient[candidate] == enc_patient) & (admit <= end[candidate])
+        assigned = preg_num[candidate]
+    else:
+        found[:] = False
+        assigned = np.zeros(len(df), dtype=preg_num.dtype)
+
+    if how == 'inner':
+        output = df.loc[found].copy()
+        output[preg_col] = assigned[found]
+    else:
+        output = df.copy()
+        output[preg_col] = pd.Series(assigned, index=df.index).where(found)
+        if pd.api.types.is_integer_dtype(pregnancies[preg_col]):
+            output[preg_col] = output[preg_col].astype('Int64')
+
+    return output
+
+
+def _window_pairs(df: pd.DataFrame,
+                  pregnancies: pd.DataFrame,
+                  patient_col: str,
+                  admit_date_col: str,
+                  lookback: int,
+                  postpartum: int,
+                  start_col: str,
+                  end_col: str):
+    """
+    Utility to pair each row with every pregnancy window that covers it by a sorted range join.
+
+    :return: Returns numpy arrays with the positions of the rows, the positions of their
+    pregnancies, and the admit day numbers of the rows, ordered by row then pregnancy
+    """
+
+    # Give both sides the same integer code for a patient
+    patient_codes, _ = pd.factorize(pd.concat([pregnancies[patient_col], df[patient_col]],
+                                              ignore_index=True))
+    preg_patient = patient_codes[:len(pregnancies)].astype(np.int64)
+    enc_patient = patient_codes[len(pregnancies):].astype(np.int64)
+
+    start, start_missing = _day_number(pregnancies[start_col])
+    end, end_missing = _day_number(pregnancies[end_col])
+    admit, admit_missing = _day_number(df[admit_date_col])
+
+    preg_position = np.flatnonzero(~(start_missing | end_missing))
+    enc_position = np.flatnonzero(~admit_missing)
+    first = start[preg_position] - lookback
+    last = end[preg_position] + postpartum
+    days = admit[enc_position]
+
+    # Pack patient and day into one key, days are counted from the earliest date so the
+    # keys never go negative
+    first_day = min(first.min(initial=0), days.min(initial=0))
+    last_day = max(last.max(initial=0), days.max(initial=0))
+    span = np.int64(last_day - first_day + 1)
+
+    enc_key = enc_patient[enc_position] * span + (days - first_day)
+    order = np.argsort(enc_key, kind='stable')
+    enc_key = enc_key[order]
+    enc_position = enc_position[order]
+
+    # Each window covers a contiguous run of the sorted rows
+    patient = preg_patient[preg_position] * span
+    low = np.searchsorted(enc_key, patient + (first - first_day), side='left')
+    high = np.searchsorted(enc_key, patient + (last - first_day), side='right')
+    counts = np.maximum(high - low, 0)
+
+    pregs = np.repeat(preg_position, counts)
+    runs = np.repeat(low - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+    rows = enc_position[runs]
+
+    order = np.lexsort((pregs, rows))
+
+    return rows[order], pregs[order], admit[rows[order]]
+
+
+def window_join(df: pd.DataFrame,
+                pregnancies: pd.DataFrame,
+                patient_col: str,
+                admit_date_col: str,
+                lookback: int = 0,
+                postpartum: int = 0,
+                preg_col: str = 'preg_num',
+                start_col: str = 'start_window',
+                end_col: str = 'event_date'):
+    """
+    Repeats each row of encounter data for every pregnancy whose window covers its admit date.
+    A window runs from lookback days before the start_window through postpartum days after the
+    event date, so with a lookback a row can belong to more than one pregnancy.
+
+    :param df: Pandas dataframe with encounter data, rows may be unique to each code
+    :param pregnancies: Pandas dataframe with one row per pregnancy, as returned by process_outcomes
+    :param patient_col: Column containing the unique patient identifier in both dataframes
+    :param admit_date_col: Column in df containing the admit date for the encounter
+    :param lookback: Number of days before the start of the pregnancy that belong to its window
+    :param postpartum: Number of days after the event date that belong to its window
+    :param preg_col: Column in pregnancies containing the pregnancy number, the column
+        is added to the output under the same name
+    :param start_col: Column in pregnancies containing the first day of the pregnancy
+    :param end_col: Column in pregnancies containing the outcome date of the pregnancy
+
+    :return: Returns a pandas dataframe with a row for each row of df and pregnancy window
+    that covers it, in the order of df, with the pregnancy number column added
+
+    :raises: KeyError
+        If column names are supplied that are not present in the data.
+    :raises: ValueError
+        If the lookback or the postpartum span is negative
+    """
+
+    if not {patient_col, admit_date_col}.issubset(df.columns):
+        raise KeyError(f"Ensure that columns {[patient_col, admit_date_col]}"
+                       f" are present in the data.")
+
+    if not {patient_col, preg_col, start_col, end_col}.issubset(pregnancies.columns):
+        raise KeyError(f"Ensure that columns {[patient_col, preg_col, start_col, end_col]}"
+                       f" are present in the pregnancies.")
+
+    if lookback < 0 or postpartum < 0:
+        raise ValueError('lookback and postpartum must not be negative')
+
+    rows, pregs, _ = _window_pairs(df, pregnancies, patient_col, admit_date_col,
+                                   lookback, postpartum, start_col, end_col)
+
+    output = df.iloc[rows].reset_index(drop=True)
+    output[preg_col] = pregnancies[preg_col].to_numpy()[pregs]
+
+    return output
@@ -10,15 +10,34 @@ about the CODE to indicate if the CODE is ICD9, ICD10, DRG, or CPT/HCPCS.
 """
 
 
+import re
+import numpy as np
 import pandas as pd
-from .outcome_map import OUTCOMES, ICD9, ICD10
+from .outcome_map import OUTCOMES, ICD9, ICD10, MOLL, CROSSWALK, EXPANDED, OUTCOME_DTYPE, SCHEMA_DTYPE
+from ..dtypes import CODE_TYPE_DTYPE, VERSION_DTYPE
+from ..provenance import PATTERN_ID, with_pattern_ids
+from ..screen import code_prefixes
+
+SCHEMAS = [MOLL, CROSSWALK, EXPANDED]
+SCHEMA_COL = 'schema_id'
+SCHEMA_BITS = 'schema_bits'
+
+# The outcome map in the dtypes of the standardized data, matched rows carry a categorical outcome
+_OUTCOMES = OUTCOMES.astype({'code_type': CODE_TYPE_DTYPE,
+                             'version': VERSION_DTYPE,
+                             'schema': SCHEMA_DTYPE,
+                             'outcome': OUTCOME_DTYPE})
+
+# Literal prefixes of the outcome patterns of every schema
+OUTCOME_PREFIXES = code_prefixes(OUTCOMES['code'])
 
 
 def attach_map(df: pd.DataFrame,
                code_col: str,
                type_col: str,
                version_col: str,
-               expanded: bool = False):
+               expanded: bool = False,
+               provenance: bool = False):
     """
     Method to attach outcome classification to diagnostic, PROCEDURE,
     and DRG codes. Moll/Crosswalk codes are used by default, user may
@@ -31,6 +50,8 @@ def attach_map(df: pd.DataFrame,
     :param version_col: Column containing VERSION info about the CODE (ICD9/ICD10/CPT/DRG)
     :param expanded: Defaults to False, user may elect to include the EXPANDED
     CODE selection or only use the Moll/Crosswalk codes
+    :param provenance: Defaults to False, adds the pattern_id of the pattern that
+    classified each row, see pattern_table
 
     :return: Returns the original dataframe with the outcome classification
     """
@@ -42,11 +63,19 @@ def attach_map(df: pd.DataFrame,
                 ICD10]
 
     # The regex does not consider dots, remove them
-    df['adjusted_code'] = df[code_col].str.replace('.', '', regex=False)
+    df = df.assign(adjusted_code=df[code_col].str.replace('.', '', regex=False))
 
     # Limit the OUTCOMES regex to their relevant sections to avoid erroneous matches
     dx9_outcomes, dx10_outcomes, px_outcomes, drg_outcomes = map_version_split(expanded)
 
+    # Carry the pattern id through the merge when the user asks for provenance
+    map_cols = ['code', 'outcome']
+    if provenance:
+        map_cols.append(PATTERN_ID)
+        dx9_outcomes, dx10_outcomes, px_outcomes, drg_outcomes = \
+            [with_pattern_ids(outcomes, 'outcome', 'code_type', 'version', 'code', 'outcome', 'schema')
+             for outcomes in [dx9_outcomes, dx10_outcomes, px_outcomes, drg_outcomes]]
+
     # Limit the data to be matched by code_type
     df_dx = df[df[type_col] == 'DX'].copy().drop_duplicates()
     df_px = df[df[type_col] == 'PX'].copy().drop_duplicates()
@@ -71,22 +100,22 @@ def attach_map(df: pd.DataFrame,
                                                       regex=True)
 
     # Attach the OUTCOMES by matching on the regex string
-    matched_dx9 = df_dx9.merge(dx9_outcomes[['code', 'outcome']],
+    matched_dx9 = df_dx9.merge(dx9_outcomes[map_cols],
                                how='inner',
                                left_on='regex',
                                right_on='code',
                                suffixes=('', '_x'))
-    matched_dx10 = df_dx10.merge(dx10_outcomes[['code', 'outcome']],
+    matched_dx10 = df_dx10.merge(dx10_outcomes[map_cols],
                                  how='inner',
                                  left_on='regex',
                                  right_on='code',
                                  suffixes=('', '_x'))
-    matched_px = df_px.merge(px_outcomes[['code', 'outcome']],
+    matched_px = df_px.merge(px_outcomes[map_cols],
                              how='inner',
                              left_on='regex',
                              right_on='code',
                              suffixes=('', '_x'))
-    matched_drg = df_drg.merge(drg_outcomes[['code', 'outcome']],
+    matched_drg = df_drg.merge(drg_outcomes[map_cols],
                                how='inner',
                                left_on='regex',
                                right_on='code',
@@ -103,6 +132,115 @@ def attach_map(df: pd.DataFrame,
     return output
 
 
+def attach_map_schemas(df: pd.DataFrame,
+                       code_col: str,
+                       type_col: str,
+                       version_col: str,
+                       selections: list,
+                       provenance: bool = False):
+    """
+    Method to attach outcome classification for several schema selections at once.
+    Each selection is matched as attach_map would match it, but each pattern of the
+    selections is evaluated once against the distinct codes of the data, the outcome of
+    every selection is picked from those matches, and the rows are joined to the matches
+    a single time.
+
+    :param df: pandas dataframe containing diagnostic codes and the CODE versions
+    :param code_col: Column containing diagnostic codes
+    :param type_col: Column containing information about the category of CODE (DX/PX/DRG)
+    :param version_col: Column containing VERSION info about the CODE (ICD9/ICD10/CPT/DRG)
+    :param selections: List of collections of schemas (MOLL, CROSSWALK, EXPANDED)
+    :param provenance: Adds the pattern_id of the pattern that classified each row,
+    a row is repeated when selections match it with different patterns
+
+    :return: Returns the dataframe with the outcome classification and an integer
+    SCHEMA_BITS column, bit i is set when the i-th selection gives the row that outcome
+
+    :raises: ValueError
+        If a selection contains an unknown schema
+    """
+
+    selections = [[selection] if isinstance(selection, str) else list(selection)
+                  for selection in selections]
+    for selection in selections:
+        if not set(selection).issubset(SCHEMAS):
+            raise ValueError(f'Schemas must be among {SCHEMAS}, got {selection}')
+
+    # The regex does not consider dots, remove them
+    df = df.assign(adjusted_code=df[code_col].str.replace('.', '', regex=False))
+
+    # Carry the pattern id through the matching when the user asks for provenance
+    outcomes = _OUTCOMES
+    pair_cols = ['adjusted_code', 'outcome']
+    if provenance:
+        outcomes = with_pattern_ids(_OUTCOMES, 'outcome', 'code_type', 'version', 'code', 'outcome', 'schema')
+        pair_cols.append(PATTERN_ID)
+
+    buckets = [(df[(df[type_col] == 'DX') & (df[version_col] == ICD9)],
+                outcomes[(outcomes.code_type == 'DX') & (outcomes.version == ICD9)]),
+               (df[(df[type_col] == 'DX') & (df[version_col] == ICD10)],
+                outcomes[(outcomes.code_type == 'DX') & (outcomes.version == ICD10)]),
+               (df[df[type_col] == 'PX'],
+                outcomes[outcomes.code_type == 'PX']),
+               (df[df[type_col] == 'DRG'],
+                outcomes[outcomes.code_type == 'DRG'])]
+
+    matched = []
+    for df_bucket, bucket_map in buckets:
+        df_bucket = df_bucket.drop_duplicates()
+        codes = df_bucket['adjusted_code'].unique()
+        patterns = pd.unique(bucket_map['code'])
+
+        # Match the distinct codes against each pattern of the union of the selections once. The
+        # patterns are anchored, so a code is rewritten by the first pattern that matches it and
+        # keeps the outcome of the map rows equal to the rewritten code
+        hits = []
+        for position, pattern in enumerate(patterns):
+            compiled = re.compile(pattern)
+            hit = [idx for idx, code in enumerate(codes) if isinstance(code, str) and compiled.search(code)]
+            hits.append(pd.DataFrame({'code_position': np.array(hit, dtype=np.int64),
+                                      'pattern_position': position,
+                                      'regex': np.array([compiled.sub(pattern, codes[idx]) for idx in hit], dtype=object)}))
+        hits = pd.concat(hits, ignore_index=True)
+        hits['adjusted_code'] = codes[hits['code_position'].to_numpy()]
+
+        # The patterns of a selection keep the order of their first row in the selection
+        first_row = pd.Series(np.arange(len(bucket_map)))\
+            .groupby([bucket_map['code'].to_numpy(), bucket_map['schema'].astype(object).to_numpy()])\
+            .min()
+
+        pairs = []
+        for bit, selection in enumerate(selections):
+            rank = first_row[first_row.index.get_level_values(1).isin(selection)]\
+                .groupby(level=0).min()\
+                .reindex(patterns)\
+                .to_numpy()
+            found = hits.assign(rank=rank[hits['pattern_position']])\
+                .dropna(subset='rank')\
+                .sort_values(['code_position', 'rank'])\
+                .drop_duplicates('code_position')\
+                .merge(bucket_map.loc[bucket_map.schema.isin(selection), pair_cols[1:] + ['code']],
+                       how='inner',
+                       left_on='regex',
+                       right_on='code')
+            pairs.append(found[pair_cols].assign(**{SCHEMA_BITS: 1 << bit}))
+
+        # Each selection sets its own bit, the distinct bits of a pair add up to their union
+        pairs = pd.concat(pairs)\
+            .drop_duplicates()\
+            .groupby(pair_cols, sort=False, observed=True)[SCHEMA_BITS]\
+            .sum()\
+            .reset_index()
+
+        matched.append(df_bucket.merge(pairs, how='inner', on='adjusted_code'))
+
+    # Combine the output into one dataframe
+    output = pd.concat(matched)
+    output.drop(columns=['adjusted_code'], inplace=True)
+
+    return output
+
+
 def map_version_split(expanded: bool = False):
     """
     Method to split the full list of pregnancy outcome codes into 4 subtypes:
@@ -119,11 +257,11 @@ def map_version_split(expanded: bool = False):
     """
 
     # Limit the map to Moll/Crosswalk by default
-    map_df = OUTCOMES[OUTCOMES.schema != 'EXPANDED']
+    map_df = _OUTCOMES[_OUTCOMES.schema != EXPANDED]
 
     # Reassign the full OUTCOMES list if user expands
     if expanded:
-        map_df = OUTCOMES
+        map_df = _OUTCOMES
 
     # Limit the OUTCOMES regex to their relevant sections to avoid erroneous matches
     dx9_outcomes = map_df[(map_df.code_type == 'DX') & (map_df.version == ICD9)]
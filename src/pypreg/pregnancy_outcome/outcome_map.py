@@ -41,6 +41,10 @@ OUTCOME_LIST = ['LIVE_BIRTH',
                 'SPONTANEOUS_ABORTION']
 OUTCOME_COL = 'outcome'
 
+# Categorical dtypes of the outcome classification, in the order of the hierarchy, and of the schemas
+OUTCOME_DTYPE = pd.CategoricalDtype(OUTCOME_LIST)
+SCHEMA_DTYPE = pd.CategoricalDtype([MOLL, CROSSWALK, EXPANDED])
+
 # ======================
 # Ectopic
 # ======================
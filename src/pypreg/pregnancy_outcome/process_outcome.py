@@ -9,8 +9,12 @@ subsequent_outcome : Returns a pandas dataframe with the date of the next
     possible outcome for each outcome type
 process_spacing : Returns a pandas dataframe with additional timing information
 spacing : Utility to set up process_spacing
+collapse_encounters : Reduces the classified rows to one per encounter and outcome
 validate_outcomes : Selects the outcome classification based on a hierarchy
 next_event_valid : Compares two events to determine if one is valid
+gap_matrix : Utility function that lays out the days to the next feasible event as a matrix
+next_event_valid_array : Compares batches of events to determine if they are valid
+validate_outcomes_array : Selects the outcome classification of every patient at once
 number_pregnancy : Calculates the gravida number for each pregnancy
 set_preg_window : Utility function to convert spacing data to dates
 calc_preg_window : Utility function to calculate a date from a date and offset
@@ -22,16 +26,30 @@ process_outcomes : Main function to process pregnancy data.
 
 """
 
+import numpy as np
 import pandas as pd
-from .attach_map import attach_map
-from .outcome_map import OUTCOME_LIST
+from .attach_map import attach_map, attach_map_schemas, SCHEMA_COL, SCHEMA_BITS, OUTCOME_PREFIXES
+from ..dtypes import CODE_TYPE_DTYPE, VERSION_DTYPE, standard_labels
+from ..instrument import Stages
+from ..provenance import PATTERN_ID
+from ..screen import screen_codes
+from .outcome_map import OUTCOME_LIST, OUTCOME_DTYPE
 
 
 BAD_DATE = pd.to_datetime('1900-01-01')
+BAD_DAY = (BAD_DATE - pd.Timestamp(0)).days
 MAX_TERM = 'max_term'
 MIN_TERM = 'min_term'
 SUBSEQUENT = 'subsequent_preg'
+NEXT = 'next_outcome'
 EVENT_DATE = 'event_date'
+CONFIG_COL = 'config_id'
+
+# Days from the event date to the pregnancy start window (MAX_TERM, MIN_TERM)
+# and to the earliest start of a subsequent pregnancy (SUBSEQUENT), in OUTCOME_LIST order
+SPACING = {MAX_TERM: [301, 301, 301, 112, 84, 168, 133],
+           MIN_TERM: [154, 140, 140, 42, 42, 42, 28],
+           SUBSEQUENT: [28, 28, 28, 14, 14, 14, 14]}
 
 # Dictionary that defines the distance to the next feasible event date.
 #     Key: Current event outcome class
@@ -51,10 +69,83 @@ NEXT_OUTCOME = {OUTCOME_LIST[0]: pd.to_timedelta([182, 168, 168, 70, 70, 70, 56]
                 OUTCOME_LIST[5]: pd.to_timedelta([168, 154, 154, 56, 56, 56, 42], unit='d'),
                 OUTCOME_LIST[6]: pd.to_timedelta([168, 154, 154, 56, 56, 56, 42], unit='d')}
 
+# Types can accept a CODE label as dx/DIAGNOSIS/diagnostic,
+# px/PROCEDURE, DRG/diagnostic related group
+TYPES = dict()
+TYPES['DX'] = ('dx',
+               'DIAGNOSIS',
+               'diagnostic')
+TYPES['PX'] = ('px',
+               'PROCEDURE')
+TYPES['DRG'] = ('DRG',
+                'diagnostic related group')
+
+# Versions can accept different coding systems: 9/ICD9, 10/ICD10/ICD10-CM/ICD10-PCS
+VERSIONS = dict()
+VERSIONS['ICD9'] = ('9',
+                    'ICD9')
+VERSIONS['ICD10'] = ('10',
+                     'ICD10',
+                     'ICD10-CM',
+                     'ICD10-PCS')
+VERSIONS['CPT'] = ('CPT',
+                   'CPT4',
+                   'HCPCS')
+VERSIONS['DRG'] = ('DRG',
+                   'MS-DRG')
+
+
+def spacing_config(config: dict = None):
+    """
+    Utility function that completes a spacing configuration with the default Moll spacing.
+
+    A configuration is a dictionary that may contain:
+        MAX_TERM, MIN_TERM, SUBSEQUENT: a list of days in OUTCOME_LIST order, or a
+            dictionary of days for only the outcomes that change
+        NEXT: a dictionary keyed by outcome with a list of days to the next outcome of
+            each class in OUTCOME_LIST order, in the same layout as NEXT_OUTCOME
+
+    :param config: Dictionary of spacing that differs from the default, None for the default
+
+    :return: Returns a complete configuration with every key present
+
+    :raises: ValueError
+        If the configuration contains an unknown key, outcome, or list of the wrong length
+    """
+
+    config = dict() if config is None else config
+
+    unknown = set(config) - {MAX_TERM, MIN_TERM, SUBSEQUENT, NEXT}
+    if unknown:
+        raise ValueError(f'Unknown spacing configuration keys {unknown}. '
+                         f'Use {[MAX_TERM, MIN_TERM, SUBSEQUENT, NEXT]}')
+
+    def complete(values, default, name):
+        if isinstance(values, dict):
+            if not set(values).issubset(OUTCOME_LIST):
+                raise ValueError(f'Unknown outcomes in {name}: {set(values) - set(OUTCOME_LIST)}')
+            return [values.get(outcome, days) for outcome, days in zip(OUTCOME_LIST, default)]
+        if len(values) != len(OUTCOME_LIST):
+            raise ValueError(f'{name} must have {len(OUTCOME_LIST)} values, one per outcome in OUTCOME_LIST')
+        return list(values)
+
+    output = {key: complete(config.get(key, default), default, key)
+              for key, default in SPACING.items()}
+
+    next_outcome = config.get(NEXT, dict())
+    if not set(next_outcome).issubset(OUTCOME_LIST):
+        raise ValueError(f'Unknown outcomes in {NEXT}: {set(next_outcome) - set(OUTCOME_LIST)}')
+    output[NEXT] = {outcome: pd.to_timedelta(complete(next_outcome[outcome], gaps, NEXT), unit='d')
+                    if outcome in next_outcome else gaps
+                    for outcome, gaps in NEXT_OUTCOME.items()}
+
+    return output
+
 
 def subsequent_outcome(df: pd.DataFrame,
                        outcome: str,
-                       admit_col: str):
+                       admit_col: str,
+                       next_outcome: dict = None):
     """
     Utility function that calculates the event date of the next outcome class.
 
@@ -63,18 +154,23 @@ def subsequent_outcome(df: pd.DataFrame,
     :param df: Pandas dataframe that contains pregnancy OUTCOMES of a single code_type
     :param outcome: String that defines the outcome classification - use the OUTCOME_LIST
     :param admit_col: Column in the dataframe that contains the date of the outcome
+    :param next_outcome: Optional dictionary in the layout of NEXT_OUTCOME to use in its place
 
     :return: Returns the dataframe with 7 new columns that define the feasible
     date a subsequent outcome of each class can occur
     """
 
-    df['next_lb'] = df[admit_col] + NEXT_OUTCOME[outcome][0]
-    df['next_sb'] = df[admit_col] + NEXT_OUTCOME[outcome][1]
-    df['next_uk'] = df[admit_col] + NEXT_OUTCOME[outcome][2]
-    df['next_tr'] = df[admit_col] + NEXT_OUTCOME[outcome][3]
-    df['next_ec'] = df[admit_col] + NEXT_OUTCOME[outcome][4]
-    df['next_ab'] = df[admit_col] + NEXT_OUTCOME[outcome][5]
-    df['next_sa'] = df[admit_col] + NEXT_OUTCOME[outcome][6]
+    gaps = (NEXT_OUTCOME if next_outcome is None else next_outcome)[outcome]
+
+    # The dataframe is usually a slice of the classified encounters, set the columns on a copy
+    df = df.copy()
+    df['next_lb'] = df[admit_col] + gaps[0]
+    df['next_sb'] = df[admit_col] + gaps[1]
+    df['next_uk'] = df[admit_col] + gaps[2]
+    df['next_tr'] = df[admit_col] + gaps[3]
+    df['next_ec'] = df[admit_col] + gaps[4]
+    df['next_ab'] = df[admit_col] + gaps[5]
+    df['next_sa'] = df[admit_col] + gaps[6]
 
     return df
 
@@ -82,7 +178,8 @@ def subsequent_outcome(df: pd.DataFrame,
 def process_spacing(df: pd.DataFrame,
                     admit_col: str,
                     outcome_col: str,
-                    patient_col: str):
+                    patient_col: str,
+                    next_outcome: dict = None):
     """
     Calculate the dates for the max term, min term, subsequent starts, and subsequent outcomes
 
@@ -90,6 +187,7 @@ def process_spacing(df: pd.DataFrame,
     :param admit_col: Column containing the admit date
     :param outcome_col: Column containing the outcome classification
     :param patient_col: Column containing the patient identifier
+    :param next_outcome: Optional dictionary in the layout of NEXT_OUTCOME to use in its place
 
     :return: Returns the original pandas dataframe with the pregnancy
     start window (Max term and Min term) and the subsequent event dates added in.
@@ -111,13 +209,13 @@ def process_spacing(df: pd.DataFrame,
     df_sa = df[df[outcome_col] == OUTCOME_LIST[6]]
 
     # Calculate the subsequent outcome date using the outcome separated dataframes
-    df_lb = subsequent_outcome(df_lb, OUTCOME_LIST[0], admit_col)
-    df_sb = subsequent_outcome(df_sb, OUTCOME_LIST[1], admit_col)
-    df_uk = subsequent_outcome(df_uk, OUTCOME_LIST[2], admit_col)
-    df_tr = subsequent_outcome(df_tr, OUTCOME_LIST[3], admit_col)
-    df_ec = subsequent_outcome(df_ec, OUTCOME_LIST[4], admit_col)
-    df_ab = subsequent_outcome(df_ab, OUTCOME_LIST[5], admit_col)
-    df_sa = subsequent_outcome(df_sa, OUTCOME_LIST[6], admit_col)
+    df_lb = subsequent_outcome(df_lb, OUTCOME_LIST[0], admit_col, next_outcome)
+    df_sb = subsequent_outcome(df_sb, OUTCOME_LIST[1], admit_col, next_outcome)
+    df_uk = subsequent_outcome(df_uk, OUTCOME_LIST[2], admit_col, next_outcome)
+    df_tr = subsequent_outcome(df_tr, OUTCOME_LIST[3], admit_col, next_outcome)
+    df_ec = subsequent_outcome(df_ec, OUTCOME_LIST[4], admit_col, next_outcome)
+    df_ab = subsequent_outcome(df_ab, OUTCOME_LIST[5], admit_col, next_outcome)
+    df_sa = subsequent_outcome(df_sa, OUTCOME_LIST[6], admit_col, next_outcome)
 
     # Recombine the data and sort
     output = pd.concat([df_lb, df_sb, df_uk, df_tr, df_ec, df_ab, df_sa])
@@ -130,7 +228,8 @@ def process_spacing(df: pd.DataFrame,
 def spacing(df: pd.DataFrame,
             patient_col: str,
             outcome_col: str,
-            admit_col: str):
+            admit_col: str,
+            config: dict = None):
     """
     Utility function to setup and start adding spacing data to classified encounters
 
@@ -138,6 +237,7 @@ def spacing(df: pd.DataFrame,
     :param patient_col: Column containing the patient identifier
     :param outcome_col: Column containing the outcome classification
     :param admit_col: Column containing the encounter admit date
+    :param config: Optional spacing configuration, see spacing_config
 
     :return: Returns the original dataframe with the spacing information
     added defining the pregnancy start window for the current outcome as
@@ -146,11 +246,13 @@ def spacing(df: pd.DataFrame,
     pregnancy outcomes as possible longitudinally.
     """
 
+    config = spacing_config(config)
+
     # Set up a pandas data frame with day spacing from the event date
-    data = {outcome_col: OUTCOME_LIST,
-            MAX_TERM: [301, 301, 301, 112, 84, 168, 133],
-            MIN_TERM: [154, 140, 140, 42, 42, 42, 28],
-            SUBSEQUENT: [28, 28, 28, 14, 14, 14, 14]}
+    data = {outcome_col: pd.Categorical(OUTCOME_LIST, dtype=OUTCOME_DTYPE),
+            MAX_TERM: config[MAX_TERM],
+            MIN_TERM: config[MIN_TERM],
+            SUBSEQUENT: config[SUBSEQUENT]}
     spacing_df = pd.DataFrame(data)
 
     # Join the spacing data to the classified encounters
@@ -163,11 +265,40 @@ def spacing(df: pd.DataFrame,
     output = process_spacing(joined_df,
                              admit_col=admit_col,
                              outcome_col=outcome_col,
-                             patient_col=patient_col)
+                             patient_col=patient_col,
+                             next_outcome=config[NEXT])
 
     return output
 
 
+def collapse_encounters(df: pd.DataFrame,
+                        unit_cols: list,
+                        outcome_col: str,
+                        code_cols: list):
+    """
+    Reduces the classified rows to one row per encounter and outcome. An encounter with
+    many codes of the same outcome is matched once per code, the copies only differ in
+    their code metadata and can never change the validation, so the code metadata is
+    dropped and the first row of each copy is kept. Only the unit columns and the outcome
+    are compared, the other columns of the first row are carried along.
+
+    Rows of the same encounter with different outcomes are all kept, a lower ranked outcome
+    can be valid where the higher ranked one falls too close to another pregnancy.
+
+    :param df: Pandas dataframe of classified rows, as returned by attach_map
+    :param unit_cols: Columns identifying an encounter: the batch and patient keys,
+    the encounter, and the admit date
+    :param outcome_col: Column that contains the outcome classification
+    :param code_cols: Code metadata columns to drop, the code, code type, and version
+
+    :return: Returns the classified rows without the code metadata, in their original order
+    """
+
+    copies = df.duplicated(subset=[*unit_cols, outcome_col], keep='first').to_numpy()
+
+    return df.loc[~copies].drop(columns=code_cols)
+
+
 def validate_outcomes(df: pd.DataFrame,
                       outcome_col: str,
                       admit_col: str,
@@ -294,6 +425,186 @@ def next_event_valid(first_event: pd.DataFrame,
         return False, BAD_DATE
 
 
+def gap_matrix(next_outcome: dict = None):
+    """
+    Utility function that lays out the days to the next feasible event as a matrix.
+
+    :param next_outcome: Optional dictionary in the layout of NEXT_OUTCOME to use in its place
+
+    :return: Returns a 7x7 numpy int64 array, the row is the outcome of the first event and the
+    column the outcome of the second, both in OUTCOME_LIST order
+    """
+
+    next_outcome = NEXT_OUTCOME if next_outcome is None else next_outcome
+
+    return np.array([[gap.days for gap in next_outcome[outcome]] for outcome in OUTCOME_LIST],
+                    dtype=np.int64)
+
+
+def next_event_valid_array(first_rank: np.ndarray,
+                           first_day: np.ndarray,
+                           second_rank: np.ndarray,
+                           second_day: np.ndarray,
+                           base: int,
+                           gaps: np.ndarray = None):
+    """
+    Utility function to determine if events are valid compared to the others, the array
+    counterpart of next_event_valid for a batch of pairs of events at once.
+
+    :param first_rank: Numpy integer array with the position of the outcome of each first event in OUTCOME_LIST
+    :param first_day: Numpy integer array with the admit day number of each first event
+    :param second_rank: Numpy integer array with the position of the outcome of each second event in OUTCOME_LIST
+    :param second_day: Numpy integer array with the admit day number of each second event
+    :param base: Switch to determine which event is the primary event to compare against
+    :param gaps: Optional matrix of days to the next event from gap_matrix, NEXT_OUTCOME by default
+
+    :return: Returns a boolean array of validity and an array of the day numbers of the
+    events (the day number of the global bad date is returned if not valid)
+    """
+
+    valid_base = [0, 1]
+    if base not in valid_base:
+        raise ValueError(f'next_event_valid_array: base must be one of {valid_base}. {valid_base[0]}'
+                         f' to select the first event as the base, {valid_base[1]} for the other.')
+
+    gaps = gap_matrix() if gaps is None else gaps
+
+    outcome_valid = np.asarray(second_day) >= np.asarray(first_day) + gaps[first_rank, second_rank]
+    event_day = np.where(outcome_valid,
+                         first_day if base == valid_base[0] else second_day,
+                         BAD_DAY)
+
+    return outcome_valid, event_day
+
+
+def validate_outcomes_array(df: pd.DataFrame,
+                            keys: list,
+                            outcome_col: str,
+                            admit_col: str,
+                            encounter_col: str,
+                            gaps: np.ndarray = None):
+    """
+    Selects the outcome classification of every group of keys at once, with the same hierarchy
+    and result as validate_outcomes applied to each group.
+
+    The groups advance together: each round takes the next classified encounter of the
+    current outcome from every group, finds its valid neighbours in the admit date timeline
+    of its group, and compares them with next_event_valid_array. The admit dates are
+    compared as day numbers, so they must be whole days.
+
+    :param df: Pandas dataframe with the spacing data of every group, outcome_valid, and event_date
+    :param keys: Columns that identify the groups, rows with a missing key are left out
+    :param outcome_col: Column that contains the outcome classification
+    :param admit_col: Column that contains the admit date for the encounter
+    :param encounter_col: Column that contains the encounter identifier
+    :param gaps: Optional matrix of days to the next event from gap_matrix, NEXT_OUTCOME by default
+
+    :return: Returns the rows ordered by group as groupby would, the keys in the first columns,
+    with the outcome_valid and event_date columns completed
+    """
+
+    # Rows of a group are contiguous in the order of the sorted keys and keep their order within
+    # Rows with a missing key have no group number
+    group = df.groupby(keys, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    rows = np.flatnonzero(group >= 0)
+    rows = rows[np.argsort(group[rows], kind='stable')]
+    df = df.iloc[rows].reset_index(drop=True)
+    df = df[[*keys, *df.columns.drop(keys)]]
+    group = group[rows]
+    size = len(df)
+
+    rank = pd.Categorical(df[outcome_col], categories=OUTCOME_LIST).codes.astype(np.int64)
+    day, missing = _admit_days(df[admit_col])
+    encounter, _ = pd.factorize(df[encounter_col], sort=True)
+
+    # Timeline of each group in the order validate_outcomes sorts it, missing values last
+    timeline = np.lexsort((np.where(encounter < 0, size, encounter),
+                           np.where(missing, day.max(initial=0) + 1, day),
+                           group))
+    position = np.empty(size, dtype=np.int64)
+    position[timeline] = np.arange(size)
+
+    # An encounter is only valid once within its group
+    pair, _ = pd.factorize(group * (encounter.max(initial=0) + 2) + encounter)
+    pair = np.where(encounter < 0, -1, pair)
+
+    valid = np.zeros(size, dtype=bool)
+    ordered_valid = np.zeros(size, dtype=bool)
+    group_valid = np.zeros(group.max(initial=-1) + 1, dtype=bool)
+    pair_valid = np.zeros(pair.max(initial=-1) + 2, dtype=bool)
+    rounds = pd.DataFrame({'group': group, 'rank': rank}).groupby(['group', 'rank']).cumcount().to_numpy()
+    steps = np.arange(size)
+
+    # Outcome_list is ordered in the hierarchy, one encounter per group and round
+    for outcome in range(len(OUTCOME_LIST)):
+        level = np.flatnonzero(rank == outcome)
+        for step in range(rounds[level].max(initial=-1) + 1):
+            current = level[rounds[level] == step]
+            current = current[~pair_valid[pair[current]]]
+            if not len(current):
+                continue
+
+            # This encounter is valid by default when its group has no valid encounter yet
+            accept = ~group_valid[group[current]]
+
+            # The nearest valid encounters before and after in the timeline of the group
+            before = np.maximum.accumulate(np.where(ordered_valid, steps, -1))
+            after = np.minimum.accumulate(np.where(ordered_valid, steps, size)[::-1])[::-1]
+            at = position[current]
+            previous = timeline[before[np.maximum(at - 1, 0)]]
+            has_previous = (at > 0) & (before[np.maximum(at - 1, 0)] >= 0) & (group[previous] == group[current])
+            following = timeline[np.minimum(after[np.minimum(at + 1, size - 1)], size - 1)]
+            has_following = (at < size - 1) & (after[np.minimum(at + 1, size - 1)] < size) \
+                & (group[following] == group[current])
+
+            # Check before and after, both must be valid
+            valid_before, _ = next_event_valid_array(rank[previous], day[previous],
+                                                     rank[current], day[current], base=1, gaps=gaps)
+            valid_after, _ = next_event_valid_array(rank[current], day[current],
+                                                    rank[following], day[following], base=0, gaps=gaps)
+            valid_before = ~has_previous | (valid_before & ~missing[previous] & ~missing[current])
+            valid_after = ~has_following | (valid_after & ~missing[current] & ~missing[following])
+            accept |= valid_before & valid_after & (encounter[current] >= 0)
+
+            found = current[accept]
+            valid[found] = True
+            ordered_valid[position[found]] = True
+            group_valid[group[found]] = True
+            pair_valid[pair[found]] = True
+            pair_valid[-1] = False
+
+    df['outcome_valid'] = valid
+    df['event_date'] = df[admit_col].where(valid, BAD_DATE)
+
+    return df
+
+
+def _admit_days(dates: pd.Series):
+    """
+    Utility to convert admit dates to whole days since the epoch.
+
+    :return: Returns a numpy int64 array and a boolean array that is True for missing dates
+    """
+
+    missing = dates.isna().to_numpy()
+    days = dates.to_numpy(dtype='datetime64[D]').astype(np.int64)
+
+    return np.where(missing, 0, days), missing
+
+
+def _whole_days(dates: pd.Series):
+    """
+    Utility to check that the admit dates are datetimes without a time of day.
+    """
+
+    if not pd.api.types.is_datetime64_dtype(dates):
+        return False
+
+    values = dates.dropna()
+
+    return bool((values == values.dt.normalize()).all())
+
+
 def outcomes(df: pd.DataFrame,
              max_id: str,
              patient_col: str,
@@ -358,14 +669,17 @@ def number_pregnancy(df: pd.DataFrame,
 
     :param df: Pandas dataframe with validated classified encounters
     where each row indicates an individual pregnancy outcome
-    :param patient_col: Column that contains the patient identifier
+    :param patient_col: Column that contains the patient identifier, or a list of
+    columns that together identify the patient
     :param admit_col: Column that contains the admit date of the encounter
 
     :return: Returns the original dataframe with the preg_num appended in the columns
     """
 
-    df.sort_values(by=[patient_col, admit_col], inplace=True)
-    df['preg_num'] = df.groupby(patient_col).cumcount() + 1
+    keys = patient_col if isinstance(patient_col, list) else [patient_col]
+
+    df.sort_values(by=[*keys, admit_col], inplace=True)
+    df['preg_num'] = df.groupby(keys).cumcount() + 1
 
     return df
 
@@ -453,84 +767,32 @@ def standardize_type_and_version(df: pd.DataFrame,
     :param version_col: Column containing information about the coding system for the CODE
 
     :return: Returns the original pandas dataframe with the code_type and
-    version data replaced with standard forms if they match acceptable variations.
+    version data replaced with standard forms if they match acceptable variations,
+    held in the categorical dtypes CODE_TYPE_DTYPE and VERSION_DTYPE.
     """
 
     import warnings
 
-    # Types can accept a CODE label as dx/DIAGNOSIS/diagnostic,
-    # px/PROCEDURE, DRG/diagnostic related group
-    types = dict()
-    types['DX'] = ('dx',
-                   'DIAGNOSIS',
-                   'diagnostic')
-    types['PX'] = ('px',
-                   'PROCEDURE')
-    types['DRG'] = ('DRG',
-                    'diagnostic related group')
-
-    # Versions can accept different coding systems: 9/ICD9, 10/ICD10/ICD10-CM/ICD10-PCS
-    versions = dict()
-    versions['ICD9'] = ('9',
-                        'ICD9')
-    versions['ICD10'] = ('10',
-                         'ICD10',
-                         'ICD10-CM',
-                         'ICD10-PCS')
-    versions['CPT'] = ('CPT',
-                       'CPT4',
-                       'HCPCS')
-    versions['DRG'] = ('DRG',
-                       'MS-DRG')
-
-    # Check the contents of the Type column and warn user if
-    # the contents don't match the expected types. This doesn't constitute
-    # an error as the dataset could contain valid codes from other systems for other uses
-    df[type_col] = df[type_col].str.lower()
-    df_types = set(df[type_col].unique().flat)
-    this_types = set([val for value in types.values() for val in value])
-    if not df_types.issubset(this_types):
-        warnings.warn(f"Some code types ({df_types-this_types}) do not match {this_types}."
+    # Replace Type and Version with their standard forms, the labels are checked once per
+    # distinct value. Labels that don't match the expected types and versions don't constitute
+    # an error as the dataset could contain valid codes from other systems for other uses,
+    # warn the user and leave those rows out.
+    df[type_col], df_types = standard_labels(df[type_col], TYPES, CODE_TYPE_DTYPE,
+                                             lambda labels: labels.str.lower())
+    this_types = set([val for value in TYPES.values() for val in value])
+    if df_types:
+        warnings.warn(f"Some code types ({df_types}) do not match {this_types}."
                       f" Ensure these are not in error.", stacklevel=2)
 
-    # Check the contents of the Version column and warn user if
-    # the contents don't match the expected. This doesn't constitute
-    # an error as the dataset could contain valid codes from other systems for other uses
-    df[version_col] = df[version_col].str.upper()
-    df_versions = set(df[version_col].unique().flat)
-    this_versions = set([val for value in versions.values() for val in value])
-    if not df_versions.issubset(this_versions):
-        warnings.warn(f"Some code versions ({df_versions-this_versions})"
+    df[version_col], df_versions = standard_labels(df[version_col], VERSIONS, VERSION_DTYPE,
+                                                   lambda labels: labels.str.upper())
+    this_versions = set([val for value in VERSIONS.values() for val in value])
+    if df_versions:
+        warnings.warn(f"Some code versions ({df_versions})"
                       f" do not match {this_versions}."
                       f" Ensure these are not in error.", stacklevel=2)
 
-    # Convert dictionary to dataframe
-    types = pd.DataFrame.from_dict(types, orient='index').stack().to_frame()
-    types = pd.DataFrame(types[0].values.tolist(),
-                         index=types.index).reset_index().drop('level_1', axis=1)
-    types.columns = [type_col, 'type_match']
-
-    # Convert dictionary to dataframe
-    versions = pd.DataFrame.from_dict(versions, orient='index').stack().to_frame()
-    versions = pd.DataFrame(versions[0].values.tolist(),
-                            index=versions.index).reset_index().drop('level_1', axis=1)
-    versions.columns = [version_col, 'version_match']
-
-    # Replace Type and Version in the provided dataframe with standard forms
-    df = df.merge(types,
-                  how='inner',
-                  left_on=type_col,
-                  right_on='type_match',
-                  suffixes=('_x', ''))\
-        .merge(versions,
-               how='inner',
-               left_on=version_col,
-               right_on='version_match',
-               suffixes=('_x', ''))\
-        .drop(columns=[f'{version_col}_x',
-                       'version_match',
-                       f'{type_col}_x',
-                       'type_match'])
+    df = df[df[type_col].notna() & df[version_col].notna()].reset_index(drop=True)
 
     return df
 
@@ -542,12 +804,18 @@ def process_outcomes(df: pd.DataFrame,
                      version_col: str,
                      type_col: str,
                      code_col: str,
-                     expanded: bool = False):
+                     expanded: bool = False,
+                     spacing_configs=None,
+                     schemas=None,
+                     provenance: bool = False,
+                     memory_limit: int = None,
+                     trace_memory: bool = False):
     """
     Main function to classify pregnancies. Accepts a dataframe with the listed columns to begin the
     pregnancy classification.
 
-    :param df: Pandas dataframe with encounter data - rows should be unique to each CODE provided
+    :param df: Pandas dataframe with encounter data - rows should be unique to each CODE provided.
+    A pyarrow Table or the path of an Arrow IPC file is also accepted, see arrow_frame
     :param patient_col: Column containing the unique patient identifier
     :param encounter_col: Column containing the encounter identifier
     :param admit_date_col: Column containing the admit date for the encounter
@@ -557,13 +825,60 @@ def process_outcomes(df: pd.DataFrame,
     :param expanded: Boolean flag to indicate if the classification should use the
     Moll and crosswalked codes or if the additional codes added by the author should
     be included in the classification process
+    :param spacing_configs: Optional batch of spacing configurations for sensitivity analyses,
+    given as a dictionary of configuration id to configuration or as a list where the position
+    is the id. See spacing_config for the layout of a configuration, an empty dictionary is
+    the default spacing. Codes are standardized and classified once for the whole batch.
+    :param schemas: Optional batch of code schema selections to compare code lists, given as
+    a dictionary of selection id to a list of schemas (MOLL, CROSSWALK, EXPANDED) or as a list
+    where the position is the id. Replaces the expanded flag, which is equivalent to
+    [MOLL, CROSSWALK, EXPANDED] and [MOLL, CROSSWALK] otherwise. Codes are matched in a single
+    pass for all selections.
+    :param provenance: Adds a pattern_id column with the first pattern of the published
+    pattern table that gave the outcome encounter its outcome, see pattern_table
+    :param memory_limit: Optional memory budget in bytes. Patients are processed in chunks
+    sized so the estimated working set stays under the budget, and the chunking is
+    reported in output.attrs['memory'], see run_within
+    :param trace_memory: Optional boolean to trace the allocations of a run with a memory_limit
+    and report their peak in output.attrs['memory'], tracing slows the entry point down
 
     :return: Returns a pandas dataframe containing a single row per pregnancy, the pregnancy number,
-    the outcome classification, and date information about the pregnancy start window
+    the outcome classification, and date information about the pregnancy start window.
+    With spacing_configs there is a row per configuration and pregnancy, identified by
+    the config_id column, and with schemas a row per selection and pregnancy, identified
+    by the schema_id column.
     """
 
     from .outcome_map import OUTCOME_COL
 
+    # Arrow tables and IPC files are screened before any dataframe is made, see arrow_frame
+    if not isinstance(df, pd.DataFrame):
+        from ..arrow import arrow_frame
+        df = arrow_frame('process_outcomes', df,
+                         patient_col=patient_col,
+                         encounter_col=encounter_col,
+                         admit_date_col=admit_date_col,
+                         version_col=version_col,
+                         type_col=type_col,
+                         code_col=code_col)
+
+    if memory_limit is not None:
+        from ..budget import run_within
+        return run_within('process_outcomes', df, memory_limit,
+                          patient_col=patient_col,
+                          encounter_col=encounter_col,
+                          admit_date_col=admit_date_col,
+                          version_col=version_col,
+                          type_col=type_col,
+                          code_col=code_col,
+                          expanded=expanded,
+                          spacing_configs=spacing_configs,
+                          schemas=schemas,
+                          provenance=provenance,
+                          trace_memory=trace_memory)
+
+    stages = Stages('process_outcomes', df)
+
     # Set a reference for the column names used in the package to the provided column names.
     package_cols = {admit_date_col: 'admit',
                     patient_col: 'group_id',
@@ -583,48 +898,112 @@ def process_outcomes(df: pd.DataFrame,
     type_col = package_cols[type_col]
     code_col = package_cols[code_col]
 
-    # A lot of operations are done on the original dataframe, this turns off the warning
-    pd.options.mode.chained_assignment = None
-
-    # Set the column names to what is used throughout the package
-    df.rename(columns=package_cols, inplace=True)
+    # Set the column names to what is used throughout the package on a copy,
+    # the caller's dataframe is left untouched
+    df = df.rename(columns=package_cols)
 
     # Standardize the CODE metadata
     data = standardize_type_and_version(df,
                                         type_col,
                                         version_col)
+    stages.done('standardize', data)
+
+    # Drop the codes that no outcome pattern can match before the regex is applied,
+    # the patterns ignore the dots of the codes
+    data = data[screen_codes(data[code_col], OUTCOME_PREFIXES, strip='.')]
+    stages.done('screen', data)
 
     # Classify each row based on the CODE and CODE metadata
-    data = attach_map(data,
-                      code_col,
-                      type_col,
-                      version_col,
-                      expanded)
-    # Utility to give an idea of progress
-    # max_id = data[patient_col].max()
+    if schemas is None:
+        keys = [patient_col]
+        data = attach_map(data,
+                          code_col,
+                          type_col,
+                          version_col,
+                          expanded,
+                          provenance)
+    else:
+        if not isinstance(schemas, dict):
+            schemas = dict(enumerate(schemas))
+        keys = [SCHEMA_COL, patient_col]
+        data = attach_map_schemas(data,
+                                  code_col,
+                                  type_col,
+                                  version_col,
+                                  list(schemas.values()),
+                                  provenance)
+        # Each selection continues with the rows its schemas matched
+        data = pd.concat([data[(data[SCHEMA_BITS] & (1 << bit)) > 0]
+                          .assign(**{SCHEMA_COL: schema_id})
+                          for bit, schema_id in enumerate(schemas)],
+                         ignore_index=True)\
+            .drop(columns=SCHEMA_BITS)
+    stages.done('attach_map', data)
+
+    # Keep the pattern of each classified encounter aside, the spacing logic runs without it
+    if provenance:
+        pattern_keys = [*keys, encounter_col, OUTCOME_COL]
+        patterns = data.groupby(pattern_keys, observed=True)[PATTERN_ID].min()
+        data = data.drop(columns=PATTERN_ID)
+
+    # Only one row per encounter and outcome goes on to spacing and validation
+    data = collapse_encounters(data, [*keys, encounter_col, admit_date_col], OUTCOME_COL,
+                               [code_col, type_col, version_col])
+    stages.done('collapse', data)
+
+    # Get the spacing data, once per configuration when a batch is given
+    if spacing_configs is None:
+        df_spacing_data = spacing(data,
+                                  patient_col=patient_col,
+                                  outcome_col=OUTCOME_COL,
+                                  admit_col=admit_date_col)
+    else:
+        if not isinstance(spacing_configs, dict):
+            spacing_configs = dict(enumerate(spacing_configs))
+        keys = [CONFIG_COL, *keys]
+        df_spacing_data = pd.concat([spacing(data,
+                                             patient_col=patient_col,
+                                             outcome_col=OUTCOME_COL,
+                                             admit_col=admit_date_col,
+                                             config=config)
+                                     .assign(**{CONFIG_COL: config_id})
+                                     for config_id, config in spacing_configs.items()],
+                                    ignore_index=True)
 
-    # Get the spacing data
-    df_spacing_data = spacing(data,
-                              patient_col=patient_col,
-                              outcome_col=OUTCOME_COL,
-                              admit_col=admit_date_col)
     # Prepare columns to validate the OUTCOMES
     df_spacing_data['outcome_valid'] = False
     df_spacing_data['event_date'] = BAD_DATE
 
-    # Code metadata is no longer needed at this stage - also lose the duplicates
-    df_spacing_data.drop(columns=[code_col, type_col, version_col], inplace=True)
-    df_spacing_data.drop_duplicates(inplace=True)
-
-    # Validate the OUTCOMES for each patient
-    pregs = df_spacing_data.groupby(patient_col,
-                                    group_keys=True)\
-        .apply(validate_outcomes,
-               outcome_col=OUTCOME_COL,
-               admit_col=admit_date_col,
-               encounter_col=encounter_col,
-               include_groups=False)\
-        .reset_index(level=0, names=patient_col)
+    stages.done('spacing', df_spacing_data)
+
+    # Validate the OUTCOMES for each patient, all patients at once on arrays when the admit
+    # dates are whole days, one batch per configuration
+    if _whole_days(df_spacing_data[admit_date_col]):
+        if spacing_configs is None:
+            pregs = validate_outcomes_array(df_spacing_data,
+                                            keys=keys,
+                                            outcome_col=OUTCOME_COL,
+                                            admit_col=admit_date_col,
+                                            encounter_col=encounter_col)
+        else:
+            pregs = pd.concat([validate_outcomes_array(df_spacing_data[df_spacing_data[CONFIG_COL] == config_id],
+                                                       keys=keys,
+                                                       outcome_col=OUTCOME_COL,
+                                                       admit_col=admit_date_col,
+                                                       encounter_col=encounter_col,
+                                                       gaps=gap_matrix(spacing_config(config)[NEXT]))
+                               for config_id, config in spacing_configs.items()],
+                              ignore_index=True)
+    else:
+        pregs = df_spacing_data.groupby(keys,
+                                        group_keys=True)\
+            .apply(validate_outcomes,
+                   outcome_col=OUTCOME_COL,
+                   admit_col=admit_date_col,
+                   encounter_col=encounter_col,
+                   include_groups=False)\
+            .reset_index(level=list(range(len(keys))), names=keys)
+    stages.done('validate_outcomes', pregs)
 
     # Only keep the valid patients
     output = select_valid(pregs)
@@ -634,17 +1013,19 @@ def process_outcomes(df: pd.DataFrame,
 
     # Prepare dataframe to get the pregnancy number
     output.reset_index(drop=True, inplace=True)
-    output = number_pregnancy(output, patient_col=patient_col, admit_col=admit_date_col)
+    output = number_pregnancy(output, patient_col=keys, admit_col=admit_date_col)
+    stages.done('set_preg_window', output)
 
     # Adjust the start window date if needed
-    output = output.groupby(patient_col,
+    output = output.groupby(keys,
                             group_keys=True)\
         .apply(check_window,
                include_groups=False)\
-        .reset_index(level=0, names=patient_col)
+        .reset_index(level=list(range(len(keys))), names=keys)
+    stages.done('check_window', output)
 
-    # Restore the pandas settings
-    pd.options.mode.chained_assignment = 'warn'
+    if provenance:
+        output = output.join(patterns, on=pattern_keys)
 
     # Restore the column names
     output.rename(columns=restore_cols, inplace=True)
@@ -0,0 +1,116 @@
+"""
+APO flags and comorbidity scores over the windows of the pregnancies found.
+
+Copyright (C) 2023 Dave Walsh
+
+apo and calc_index count every code row that carries the pregnancy identifier
+they are given. window_flags takes dated code rows and the pregnancies found
+by process_outcomes instead, and only counts the codes dated within each
+pregnancy, from its start_window through its event_date. Chronic conditions
+are often coded before the pregnancy is known, so the comorbidity score can
+also look back a number of days before the start of the window.
+
+The rows are joined to the windows once with the sorted range join of
+window_join, over the window extended by the lookback. The APO flags are
+taken from the rows within the pregnancy itself and the score from every
+joined diagnosis row, so both come from the same join.
+
+Available functions
+window_flags : Flags APOs and scores comorbidity from the codes within each pregnancy window
+"""
+
+import pandas as pd
+
+from .adverse_pregnancy_outcomes import apo
+from .adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import TYPES
+from .dtypes import CODE_TYPE_DTYPE, standard_labels
+from .obstetric_comorbidity import calc_index
+from .pregnancy_outcome.assign_pregnancy import _day_number, _window_pairs
+
+
+def window_flags(df: pd.DataFrame,
+                 pregnancies: pd.DataFrame,
+                 patient_col: str,
+                 admit_date_col: str,
+                 code_type: str,
+                 version: str,
+                 code: str,
+                 method: str = 'bateman',
+                 age_col: str = None,
+                 lookback: int = 0,
+                 preg_col: str = 'preg_num',
+                 start_col: str = 'start_window',
+                 end_col: str = 'event_date'):
+    """
+    Flags adverse pregnancy outcomes and scores obstetric comorbidity for each pregnancy from
+    the codes dated within its window.
+
+    :param df: Pandas dataframe of dated codes, rows should be unique to each CODE
+    :param pregnancies: Pandas dataframe with one row per pregnancy, as returned by process_outcomes
+    :param patient_col: Column containing the unique patient identifier in both dataframes
+    :param admit_date_col: Column in df containing the admit date for the encounter
+    :param code_type: Column in df with the type of the code, see apo
+    :param version: Column in df with the version of the code, see apo and calc_index
+    :param code: Column in df containing the CODE
+    :param method: Comorbidity index method, 'bateman' or 'leonard', None leaves the score out
+    :param age_col: Optional column with the maternal age, in df or in pregnancies
+    :param lookback: Number of days before the start_window whose codes count toward the score
+    :param preg_col: Column in pregnancies containing the pregnancy number
+    :param start_col: Column in pregnancies containing the first day of the pregnancy
+    :param end_col: Column in pregnancies containing the outcome date
+
+    :return: Returns a pandas dataframe with the patient and pregnancy number of every
+    pregnancy, the APO flags, and the comorbidity score columns of calc_index. Only diagnosis
+    codes are scored. The score is missing for a pregnancy without a diagnosis code of a
+    version the method accepts in its window.
+
+    :raises: KeyError
+        If column names are supplied that are not present in the data.
+    :raises: ValueError
+        If the lookback is negative
+    """
+
+    if not {patient_col, admit_date_col, code_type, version, code}.issubset(df.columns):
+        raise KeyError(f"Ensure that columns "
+                       f"{[patient_col, admit_date_col, code_type, version, code]}"
+                       f" are present in the data.")
+
+    if not {patient_col, preg_col, start_col, end_col}.issubset(pregnancies.columns):
+        raise KeyError(f"Ensure that columns {[patient_col, preg_col, start_col, end_col]}"
+                       f" are present in the pregnancies.")
+
+    if lookback < 0:
+        raise ValueError('lookback must not be negative')
+
+    # Every row is paired with each window it falls in, extended by the lookback
+    rows, pregs, admit = _window_pairs(df, pregnancies, patient_col, admit_date_col,
+                                       lookback, 0, start_col, end_col)
+    start, _ = _day_number(pregnancies[start_col])
+
+    code_cols = [patient_col, code_type, version, code]
+    if age_col and age_col in df.columns:
+        code_cols.append(age_col)
+    codes = df[code_cols].iloc[rows].reset_index(drop=True)
+    codes[preg_col] = pregnancies[preg_col].to_numpy()[pregs]
+    if age_col and age_col not in codes.columns:
+        codes[age_col] = pregnancies[age_col].to_numpy()[pregs]
+
+    output = pregnancies[[patient_col, preg_col]].drop_duplicates().reset_index(drop=True)
+
+    # APOs only count the codes within the pregnancy itself
+    in_pregnancy = (admit >= start[pregs])
+    apo_flags = apo(codes[in_pregnancy], patient_col, preg_col, code_type, version, code)
+    apo_cols = list(apo_flags.columns.drop([patient_col, preg_col]))
+    output = output.merge(apo_flags, how='left', on=[patient_col, preg_col])
+    output[apo_cols] = output[apo_cols].astype('boolean').fillna(False).astype(bool)
+
+    # The score counts the lookback as well, calc_index only accepts diagnosis codes and does
+    # not look at the code type, so the other types are left out with the labels apo accepts
+    if method is not None:
+        types, _ = standard_labels(codes[code_type], TYPES, CODE_TYPE_DTYPE, lambda labels: labels.str.lower())
+        diagnoses = codes[(types == 'DX').to_numpy()]
+        output = output.merge(calc_index(diagnoses, patient_col, preg_col, code, version, method, age_col),
+                              how='left',
+                              on=[patient_col, preg_col])
+
+    return output
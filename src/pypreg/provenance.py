@@ -0,0 +1,96 @@
+"""
+Match provenance for auditing classifications.
+
+Copyright (C) 2023 Dave Walsh
+
+Every regular expression in the package code maps has a small integer
+pattern_id in the published pattern table. With provenance switched on,
+attach_map, process_outcomes, and smm return the pattern_id of the pattern
+that classified each row, so a questioned classification can be traced to
+the exact code set, code type, version, schema, pattern, and label without
+matching the codes again. The ids are attached to the few rows of the code
+maps before matching, the data itself only carries one more integer column.
+
+The ids follow the order of the code maps and are stable for a release of
+the package. Keep the pattern table of the release with results that are
+audited later.
+
+Available functions
+pattern_table : Returns the published pattern table
+with_pattern_ids : Attaches the pattern_id to the rows of a package code map
+"""
+
+from functools import lru_cache
+import pandas as pd
+
+PATTERN_ID = 'pattern_id'
+
+PATTERN_TABLE_COLUMNS = [PATTERN_ID,
+                         'code_set',
+                         'code_type',
+                         'version',
+                         'schema',
+                         'label',
+                         'pattern']
+
+
+@lru_cache(maxsize=1)
+def _pattern_table():
+    """
+    Utility to build the pattern table a single time.
+    """
+
+    from .sql.code_tables import code_set_table
+
+    return code_set_table()[PATTERN_TABLE_COLUMNS]
+
+
+def pattern_table():
+    """
+    Returns the published pattern table used to look up a pattern_id.
+
+    :return: Returns a pandas dataframe with one row per pattern_id and the code set,
+        code type, version, schema, label, and regular expression of the pattern
+    """
+
+    return _pattern_table().copy()
+
+
+def with_pattern_ids(map_df: pd.DataFrame,
+                     code_set: str,
+                     type_col: str,
+                     version_col: str,
+                     pattern_col: str,
+                     label_col: str = None,
+                     schema_col: str = None):
+    """
+    Attaches the pattern_id of the pattern table to the rows of a package code map, or to a
+    subset of its rows. Map rows that are repeated share the first id of the pattern.
+
+    :param map_df: pandas dataframe of the code map
+    :param code_set: Name of the code set in the pattern table ('outcome', 'smm', 'transfusion', ...)
+    :param type_col: Column containing the code type
+    :param version_col: Column containing the code version
+    :param pattern_col: Column containing the regular expression
+    :param label_col: Column containing the label attached by a match, if any
+    :param schema_col: Column containing the code schema, if any
+
+    :return: Returns the map with an added pattern_id column
+    """
+
+    table = _pattern_table()
+    table = table[table['code_set'] == code_set]
+
+    # Match the map columns to the pattern table columns they were flattened into
+    keys = {type_col: 'code_type',
+            version_col: 'version',
+            pattern_col: 'pattern'}
+    if label_col:
+        keys[label_col] = 'label'
+    if schema_col:
+        keys[schema_col] = 'schema'
+
+    ids = table.groupby(list(keys.values()), sort=False)[PATTERN_ID].min()
+
+    # Categorical map columns come back from the join as strings, keep the dtypes of the map
+    return map_df.join(ids, on=list(keys)).astype(map_df.dtypes.to_dict())
@@ -0,0 +1,18 @@
+"""
+This module holds a frozen copy of the entry points, the reference engine of verify.
+
+The copies are the published pipeline as it stood before the collapsed encounters,
+categorical dtypes, prefix screening, and array validation were added to the package.
+They share the code maps of the package but none of its execution paths, so every
+optimization is compared against the logic it replaced. They are not changed when the
+package is optimized; a change to the published results is made here deliberately.
+
+process_outcomes, smm, apo, and calc_index take the analytic arguments of the package
+entry points, options added for execution (memory_limit) or reporting (provenance,
+flags, registered code sets) are not part of the reference.
+"""
+
+from .process_outcome import process_outcomes
+from .smm import smm
+from .adverse_pregnancy_outcomes import apo
+from .obstetric_index import calc_index
@@ -0,0 +1,73 @@
+"""
+Prefix screen applied before the code sets are matched.
+
+Copyright (C) 2023 Dave Walsh
+
+Every anchored pattern of a code set starts with a literal prefix, for most
+of them the ICD-10 chapter letter or the leading digits of an ICD-9 code. A
+code that starts with none of the prefixes of a code set can't match any of
+its patterns, so those rows can be dropped before the regular expressions are
+tried. The screen is a single startswith over the distinct codes of a column,
+most rows of a general claims extract are removed for the cost of a lookup.
+
+The entry points report the screen as a 'screen' stage to instrument, the
+rows it pruned are its rows_in less its rows_out.
+
+Available functions
+code_prefixes : Lists the prefixes a code must start with to match any of the patterns
+screen_codes : Flags the codes that start with one of the prefixes
+"""
+
+import numpy as np
+import pandas as pd
+
+from .sql.code_tables import literal_prefix
+
+
+def code_prefixes(patterns):
+    """
+    Lists the literal prefixes a code must start with to match any of the patterns. Prefixes
+    that extend a shorter prefix of the list are left out.
+
+    :param patterns: Regular expressions as written in the mapping modules
+
+    :return: Returns a sorted tuple of prefixes, or None when a pattern is not anchored or
+    has no literal prefix, so no code can be ruled out
+    """
+
+    prefixes = set()
+    for pattern in patterns:
+        prefix = literal_prefix(pattern)
+        if not pattern.startswith('^') or not prefix:
+            return None
+        prefixes.add(prefix)
+
+    return tuple(sorted(prefix for prefix in prefixes
+                        if not any(prefix != other and prefix.startswith(other) for other in prefixes)))
+
+
+def screen_codes(codes: pd.Series,
+                 prefixes,
+                 strip: str = None):
+    """
+    Flags the codes that start with one of the prefixes. The comparison is made once per
+    distinct code, missing codes are never kept.
+
+    :param codes: Pandas series of codes
+    :param prefixes: Tuple of prefixes from code_prefixes, None keeps every code
+    :param strip: Optional character removed from the codes before the comparison, such as '.'
+
+    :return: Returns a numpy boolean array, True for the codes that could match a pattern
+    """
+
+    if prefixes is None:
+        return np.ones(len(codes), dtype=bool)
+
+    positions, uniques = pd.factorize(codes)
+    uniques = pd.Series(uniques, dtype=object)
+    if strip:
+        uniques = uniques.str.replace(strip, '', regex=False)
+    kept = uniques.str.startswith(prefixes, na=False).to_numpy(dtype=bool)
+
+    # Missing codes have position -1, which takes the False appended at the end
+    return np.append(kept, False)[positions]
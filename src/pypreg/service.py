@@ -0,0 +1,459 @@
+"""
+Local scoring service for SMM and APO flags.
+
+Copyright (C) 2023 Dave Walsh
+
+Scoring one encounter at a time pays the setup and normalization cost of a
+dataframe call for every request. The service keeps the code sets loaded and
+collects incoming requests into micro-batches: a batch is scored once the
+queued requests hold max_batch units or the oldest request has waited
+max_delay seconds, whichever comes first. Each batch is scored with a single
+smm or apo call in a worker thread while the event loop keeps accepting
+requests, and the flags are split back out to each request. A batch that
+fails is scored again one request at a time, so a bad request only fails
+itself.
+
+The service speaks HTTP/1.1 over TCP or a Unix socket:
+
+    POST /smm  {"encounters": [{"encounter_id": "E1", "codes": [{"code_type": "DX", "version": "10", "code": "O72.3"}]}]}
+    POST /apo  {"pregnancies": [{"patient_id": 1, "preg_id": 1, "codes": [...]}]}
+    GET /metrics
+    GET /health
+
+The response of a scoring request has one result per submitted unit, in
+order, with every flag. GET /metrics returns the request, unit, and batch
+counts, the current and largest queue depth, and latency percentiles.
+
+Available functions and classes
+MicroBatcher : Collects requests into batches by size or deadline and scores them
+ScoringService : HTTP front end of the SMM and APO batchers
+serve : Runs the service until interrupted
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import warnings
+from collections import deque
+import numpy as np
+import pandas as pd
+
+CODE_FIELDS = ['code_type', 'version', 'code']
+
+# Request list and unit key fields of each scoring endpoint
+UNITS = {'smm': ('encounters', ['encounter_id']),
+         'apo': ('pregnancies', ['patient_id', 'preg_id'])}
+
+BATCH_ID = 'batch_id'
+
+PERCENTILES = [50, 95, 99]
+
+
+def _frame(requests: list):
+    """
+    Utility to flatten requests into one dataframe of code rows. Every unit gets a batch id
+    so that units with the same key in different requests stay apart.
+
+    :return: Returns the dataframe and the number of units
+    """
+
+    rows = [(unit_id, *[code[field] for field in CODE_FIELDS])
+            for unit_id, unit in enumerate(unit for request in requests for unit in request)
+            for code in unit['codes']]
+    units = sum(len(request) for request in requests)
+
+    return pd.DataFrame(rows, columns=[BATCH_ID, *CODE_FIELDS]), units
+
+
+def _split(flags: pd.DataFrame,
+           requests: list,
+           keys: list):
+    """
+    Utility to give each request the flags of its units, with the keys it sent.
+    """
+
+    results = []
+    records = iter(flags.to_dict(orient='records'))
+    for request in requests:
+        results.append([{**{key: unit[key] for key in keys}, **next(records)} for unit in request])
+
+    return results
+
+
+def score_smm(requests: list,
+              indicators: bool = False):
+    """
+    Scores a batch of smm requests with a single smm call.
+
+    :param requests: List of requests, each a list of encounters with encounter_id and codes
+    :param indicators: Also return the individual SMM indicators
+
+    :return: Returns a list with the results of each request
+    """
+
+    from .smm import smm
+
+    df, units = _frame(requests)
+    output = smm(df, BATCH_ID, 'code_type', 'version', 'code', indicators=indicators)
+
+    # Encounters without SMM or transfusion are not in the output
+    flags = output.set_index(BATCH_ID).reindex(range(units), fill_value=False).astype(bool)
+
+    return _split(flags, requests, UNITS['smm'][1])
+
+
+def score_apo(requests: list):
+    """
+    Scores a batch of apo requests with a single apo call.
+
+    :param requests: List of requests, each a list of pregnancies with patient_id, preg_id, and codes
+
+    :return: Returns a list with the results of each request
+    """
+
+    from .adverse_pregnancy_outcomes import apo
+
+    df, units = _frame(requests)
+    df['preg'] = df[BATCH_ID]
+    output = apo(df, BATCH_ID, 'preg', 'code_type', 'version', 'code')
+
+    # Pregnancies without codes are not in the output
+    flags = output.drop(columns='preg').set_index(BATCH_ID).reindex(range(units), fill_value=False).astype(bool)
+
+    return _split(flags, requests, UNITS['apo'][1])
+
+
+class MicroBatcher:
+    """
+    Collects requests into batches and scores each batch with one call.
+
+    :param score: Function scoring a list of requests, returning a list of results per request
+    :param max_batch: Number of units that closes a batch
+    :param max_delay: Seconds the oldest request of a batch waits before the batch is scored
+    :param window: Number of recent requests and batches kept for the latency and size metrics
+    """
+
+    def __init__(self,
+                 score,
+                 max_batch: int = 512,
+                 max_delay: float = 0.01,
+                 window: int = 10_000):
+        self.score = score
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = None
+        self.requests = 0
+        self.units = 0
+        self.batches = 0
+        self.errors = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.batch_seconds = deque(maxlen=window)
+
+    async def submit(self, units: list):
+        """
+        Queues a request and waits for its batch to be scored.
+
+        :param units: List of units, encounters for smm or pregnancies for apo
+
+        :return: Returns the list of results of the units
+        """
+
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+
+        future = asyncio.get_running_loop().create_future()
+        self.queue_depth += len(units)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        await self.queue.put((units, future, time.perf_counter()))
+
+        return await future
+
+    async def run(self):
+        """
+        Scores batches until cancelled.
+        """
+
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_delay
+
+            # Keep collecting until the batch is full or the deadline passes
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                size += len(batch[-1][0])
+            self.queue_depth -= size
+
+            requests = [units for units, _, _ in batch]
+            started = time.perf_counter()
+            try:
+                # Score in a thread so the loop keeps accepting requests
+                results = await loop.run_in_executor(None, self.score, requests)
+            except Exception as err:
+                # Score the requests of a failed batch on their own so only the bad ones fail
+                results = [err] if len(batch) == 1 \
+                    else [await self._score_alone(loop, units) for units in requests]
+
+            finished = time.perf_counter()
+            self.batches += 1
+            self.batch_sizes.append(size)
+            self.batch_seconds.append(finished - started)
+            for (units, future, queued), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    if not future.done():
+                        future.set_exception(result)
+                    continue
+                self.requests += 1
+                self.units += len(units)
+                self.latencies.append(finished - queued)
+                if not future.done():
+                    future.set_result(result)
+
+    async def _score_alone(self, loop, units: list):
+        """
+        Utility to score one request in a batch of its own, returns its result or the exception it raised.
+        """
+
+        try:
+            return (await loop.run_in_executor(None, self.score, [units]))[0]
+        except Exception as err:
+            return err
+
+    def metrics(self):
+        """
+        :return: Returns a dictionary of counts, queue depth, and latency and batch percentiles in seconds
+        """
+
+        def percentiles(values):
+            if not values:
+                return {f'p{q}': None for q in PERCENTILES}
+            return dict(zip([f'p{q}' for q in PERCENTILES],
+                            np.percentile(np.fromiter(values, float), PERCENTILES).round(6).tolist()))
+
+        return {'requests': self.requests,
+                'units': self.units,
+                'batches': self.batches,
+                'errors': self.errors,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else None,
+                'latency_seconds': percentiles(self.latencies),
+                'batch_seconds': percentiles(self.batch_seconds)}
+
+
+class ScoringService:
+    """
+    Serves the SMM and APO batchers over HTTP.
+
+    service = ScoringService(max_batch=512, max_delay=0.01)
+    await service.start(port=8750) or await service.start(path='/tmp/pypreg.sock')
+
+    :param max_batch: Number of units that closes a batch
+    :param max_delay: Seconds the oldest request of a batch waits before the batch is scored
+    :param indicators: Also return the individual SMM indicators
+    """
+
+    def __init__(self,
+                 max_batch: int = 512,
+                 max_delay: float = 0.01,
+                 indicators: bool = False):
+        self.batchers = {'smm': MicroBatcher(lambda requests: score_smm(requests, indicators),
+                                             max_batch, max_delay),
+                         'apo': MicroBatcher(score_apo, max_batch, max_delay)}
+        self.server = None
+        self.tasks = []
+
+    async def start(self,
+                    host: str = '127.0.0.1',
+                    port: int = 8750,
+                    path: str = None):
+        """
+        Loads the code sets and starts listening.
+
+        :param host: Host of the TCP server
+        :param port: Port of the TCP server, 0 picks a free port
+        :param path: Path of a Unix socket to listen on instead of TCP
+
+        :return: Returns the asyncio server
+        """
+
+        # Score one unit per endpoint so the code sets are loaded before the first request
+        warm = {'codes': [{'code_type': 'DX', 'version': '10', 'code': 'O80'}]}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            score_smm([[{'encounter_id': 0, **warm}]])
+            score_apo([[{'patient_id': 0, 'preg_id': 0, **warm}]])
+
+        self.tasks = [asyncio.create_task(batcher.run()) for batcher in self.batchers.values()]
+        if path:
+            self.server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host=host, port=port)
+
+        return self.server
+
+    async def close(self):
+        """
+        Stops listening and stops the batchers.
+        """
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def metrics(self):
+        """
+        :return: Returns the metrics of each batcher
+        """
+
+        return {name: batcher.metrics() for name, batcher in self.batchers.items()}
+
+    async def _respond(self, method: str, target: str, body: bytes):
+        """
+        Utility to route a request, returns the status and the JSON payload.
+        """
+
+        if method == 'GET' and target == '/health':
+            return 200, {'status': 'ok'}
+        if method == 'GET' and target == '/metrics':
+            return 200, self.metrics()
+
+        analysis = target.strip('/')
+        if method != 'POST' or analysis not in UNITS:
+            return 404, {'error': f'Unknown endpoint {method} {target}'}
+
+        field, keys = UNITS[analysis]
+        try:
+            units = json.loads(body)[field]
+            for unit in units:
+                missing = [key for key in keys if key not in unit]
+                if missing:
+                    raise KeyError(missing)
+                for code in unit['codes']:
+                    missing = [name for name in CODE_FIELDS if name not in code]
+                    if missing:
+                        raise KeyError(missing)
+                    # A code that isn't text would fail the whole batch it is scored in
+                    wrong = [name for name in CODE_FIELDS if code[name] is not None and not isinstance(code[name], str)]
+                    if wrong:
+                        raise TypeError(wrong)
+        except (ValueError, KeyError, TypeError) as err:
+            return 400, {'error': f'Each {field[:-1]} needs {keys} and codes with {CODE_FIELDS} '
+                                  f'as strings or null: {err!r}'}
+
+        try:
+            return 200, {'results': await self.batchers[analysis].submit(units)}
+        except Exception as err:
+            return 500, {'error': repr(err)}
+
+    async def _handle(self,
+                      reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        """
+        Utility to serve the requests of one connection, the connection is kept open between requests.
+        """
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, target, _ = line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._respond(method.upper(), target.split('?')[0], body)
+                content = json.dumps(payload, default=str).encode()
+                close = headers.get('connection', '').lower() == 'close'
+                writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(content)}\r\n'
+                             f'Connection: {"close" if close else "keep-alive"}\r\n\r\n'.encode() + content)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _serve(service: ScoringService,
+                 host: str,
+                 port: int,
+                 path: str):
+    server = await service.start(host, port, path)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def serve(host: str = '127.0.0.1',
+          port: int = 8750,
+          path: str = None,
+          max_batch: int = 512,
+          max_delay: float = 0.01,
+          indicators: bool = False):
+    """
+    Runs the scoring service until interrupted.
+
+    :param host: Host of the TCP server
+    :param port: Port of the TCP server
+    :param path: Path of a Unix socket to listen on instead of TCP
+    :param max_batch: Number of units that closes a batch
+    :param max_delay: Seconds the oldest request of a batch waits before the batch is scored
+    :param indicators: Also return the individual SMM indicators
+    """
+
+    service = ScoringService(max_batch, max_delay, indicators)
+    try:
+        asyncio.run(_serve(service, host, port, path))
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='pypreg-service',
+                                     description='Local micro-batching scoring service for SMM and APO flags.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8750)
+    parser.add_argument('--socket', default=None,
+                        help='Listen on this Unix socket path instead of TCP')
+    parser.add_argument('--max-batch', type=int, default=512,
+                        help='Number of units that closes a batch')
+    parser.add_argument('--max-delay', type=float, default=0.01,
+                        help='Seconds the oldest request waits before its batch is scored')
+    parser.add_argument('--indicators', action='store_true',
+                        help='Also return the individual SMM indicators')
+    args = parser.parse_args(argv)
+
+    serve(args.host, args.port, args.socket, args.max_batch, args.max_delay, args.indicators)
+
+
+if __name__ == '__main__':
+    main()
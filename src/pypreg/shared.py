@@ -0,0 +1,300 @@
+"""
+Parallel execution of the pypreg entry points over shared memory.
+
+Copyright (C) 2023 Dave Walsh
+
+Pickling dataframe slices to worker processes can cost more than the work
+itself. Here the columns an entry point reads are encoded once as numpy
+arrays: identifiers and text columns are factorized to integer codes, dates
+and numbers keep their own dtype. The arrays are sorted by patient (by
+encounter for smm) and copied into multiprocessing.shared_memory blocks.
+Workers attach to the blocks by name, take a zero-copy view, and read only
+the contiguous rows of their patient range. Only the block names, the range
+bounds, and the small lookup tables of the text columns are sent to a worker.
+
+Identifiers stay as integer codes inside the workers and are translated
+back in the parent, so results match the in-memory call, in the same order.
+
+Workers keep the blocks attached while the entry point runs, so the
+identifier, date, and number columns of its dataframe are views of the
+blocks rather than copies. Only the text columns are decoded from their
+codes. A result that still holds memory of a block is copied before the
+worker closes its handles.
+
+The parent owns the blocks and unlinks them when the run ends, whether it
+succeeds, raises, or a worker process dies. Workers only close their handles.
+
+Available functions and classes
+SharedColumns : Context manager that owns a set of shared memory arrays
+attach_shared : Context manager that gives zero-copy views of the shared arrays
+run_shared : Runs an entry point over patient ranges in worker processes
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import pandas as pd
+
+from .partition import ENTRY_POINTS, ID_ARGS, VALUE_ARGS, ROW_COL, _combine, _entry_point, _first_rows
+
+
+class SharedColumns:
+    """
+    Copies numpy arrays into shared memory blocks, optionally reordered, and removes
+    the blocks when the context exits.
+
+    with SharedColumns({'code': codes}, order) as shared:
+        run workers with shared.spec
+
+    :param arrays: Dictionary of column name to one-dimensional numpy array
+    :param order: Optional row order the arrays are written in
+    """
+
+    def __init__(self,
+                 arrays: dict,
+                 order: np.ndarray = None):
+        self.blocks = []
+        self.spec = {}
+        try:
+            for col, values in arrays.items():
+                values = np.asarray(values)
+                block = SharedMemory(create=True, size=max(values.nbytes, 1))
+                self.blocks.append(block)
+
+                view = np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)
+                if order is None:
+                    view[:] = values
+                else:
+                    np.take(values, order, out=view)
+                del view
+
+                self.spec[col] = (block.name, values.dtype.str, len(values))
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Closes and unlinks every block, safe to call more than once.
+        """
+
+        for block in self.blocks:
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextmanager
+def attach_shared(spec: dict,
+                  start: int = 0,
+                  end: int = None):
+    """
+    Attaches to shared blocks and gives zero-copy views of a range of rows. The blocks are
+    closed when the context exits, the views must not be used after it.
+
+    with attach_shared(spec, start, end) as columns:
+        df = pd.DataFrame(columns, copy=False)
+
+    :param spec: Dictionary of column name to (block name, dtype, length), as in SharedColumns.spec
+    :param start: First row of the range
+    :param end: Row after the last row of the range, defaults to the end of the arrays
+
+    :return: Returns a dictionary of column name to numpy array viewing the block
+    """
+
+    blocks = []
+    columns = {}
+    try:
+        for col, (name, dtype, length) in spec.items():
+            block = SharedMemory(name=name)
+            blocks.append(block)
+            columns[col] = np.ndarray((length,), dtype=np.dtype(dtype), buffer=block.buf)[start:end]
+        yield columns
+    finally:
+        columns.clear()
+        for block in blocks:
+            try:
+                block.close()
+            except BufferError:
+                # A view is still referenced, the handle is closed when it is collected
+                pass
+
+
+def _detach(output: pd.DataFrame,
+            views: list):
+    """
+    Utility to copy a result that still holds memory of the shared blocks, so it outlives them.
+    """
+
+    arrays = [output.index.to_numpy()] + [output[col].to_numpy() for col in output.columns]
+    if any(np.may_share_memory(array, view) for array in arrays for view in views):
+        return output.copy(deep=True)
+
+    return output
+
+
+def _encode(values: pd.Series,
+            identifier: bool):
+    """
+    Utility to turn a column into a numpy array that can be shared.
+
+    :return: Returns the array, and the uniques when the column was factorized
+    """
+
+    if not identifier and isinstance(values.dtype, np.dtype) and values.dtype.kind in 'biufM':
+        return values.to_numpy(), None
+
+    codes, uniques = pd.factorize(values, sort=False)
+
+    # Missing identifiers stay missing in the workers, so they are grouped as in memory
+    if identifier and (codes < 0).any():
+        return np.where(codes < 0, np.nan, codes), uniques
+
+    if len(uniques) < np.iinfo(np.int32).max:
+        codes = codes.astype(np.int32)
+
+    return codes, uniques
+
+
+def _decode(codes: np.ndarray,
+            uniques):
+    """
+    Utility to turn identifier codes back into the identifiers, missing codes into missing values.
+    """
+
+    codes = np.where(pd.isna(codes), -1, codes).astype(np.int64)
+
+    return uniques.array.take(codes, allow_fill=True)
+
+
+def _ranges(keys: np.ndarray,
+            n_ranges: int):
+    """
+    Utility to cut sorted keys into about n_ranges contiguous ranges of similar size
+    without splitting the rows of a key.
+    """
+
+    size = len(keys)
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    targets = np.linspace(0, size, n_ranges + 1)[1:-1]
+    found = np.searchsorted(starts, targets)
+    cuts = np.where(found < len(starts), starts[np.minimum(found, len(starts) - 1)], size)
+    cuts = np.unique(np.r_[0, cuts, size])
+
+    return list(zip(cuts[:-1].tolist(), cuts[1:].tolist()))
+
+
+def _run_range(analysis: str,
+               spec: dict,
+               categories: dict,
+               start: int,
+               end: int,
+               kwargs: dict,
+               order_cols):
+    """
+    Runs an entry point on one range of the shared rows. Module level so worker processes can call it.
+    """
+
+    # The entry point runs over views of the blocks, only the text columns are decoded
+    with attach_shared(spec, start, end) as columns:
+        views = list(columns.values())
+        for col, uniques in categories.items():
+            columns[col] = uniques.take(columns[col], allow_fill=True, fill_value=np.nan)
+        df = pd.DataFrame({col: values for col, values in columns.items() if col != ROW_COL}, copy=False)
+
+        output = _entry_point(analysis)(df, **kwargs)
+        if order_cols is None:
+            output = _first_rows(output, df.assign(**{ROW_COL: columns[ROW_COL]}), kwargs)
+
+        # The blocks are closed on exit, nothing may hold their memory past it
+        output = _detach(output, views)
+        del df, views
+
+    return output
+
+
+def run_shared(analysis: str,
+               df: pd.DataFrame,
+               workers: int = 2,
+               n_ranges: int = None,
+               **kwargs):
+    """
+    Runs process_outcomes, smm, apo, or calc_index over patient ranges in worker processes
+    that read their rows from shared memory, and combines the results in the order of the
+    in-memory call. The index of the combined result is renumbered.
+
+    :param analysis: Name of the entry point: 'process_outcomes', 'smm', 'apo', or 'calc_index'
+    :param df: Pandas dataframe passed to the entry point
+    :param workers: Number of worker processes, 1 runs the ranges in this process
+    :param n_ranges: Number of patient ranges, defaults to the number of workers
+    :param kwargs: Arguments of the entry point other than the dataframe
+
+    :return: Returns the combined pandas dataframe
+
+    :raises: KeyError
+        If column names are supplied that are not present in the data.
+    :raises: ValueError
+        If the analysis does not exist
+    """
+
+    _entry_point(analysis)
+    partition_arg, order_args = ENTRY_POINTS[analysis]
+    order_cols = None if order_args is None \
+        else [kwargs.get(arg, arg) for arg in order_args]
+
+    id_cols = [kwargs[arg] for arg in ID_ARGS[analysis]]
+    value_cols = [kwargs[arg] for arg in VALUE_ARGS[analysis] if kwargs.get(arg) is not None]
+    if not set(id_cols + value_cols).issubset(df.columns):
+        raise KeyError(f"Ensure that columns {id_cols + value_cols} are present in the data.")
+
+    # process_outcomes returns every input column of the outcome encounters
+    if analysis == 'process_outcomes':
+        value_cols = [col for col in df.columns if col not in id_cols]
+
+    # Factorize identifiers and text once, the lookups of identifiers never leave this process
+    arrays = {ROW_COL: np.arange(len(df), dtype=np.int64)}
+    id_uniques = {}
+    categories = {}
+    for col in dict.fromkeys(id_cols + value_cols):
+        arrays[col], uniques = _encode(df[col], col in id_cols)
+        if col in id_cols:
+            id_uniques[col] = uniques
+        elif uniques is not None:
+            categories[col] = uniques
+
+    # Rows of a patient are contiguous once sorted, so a worker reads a single slice
+    range_col = kwargs[partition_arg]
+    order = np.argsort(arrays[range_col], kind='stable')
+    keys = arrays[range_col][order]
+    if keys.dtype.kind == 'f':
+        # Missing patients sort last, they are kept together as one key
+        keys = np.where(np.isnan(keys), np.inf, keys)
+    ranges = _ranges(keys, n_ranges or workers) if len(df) else [(0, 0)]
+
+    with SharedColumns(arrays, order) as shared:
+        del arrays
+        tasks = [(analysis, shared.spec, categories, start, end, kwargs, order_cols)
+                 for start, end in ranges]
+        if workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_run_range, *zip(*tasks)))
+        else:
+            results = [_run_range(*task) for task in tasks]
+
+    # Translate the identifier codes back before the in-memory order is restored
+    for output in results:
+        for col, uniques in id_uniques.items():
+            if col in output.columns:
+                output[col] = pd.Series(_decode(output[col].to_numpy(), uniques), index=output.index)
+
+    return _combine(results, order_cols)
@@ -5,3 +5,4 @@ Data is passed into the smm function.
 """
 
 from .smm import smm
+from .postpartum import smm_postpartum
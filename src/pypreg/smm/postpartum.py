@@ -0,0 +1,136 @@
+"""
+SMM over the delivery encounter and the postpartum period
+
+Copyright (C) 2023 Dave Walsh
+
+smm only looks at the codes of the encounters it is given, so morbidity
+coded on a readmission after the delivery is missed. smm_postpartum takes the
+pregnancies found by process_outcomes and the dated codes of every
+encounter, and flags each delivery using the codes of its outcome encounter
+and of any encounter admitted within the postpartum window after the event
+date.
+
+Encounters are placed in the window of a delivery with the sorted interval
+join of assign_pregnancy, a binary search per encounter over the packed
+patient and date keys of the deliveries, so no patient's encounters are
+crossed with their pregnancies.
+
+Available functions
+smm_postpartum : Flags SMM and transfusion per delivery over a postpartum window
+"""
+
+import pandas as pd
+from .smm import smm
+from ..pregnancy_outcome.assign_pregnancy import assign_pregnancy
+from ..pregnancy_outcome.outcome_map import OUTCOME_LIST
+
+# Outcomes of a delivery: live birth, stillbirth, and unknown delivery
+DELIVERIES = OUTCOME_LIST[:3]
+
+# CDC postpartum period for SMM readmissions
+POSTPARTUM_DAYS = 42
+
+PREGNANCY_KEY = '_pypreg_pregnancy'
+
+
+def smm_postpartum(df: pd.DataFrame,
+                   pregnancies: pd.DataFrame,
+                   patient_col: str,
+                   encounter_col: str,
+                   admit_date_col: str,
+                   code_type: str,
+                   version: str,
+                   code: str,
+                   window: int = POSTPARTUM_DAYS,
+                   indicators: bool = False,
+                   preg_col: str = 'preg_num',
+                   event_col: str = 'event_date',
+                   outcome_col: str = 'outcome',
+                   outcomes=DELIVERIES):
+    """
+    Flags SMM and transfusion for each delivery from the codes of the delivery encounter and of
+    the encounters admitted from the event date through window days after it.
+
+    :param df: Pandas dataframe of dated codes, rows should be unique to each CODE
+    :param pregnancies: Pandas dataframe with one row per pregnancy, as returned by process_outcomes
+    :param patient_col: Column containing the unique patient identifier in both dataframes
+    :param encounter_col: Column containing the encounter identifier in both dataframes, in
+        pregnancies this is the outcome encounter
+    :param admit_date_col: Column in df containing the admit date for the encounter
+    :param code_type: Column in df with one of either DX - Diagnosis or PX - Procedure
+    :param version: Column in df with the version of the code, ICD9 or ICD10
+    :param code: Column in df containing the CODE
+    :param window: Number of days after the event date in the postpartum period
+    :param indicators: Optional boolean to return the full slate of indicators
+    :param preg_col: Column in pregnancies containing the pregnancy number
+    :param event_col: Column in pregnancies containing the outcome date
+    :param outcome_col: Column in pregnancies containing the outcome classification
+    :param outcomes: Outcomes that count as deliveries, None to keep every pregnancy
+
+    :return: Returns a pandas dataframe with the patient, pregnancy number, outcome encounter,
+    event date, and the SMM and transfusion flags of every delivery with either, sorted by patient
+    and pregnancy number. Optionally returns the individual indicators.
+
+    :raises: KeyError
+        If column names are supplied that are not present in the data.
+    :raises: ValueError
+        If the window is negative
+    """
+
+    if not {patient_col, encounter_col, admit_date_col, code_type, version, code}.issubset(df.columns):
+        raise KeyError(f"Ensure that columns "
+                       f"{[patient_col, encounter_col, admit_date_col, code_type, version, code]}"
+                       f" are present in the data.")
+
+    if not {patient_col, encounter_col, preg_col, event_col}.issubset(pregnancies.columns):
+        raise KeyError(f"Ensure that columns {[patient_col, encounter_col, preg_col, event_col]}"
+                       f" are present in the pregnancies.")
+
+    if window < 0:
+        raise ValueError('window must not be negative')
+
+    # Keep the deliveries
+    if outcomes is not None and outcome_col in pregnancies.columns:
+        pregnancies = pregnancies[pregnancies[outcome_col].isin(outcomes)]
+    deliveries = pregnancies[[patient_col, preg_col, encounter_col, event_col]]\
+        .drop_duplicates([patient_col, preg_col])
+
+    codes = df[[patient_col, encounter_col, admit_date_col, code_type, version, code]]
+
+    # Codes of the outcome encounter count whatever their admit date
+    delivery_keys = pd.MultiIndex.from_frame(deliveries[[patient_col, encounter_col]])
+    on_delivery = pd.MultiIndex.from_frame(codes[[patient_col, encounter_col]]).isin(delivery_keys)
+    delivery_codes = codes[on_delivery].merge(deliveries[[patient_col, encounter_col, preg_col]],
+                                              how='inner',
+                                              on=[patient_col, encounter_col])
+
+    # Other encounters are placed in the window from the event date through the postpartum days
+    window_codes = assign_pregnancy(codes[~on_delivery],
+                                    deliveries,
+                                    patient_col,
+                                    admit_date_col,
+                                    postpartum=window,
+                                    preg_col=preg_col,
+                                    start_col=event_col,
+                                    end_col=event_col)
+
+    matched = pd.concat([delivery_codes, window_codes], ignore_index=True)
+    keys = matched[[patient_col, preg_col]]
+    matched[PREGNANCY_KEY] = keys.groupby([patient_col, preg_col], sort=False).ngroup()
+
+    output = smm(matched[[PREGNANCY_KEY, code_type, version, code]],
+                 PREGNANCY_KEY,
+                 code_type,
+                 version,
+                 code,
+                 indicators=indicators)
+
+    # Translate the pregnancy key back to the patient and the delivery
+    pregnancy_keys = matched[[PREGNANCY_KEY, patient_col, preg_col]].drop_duplicates(PREGNANCY_KEY)
+    output = pregnancy_keys.merge(output, how='inner', on=PREGNANCY_KEY)\
+        .merge(deliveries, how='left', on=[patient_col, preg_col])\
+        .drop(columns=PREGNANCY_KEY)
+    flag_cols = [col for col in output.columns if col not in deliveries.columns]
+    output = output[[*deliveries.columns, *flag_cols]]
+
+    return output.sort_values([patient_col, preg_col], kind='stable').reset_index(drop=True)
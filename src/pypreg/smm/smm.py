@@ -26,6 +26,51 @@ https://saferbirth.org/wp-content/uploads/Updated-AIM-SMM-Code-List_10152021.xls
 import warnings
 import pandas as pd
 from .smm_mapping import _SMM, TRANSFUSION, ICD9, ICD10
+from ..code_sets import CODE_SET, JOIN, MAP_VERSION, ROW, flag_code_rows, match_code_rows, \
+    registered_code_sets, with_registered_prefixes
+from ..dtypes import CODE_TYPE_DTYPE, VERSION_DTYPE, standard_labels
+from ..instrument import Stages
+from ..provenance import PATTERN_ID, with_pattern_ids
+from ..screen import code_prefixes, screen_codes
+
+# Types can accept a CODE label as dx/diagnosis or px/procedure
+TYPES = dict()
+TYPES['DX'] = ('dx',
+               'diagnosis')
+TYPES['PX'] = ('px',
+               'procedure')
+
+# Versions can accept different coding systems: 9/ICD9, 10/ICD10/ICD10-CM/ICD10-PCS
+VERSIONS = dict()
+VERSIONS['ICD9'] = ("9",
+                    "ICD9")
+VERSIONS['ICD10'] = ("10",
+                     "ICD10",
+                     "ICD10-CM",
+                     "ICD10-PCS")
+
+# Indicator patterns with the code metadata in the dtypes of the standardized data,
+# the indicators keep the order of the code map
+SMM_INDICATORS = _SMM[['indicator', 'smm_type', 'smm_version', 'smm_code']]\
+    .astype({'indicator': pd.CategoricalDtype(_SMM.indicator.drop_duplicates()),
+             'smm_type': CODE_TYPE_DTYPE,
+             'smm_version': VERSION_DTYPE})
+
+# Names of the SMM and transfusion maps among the code sets matched by match_code_rows
+SMM_DX9 = '_pypreg_smm_dx9'
+SMM_DX10 = '_pypreg_smm_dx10'
+SMM_PX = '_pypreg_smm_px'
+SMM_TRANSFUSION = '_pypreg_transfusion'
+
+# Code metadata of the maps in the dtypes of the standardized data
+MAP_COLS = {'smm_type': 'code_type',
+            'smm_version': 'version',
+            'smm_code': 'code'}
+MAP_DTYPES = {'code_type': CODE_TYPE_DTYPE,
+              'version': VERSION_DTYPE}
+
+# Literal prefixes of the SMM and transfusion patterns
+SMM_PREFIXES = code_prefixes([*_SMM.smm_code, *TRANSFUSION.smm_code])
 
 
 def smm(df: pd.DataFrame,
@@ -33,7 +78,10 @@ def smm(df: pd.DataFrame,
         code_type: str,
         version: str,
         code: str,
-        indicators: bool = False):
+        indicators: bool = False,
+        provenance: bool = False,
+        memory_limit: int = None,
+        trace_memory: bool = False):
     """
     Processes a pandas dataframe to indicate if an encounter contained codes consistent with
     Severe Maternal Morbidity(SMM).
@@ -41,7 +89,7 @@ def smm(df: pd.DataFrame,
     :param df: A pandas dataframe that contains at least 4 columns to identify
     the delivery encounter, the code_type of code, the version of the code,
     and the code itself - encounters may exist on multiple lines to account
-    for multiple codes
+    for multiple codes. A pyarrow Table or the path of an Arrow IPC file is also accepted, see arrow_frame
     :param enc_id: Encounter identifier that contains the pregnancy outcome
     :param code_type: One of either DX - Diagnosis or PX - Procedure
     :param version:  Only accepts CODE versions for ICD9 or ICD10
@@ -49,18 +97,48 @@ def smm(df: pd.DataFrame,
     :param code: The DX or PX CODE assigned during that encounter
     :param indicators: Optional boolean to return the full slate of indicators
     and not only SMM and transfusion columns
+    :param provenance: Optional boolean to add smm_pattern_id and transfusion_pattern_id,
+    the first pattern of the published pattern table that flagged the encounter, see pattern_table
+    :param memory_limit: Optional memory budget in bytes. Encounters are processed in chunks
+    sized so the estimated working set stays under the budget, and the chunking is
+    reported in output.attrs['memory'], see run_within
+    :param trace_memory: Optional boolean to trace the allocations of a run with a memory_limit
+    and report their peak in output.attrs['memory'], tracing slows the entry point down
 
     :return: Returns a condensed pandas dataframe with the delivery
     encounter identifier and indicators for SMM and transfusion.
     Optionally returned individualized indicators for each of the 20 other classes that make up SMM.
+    Code sets registered for smm add a column each, see register_code_set.
 
     """
 
+    # Arrow tables and IPC files are screened before any dataframe is made, see arrow_frame
+    if not isinstance(df, pd.DataFrame):
+        from ..arrow import arrow_frame
+        df = arrow_frame('smm', df,
+                         enc_id=enc_id,
+                         code_type=code_type,
+                         version=version,
+                         code=code)
+
     # Error checking to ensure the reported columns are contained in the dataframe
     if not {enc_id, code_type, version, code}.issubset(df.columns):
         raise KeyError(f"Ensure that columns {[enc_id, code_type, version, code]}"
                        f" are present in the data.")
 
+    if memory_limit is not None:
+        from ..budget import run_within
+        return run_within('smm', df, memory_limit,
+                          enc_id=enc_id,
+                          code_type=code_type,
+                          version=version,
+                          code=code,
+                          indicators=indicators,
+                          provenance=provenance,
+                          trace_memory=trace_memory)
+
+    stages = Stages('smm', df)
+
     package_cols = {enc_id: 'encounter_id',
                     version: 'version',
                     code_type: 'code_type',
@@ -68,147 +146,95 @@ def smm(df: pd.DataFrame,
                     }
     restore_cols = {i: j for j, i in package_cols.items()}
 
+    # Work on a copy of the needed columns so the caller's dataframe is left untouched
+    df = df[[enc_id, code_type, version, code]].copy()
+    df.rename(columns=package_cols, inplace=True)
+
     # Refactor the passed column names
     enc_id = package_cols[enc_id]
     version = package_cols[version]
     code_type = package_cols[code_type]
     code = package_cols[code]
 
-    df.rename(columns=package_cols, inplace=True)
-
-    # Types can accept a CODE label as dx/diagnosis or px/procedure
-    types = dict()
-    types['DX'] = ('dx',
-                   'diagnosis')
-    types['PX'] = ('px',
-                   'procedure')
-
-    # Versions can accept different coding systems: 9/ICD9, 10/ICD10/ICD10-CM/ICD10-PCS
-    versions = dict()
-    versions['ICD9'] = ("9",
-                        "ICD9")
-    versions['ICD10'] = ("10",
-                         "ICD10",
-                         "ICD10-CM",
-                         "ICD10-PCS")
-
-    # Make a copy of the dataframe to avoid warnings about working on the original
-    df = df[[enc_id, code_type, version, code]].copy()
-
-    # Check the contents of the Type column and warn user if
-    # the contents don't match the expected types. This doesn't
-    # constitute an error as the dataset could contain valid
-    # codes from other systems for other uses.
-    df[code_type] = df[code_type].str.lower()
-    df_types = set(df[code_type].unique().flat)
-    this_types = set([val for value in types.values() for val in value])
-    if not df_types.issubset(this_types):
-        warnings.warn(f"Some code types ({df_types-this_types}) do not match {this_types}."
+    # Replace Type and Version with their standard forms, the labels are checked once per
+    # distinct value. Labels that don't match the expected types and versions don't
+    # constitute an error as the dataset could contain valid codes from other systems
+    # for other uses, warn the user and leave those rows out.
+    df[code_type], df_types = standard_labels(df[code_type], TYPES, CODE_TYPE_DTYPE,
+                                              lambda labels: labels.str.lower())
+    this_types = set([val for value in TYPES.values() for val in value])
+    if df_types:
+        warnings.warn(f"Some code types ({df_types}) do not match {this_types}."
                       f" Ensure these are not in error.", stacklevel=2)
 
-    # Check the contents of the Version column and warn user
-    # if the contents don't match the expected. This doesn't
-    # constitute an error as the dataset could contain valid
-    # codes from other systems for other uses
-    df[version] = df[version].str.upper()
-    df_versions = set(df[version].unique().flat)
-    this_versions = set([val for value in versions.values() for val in value])
-    if not df_versions.issubset(this_versions):
-        warnings.warn(f"Some code versions ({df_versions-this_versions})"
+    df[version], df_versions = standard_labels(df[version], VERSIONS, VERSION_DTYPE,
+                                               lambda labels: labels.str.upper())
+    this_versions = set([val for value in VERSIONS.values() for val in value])
+    if df_versions:
+        warnings.warn(f"Some code versions ({df_versions})"
                       f" do not match {this_versions}."
                       f" Ensure these are not in error.", stacklevel=2)
 
-    # Convert dictionary to dataframe
-    types = pd.DataFrame.from_dict(types, orient='index').stack().to_frame()
-    types = pd.DataFrame(types[0].values.tolist(),
-                         index=types.index).reset_index().drop('level_1', axis=1)
-    types.columns = [code_type, 'type_match']
-
-    # Convert dictionary to dataframe
-    versions = pd.DataFrame.from_dict(versions, orient='index').stack().to_frame()
-    versions = pd.DataFrame(versions[0].values.tolist(),
-                            index=versions.index).reset_index().drop('level_1', axis=1)
-    versions.columns = [version, 'version_match']
-
-    # Replace Type and Version in the provided dataframe with standard forms
-    df = df.merge(types,
-                  how='inner',
-                  left_on=code_type,
-                  right_on='type_match',
-                  suffixes=('_x', ''))\
-        .merge(versions,
-               how='inner',
-               left_on=version,
-               right_on='version_match',
-               suffixes=('_x', ''))\
-        .drop(columns=[f'{version}_x', 'version_match', f'{code_type}_x', 'type_match'])
+    df = df[df[code_type].notna() & df[version].notna()].reset_index(drop=True)
 
     # Remove decimals from codes
     df[code] = df[code].str.replace(r'\.', '', regex=True)
     # Ensure codes are uppercase
     df[code] = df[code].str.upper()
+    stages.done('standardize', df)
+
+    # Drop the codes that no SMM or transfusion pattern can match before the regex is applied
+    df = df[screen_codes(df[code], with_registered_prefixes(SMM_PREFIXES, 'smm'))]
+    stages.done('screen', df)
 
     # Limit the outcomes regex to their relevant sections to avoid erroneous matches
     dx9_smm, dx10_smm, px_smm = smm_map_version_split()
 
-    # Limit the data to be matched by code_type
-    df_dx = df[df[code_type] == 'DX'].copy().drop_duplicates()
-    df_px = df[df[code_type] == 'PX'].copy().drop_duplicates()
-    df_transfusion = df[df[code_type] == 'PX'].copy().drop_duplicates()
-
-    # Limit the diagnoses by VERSION since these can have overlap
-    df_dx9 = df_dx[df_dx[version] == ICD9].copy()
-    df_dx10 = df_dx[df_dx[version] == ICD10].copy()
-
-    # Apply the regex to the cleaned CODE column
-    df_dx9['regex'] = df_dx9[code].replace(dx9_smm['smm_code'].to_list(),
-                                           dx9_smm['smm_code'].to_list(),
-                                           regex=True)
-    df_dx10['regex'] = df_dx10[code].replace(dx10_smm['smm_code'].to_list(),
-                                             dx10_smm['smm_code'].to_list(),
-                                             regex=True)
-    df_px['regex'] = df_px[code].replace(px_smm['smm_code'].to_list(),
-                                         px_smm['smm_code'].to_list(),
-                                         regex=True)
-    df_transfusion['regex'] = df_transfusion[code].replace(TRANSFUSION['smm_code'].to_list(),
-                                                           TRANSFUSION['smm_code'].to_list(),
-                                                           regex=True)
+    # The SMM, transfusion, and registered code sets are matched in a single pass over the
+    # distinct codes. Each SMM map keeps to its section, as the diagnoses can overlap by version
+    code_sets = {SMM_DX9: dx9_smm,
+                 SMM_DX10: dx10_smm,
+                 SMM_PX: px_smm,
+                 SMM_TRANSFUSION: TRANSFUSION}
+    code_sets = {name: code_map.rename(columns=MAP_COLS).astype(MAP_DTYPES) for name, code_map in code_sets.items()}
+    registered = registered_code_sets('smm')
+    rows = match_code_rows(df, code_type, version, code, {**code_sets, **registered})
+
+    # Diagnoses and registered codes match the patterns of their version, the procedure and
+    # transfusion patterns are matched for either version
+    any_version = rows[CODE_SET].isin([SMM_PX, SMM_TRANSFUSION]).to_numpy()
+    same_version = rows[version].to_numpy(dtype=object) == rows[MAP_VERSION].to_numpy(dtype=object)
+    rows = rows[any_version | same_version].sort_values(ROW, kind='stable')
+
+    def matched_rows(name, flag):
+        """
+        Matched rows of one SMM map with the pattern that matched them as regex and smm_code
+        """
+        found = rows[rows[CODE_SET] == name]
+        return df.iloc[found[ROW].to_numpy()]\
+            .assign(regex=found[JOIN].to_numpy(),
+                    smm_code=found[JOIN].to_numpy(),
+                    **{flag: True})\
+            .drop_duplicates()\
+            .reset_index(drop=True)
 
     # Apply SMM and Transfusion indicators to the pandas df
-    matched_dx9 = df_dx9.merge(dx9_smm[['smm_code', 'smm']],
-                               how='inner',
-                               left_on='regex',
-                               right_on='smm_code',
-                               suffixes=('', '_x'))
-    matched_dx10 = df_dx10.merge(dx10_smm[['smm_code', 'smm']],
-                                 how='inner',
-                                 left_on='regex',
-                                 right_on='smm_code',
-                                 suffixes=('', '_x'))
-    matched_px = df_px.merge(px_smm[['smm_code', 'smm']],
-                             how='inner',
-                             left_on='regex',
-                             right_on='smm_code',
-                             suffixes=('', '_x'))
-    matched_transfusion = df_transfusion.merge(TRANSFUSION[['smm_code', 'transfusion']],
-                                               how='inner',
-                                               left_on='regex',
-                                               right_on='smm_code',
-                                               suffixes=('', '_x'))
+    matched_dx9 = matched_rows(SMM_DX9, 'smm')
+    matched_dx10 = matched_rows(SMM_DX10, 'smm')
+    matched_px = matched_rows(SMM_PX, 'smm')
+    matched_transfusion = matched_rows(SMM_TRANSFUSION, 'transfusion')
 
     smm_encs = pd.concat([matched_dx9,
                           matched_dx10,
                           matched_px])
+    stages.done('match', smm_encs)
 
     # If the user wants a reporting of each indicator in addition to SMM and TRANSFUSION
     if indicators:
         # Join the SMM panda again, but keep the indicator column.
         # This may result in an indicator not being present in the
         # final output as it's not present in the data
-        matched_dx9_indicators = matched_dx9.merge(_SMM[['indicator',
-                                                         'smm_type',
-                                                         'smm_version',
-                                                         'smm_code']],
+        matched_dx9_indicators = matched_dx9.merge(SMM_INDICATORS,
                                                    # right merge to keep all indicator columns
                                                    how='right',
                                                    left_on=[code_type,
@@ -217,10 +243,7 @@ def smm(df: pd.DataFrame,
                                                    right_on=['smm_type',
                                                              'smm_version',
                                                              'smm_code']).dropna()
-        matched_dx10_indicators = matched_dx10.merge(_SMM[['indicator',
-                                                           'smm_type',
-                                                           'smm_version',
-                                                           'smm_code']],
+        matched_dx10_indicators = matched_dx10.merge(SMM_INDICATORS,
                                                      # right merge to keep all indicator columns
                                                      how='right',
                                                      left_on=[code_type,
@@ -229,10 +252,7 @@ def smm(df: pd.DataFrame,
                                                      right_on=['smm_type',
                                                                'smm_version',
                                                                'smm_code']).dropna()
-        matched_px_indicators = matched_px.merge(_SMM[['indicator',
-                                                       'smm_type',
-                                                       'smm_version',
-                                                       'smm_code']],
+        matched_px_indicators = matched_px.merge(SMM_INDICATORS,
                                                  # right merge to keep all indicator columns
                                                  how='right',
                                                  left_on=[code_type,
@@ -246,34 +266,34 @@ def smm(df: pd.DataFrame,
                                           index=[enc_id, code],
                                           columns='indicator',
                                           values='smm') \
+            .notna() \
             .reset_index(names=[enc_id, code]) \
-            .drop(columns=code) \
-            .fillna(False)
+            .drop(columns=code)
         matched_dx10_indicators = pd.pivot(matched_dx10_indicators,
                                            index=[enc_id, code],
                                            columns='indicator',
                                            values='smm') \
+            .notna() \
             .reset_index(names=[enc_id, code]) \
-            .drop(columns=code) \
-            .fillna(False)
+            .drop(columns=code)
         matched_px_indicators = pd.pivot(matched_px_indicators,
                                          index=[enc_id, code],
                                          columns='indicator',
                                          values='smm') \
+            .notna() \
             .reset_index(names=[enc_id, code]) \
-            .drop(columns=code) \
-            .fillna(False)
+            .drop(columns=code)
 
         indicators = pd.concat([matched_dx9_indicators,
                                 matched_dx10_indicators,
-                                matched_px_indicators]).fillna(False)
-        # Aggregate the rows down to one
-        indicators = indicators.groupby(enc_id).agg(lambda x: any(x))
+                                matched_px_indicators])
+        # Aggregate the rows down to one, indicators missing from a version are skipped
+        indicators = indicators.groupby(enc_id).any()
 
-        # Ensure all indicators are present
-        indicator_list = _SMM.indicator.drop_duplicates().to_list()
-        col_list = list(set().union(indicators.columns, indicator_list))
-        indicators = indicators.reindex(columns=col_list, fill_value=False)
+        # Ensure all indicators are present, in the order of the code map so every
+        # call returns the same columns in the same order
+        indicator_list = SMM_INDICATORS.indicator.cat.categories.to_list()
+        indicators = indicators.reindex(columns=indicator_list, fill_value=False)
 
         # Join the indicator data back to the SMM data
         smm_encs = smm_encs.merge(indicators,
@@ -281,20 +301,49 @@ def smm(df: pd.DataFrame,
                                   left_on=enc_id,
                                   right_index=True)
         smm_encs.index.name = None
+        stages.done('indicators', smm_encs)
 
     # Prep the output data
-    warnings.simplefilter('ignore', category=FutureWarning)
     output_df = smm_encs.merge(matched_transfusion[[enc_id, 'transfusion']],
                                how='outer',
                                left_on=enc_id,
                                right_on=enc_id)
-    warnings.simplefilter('always')
-    output_df.fillna(False, inplace=True)
-    output_df['transfusion'] = output_df['transfusion'].astype(bool)
+
+    # Registered code sets add their flags from the same pass, encounters only they flag are added
+    if registered:
+        output_df = output_df.merge(flag_code_rows(df, [enc_id],
+                                                   rows[rows[CODE_SET].isin(list(registered))],
+                                                   list(registered)),
+                                    how='outer',
+                                    on=enc_id)
     output_df.drop(columns=[code, version, code_type, 'smm_code', 'regex'], inplace=True)
+
+    # Encounters found by only one side of the merge are missing the other side's flags
+    flag_cols = output_df.columns.drop(enc_id)
+    output_df[flag_cols] = output_df[flag_cols].astype('boolean').fillna(False).astype(bool)
     output_df.drop_duplicates(inplace=True)
 
+    # Look up the id of each matched pattern, the first one found for an encounter is kept
+    if provenance:
+        smm_patterns = pd.concat([matched.merge(with_pattern_ids(smm_map, 'smm', 'smm_type', 'smm_version',
+                                                                 'smm_code', 'indicator')[['smm_code', PATTERN_ID]],
+                                                how='inner',
+                                                on='smm_code')
+                                  for matched, smm_map in [(matched_dx9, dx9_smm),
+                                                           (matched_dx10, dx10_smm),
+                                                           (matched_px, px_smm)]])\
+            .groupby(enc_id)[PATTERN_ID].min()
+        transfusion_patterns = matched_transfusion\
+            .merge(with_pattern_ids(TRANSFUSION, 'transfusion', 'smm_type', 'smm_version',
+                                    'smm_code')[['smm_code', PATTERN_ID]],
+                   how='inner',
+                   on='smm_code')\
+            .groupby(enc_id)[PATTERN_ID].min()
+        output_df['smm_pattern_id'] = output_df[enc_id].map(smm_patterns).astype('Int32')
+        output_df['transfusion_pattern_id'] = output_df[enc_id].map(transfusion_patterns).astype('Int32')
+
     output_df.rename(columns=restore_cols, inplace=True)
+    stages.done('output', output_df)
 
     return output_df
 
@@ -0,0 +1,14 @@
+"""
+This module generates SQL so that code classification, severe maternal morbidity,
+adverse pregnancy outcomes, and obstetric comorbidity scoring can run inside
+a DuckDB or SQLite database next to the data.
+
+connect opens a database file and loads the code sets as lookup tables
+create_code_tables loads the lookup tables into an existing connection
+outcome_sql, smm_sql, apo_sql, index_sql return a SELECT statement for each analysis
+run_sql runs a statement and returns a pandas dataframe
+"""
+
+from .code_tables import create_code_tables
+from .connection import connect, run_sql
+from .generate import outcome_sql, smm_sql, apo_sql, index_sql
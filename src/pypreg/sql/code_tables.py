@@ -0,0 +1,302 @@
+"""
+Lookup tables for running the pypreg code sets inside a database.
+
+Copyright (C) 2023 Dave Walsh
+
+The regular expressions from the mapping modules are flattened into a single
+pattern table. Each pattern carries the bucket it is matched within, its rank
+in that bucket (the first matching pattern wins, as it does for the pandas
+implementation), and the literal prefix every matching code must start with.
+The prefix allows the database to discard most code/pattern pairs with a
+cheap string comparison before the regular expression is evaluated.
+"""
+
+import re
+import sqlite3
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+PATTERN_TABLE = 'pypreg_patterns'
+TYPE_TABLE = 'pypreg_code_types'
+VERSION_TABLE = 'pypreg_versions'
+WEIGHT_TABLE = 'pypreg_weights'
+
+PATTERN_COLUMNS = ['code_set',
+                   'bucket_type',
+                   'bucket_version',
+                   'code_type',
+                   'version',
+                   'schema',
+                   'label',
+                   'pattern',
+                   'pattern_rank',
+                   'prefix']
+
+# Characters that end the literal prefix of a regular expression
+_REGEX_SYNTAX = set('.^$*+?{}[]()|\\')
+_QUANTIFIERS = set('*+?{')
+
+
+def literal_prefix(pattern: str):
+    """
+    Utility to find the literal characters every match of a pattern must start with.
+
+    :param pattern: Regular expression as written in the mapping modules
+
+    :return: Returns the literal prefix, an empty string if there is none
+    """
+
+    # A top level alternation can start with anything
+    depth = 0
+    for char in pattern:
+        if char == '\\':
+            return ''
+        if char in '([':
+            depth += 1
+        elif char in ')]':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return ''
+
+    prefix = ''
+    body = pattern[1:] if pattern.startswith('^') else pattern
+    for char in body:
+        if char in _REGEX_SYNTAX:
+            # A quantified character is optional, it can't be part of the prefix
+            if char in _QUANTIFIERS and prefix:
+                prefix = prefix[:-1]
+            break
+        prefix += char
+
+    return prefix
+
+
+def _code_set(map_df: pd.DataFrame,
+              code_set: str,
+              type_col: str,
+              version_col: str,
+              pattern_col: str,
+              label_col: str = None,
+              label: str = None,
+              schema_col: str = None,
+              bucket_type: bool = True,
+              bucket_version=None):
+    """
+    Utility to convert one of the package code maps to the pattern table layout.
+
+    :param map_df: pandas dataframe of the code map
+    :param code_set: Name given to the code set in the pattern table
+    :param type_col: Column containing the code type, None if the map only has diagnoses
+    :param version_col: Column containing the code version
+    :param pattern_col: Column containing the regular expression
+    :param label_col: Column containing the label attached by a match
+    :param label: Fixed label used when the map has no label column
+    :param schema_col: Column containing the code schema, if any
+    :param bucket_type: Patterns are only compared to codes of the same type
+    :param bucket_version: Collection of code types whose patterns are only compared
+        to codes of the same version
+
+    :return: Returns a pandas dataframe with the pattern table columns
+    """
+
+    map_df = map_df[map_df[pattern_col].notna()].reset_index(drop=True)
+
+    output = pd.DataFrame({'code_set': code_set,
+                           'code_type': map_df[type_col] if type_col else 'DX',
+                           'version': map_df[version_col],
+                           'schema': map_df[schema_col] if schema_col else None,
+                           'label': map_df[label_col] if label_col else label,
+                           'pattern': map_df[pattern_col]})
+
+    output['bucket_type'] = output['code_type'] if bucket_type else None
+    output['bucket_version'] = None
+    if bucket_version:
+        versioned = output['code_type'].isin(bucket_version)
+        output.loc[versioned, 'bucket_version'] = output.loc[versioned, 'version']
+
+    # Patterns are tried in map order, the same text always gets the same rank
+    bucket = [output['bucket_type'].fillna(''),
+              output['bucket_version'].fillna(''),
+              output['pattern']]
+    output['pattern_rank'] = output.groupby(bucket, sort=False).ngroup() + 1
+    output['prefix'] = output['pattern'].map(literal_prefix)
+
+    return output[PATTERN_COLUMNS]
+
+
+def code_set_table():
+    """
+    Flattens every code map in the package into a single table of patterns.
+
+    Patterns are matched within a bucket: a code type and, for the code sets
+    that split diagnoses by version, a version. Within a bucket the lowest
+    ranked matching pattern is the match for a code.
+
+    :return: Returns a pandas dataframe with one row per pattern and label, numbered
+        by the pattern_id column in table order
+    """
+
+    from ..pregnancy_outcome.outcome_map import OUTCOMES
+    from ..smm.smm_mapping import _SMM, TRANSFUSION
+    from ..adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import APO_MAPS
+    from ..obstetric_comorbidity.bateman_mapping import BATEMAN_MAP
+    from ..obstetric_comorbidity.leonard_mapping import LEONARD_MAP
+
+    tables = [_code_set(OUTCOMES, 'outcome', 'code_type', 'version', 'code',
+                        label_col='outcome', schema_col='schema', bucket_version=['DX']),
+              _code_set(_SMM, 'smm', 'smm_type', 'smm_version', 'smm_code',
+                        label_col='indicator', bucket_version=['DX']),
+              _code_set(TRANSFUSION, 'transfusion', 'smm_type', 'smm_version', 'smm_code',
+                        label='transfusion')]
+
+    # Each adverse outcome is matched against its whole map
+    for apo_name, apo_map in APO_MAPS.items():
+        tables.append(_code_set(apo_map, apo_name, 'code_type', 'version', 'code',
+                                label=apo_name, bucket_type=False))
+
+    # Only one version is scored by each index
+    tables.append(_code_set(BATEMAN_MAP, 'bateman', None, 'version', 'code',
+                            label_col='indicator', bucket_type=False))
+    tables.append(_code_set(LEONARD_MAP, 'leonard', None, 'version', 'code',
+                            label_col='indicator', bucket_type=False))
+
+    output = pd.concat(tables, ignore_index=True)
+    output.insert(0, 'pattern_id', np.arange(len(output), dtype=np.int32))
+
+    return output
+
+
+def synonym_table(synonyms: dict,
+                  entry: str,
+                  standard_col: str):
+    """
+    Utility to convert a dictionary of accepted spellings into rows.
+
+    :param synonyms: Dictionary keyed by the standard form with a tuple of accepted spellings
+    :param entry: Name of the entry point that accepts the spellings
+    :param standard_col: Name of the column that holds the standard form
+
+    :return: Returns a pandas dataframe with entry, synonym, and standard form columns
+    """
+
+    rows = [(entry, synonym, standard)
+            for standard, accepted in synonyms.items()
+            for synonym in accepted]
+
+    return pd.DataFrame(rows, columns=['entry', 'synonym', standard_col])
+
+
+def weight_table():
+    """
+    Collects the Bateman and Leonard weights for each indicator and age category.
+
+    :return: Returns a pandas dataframe with method, indicator, weight,
+        and weight_nontransfusion columns
+    """
+
+    from ..obstetric_comorbidity.bateman_mapping import BATEMAN_MAP
+    from ..obstetric_comorbidity.leonard_mapping import LEONARD_MAP
+
+    bateman = BATEMAN_MAP[['indicator', 'weight']].drop_duplicates()
+    bateman = bateman.assign(method='bateman', weight_nontransfusion=bateman['weight'])
+
+    leonard = LEONARD_MAP[['indicator', 'smm score', 'non-transfusion smm score']]\
+        .drop_duplicates()\
+        .rename(columns={'smm score': 'weight',
+                         'non-transfusion smm score': 'weight_nontransfusion'})
+    leonard = leonard.assign(method='leonard')
+
+    output = pd.concat([bateman, leonard], ignore_index=True)
+
+    return output[['method', 'indicator', 'weight', 'weight_nontransfusion']]
+
+
+@lru_cache(maxsize=4096)
+def _compile(pattern: str):
+    return re.compile(pattern)
+
+
+def regexp_full_match(code, pattern):
+    """
+    SQLite implementation of the DuckDB regexp_full_match function.
+
+    :param code: Code to test
+    :param pattern: Regular expression
+
+    :return: Returns True if the whole code matches, None if either argument is NULL
+    """
+
+    if code is None or pattern is None:
+        return None
+
+    return _compile(pattern).fullmatch(code) is not None
+
+
+def _create_table(con, name: str, df: pd.DataFrame, types: dict):
+    """
+    Utility to replace a table in the connection with the contents of a dataframe.
+    Only DB-API calls shared by DuckDB and SQLite are used.
+    """
+
+    con.execute(f'DROP TABLE IF EXISTS {name}')
+    columns = ', '.join(f'{column} {types[column]}' for column in df.columns)
+    con.execute(f'CREATE TABLE {name} ({columns})')
+
+    # NaN is not NULL for a database
+    rows = [tuple(None if pd.isna(value) else value for value in row)
+            for row in df.itertuples(index=False, name=None)]
+    placeholders = ', '.join('?' for _ in df.columns)
+    if rows:
+        con.executemany(f'INSERT INTO {name} VALUES ({placeholders})', rows)
+
+
+def create_code_tables(con):
+    """
+    Loads the lookup tables used by the generated SQL into a database connection.
+    SQLite connections also receive the regexp_full_match function used for matching.
+
+    :param con: Open DuckDB or sqlite3 connection
+
+    :return: Returns the connection
+    """
+
+    from ..pregnancy_outcome.process_outcome import TYPES as OUTCOME_TYPES
+    from ..pregnancy_outcome.process_outcome import VERSIONS as OUTCOME_VERSIONS
+    from ..smm.smm import TYPES as SMM_TYPES
+    from ..smm.smm import VERSIONS as SMM_VERSIONS
+    from ..adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import TYPES as APO_TYPES
+    from ..adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import VERSIONS as APO_VERSIONS
+    from ..obstetric_comorbidity.obstetric_index import VERSIONS as INDEX_VERSIONS
+
+    if isinstance(con, sqlite3.Connection):
+        con.create_function('regexp_full_match', 2, regexp_full_match, deterministic=True)
+
+    text = 'VARCHAR'
+    integer = 'INTEGER'
+
+    pattern_types = {column: text for column in PATTERN_COLUMNS}
+    pattern_types['pattern_id'] = integer
+    pattern_types['pattern_rank'] = integer
+    _create_table(con, PATTERN_TABLE, code_set_table(), pattern_types)
+
+    types = pd.concat([synonym_table(OUTCOME_TYPES, 'process_outcomes', 'code_type'),
+                       synonym_table(SMM_TYPES, 'smm', 'code_type'),
+                       synonym_table(APO_TYPES, 'apo', 'code_type')],
+                      ignore_index=True)
+    _create_table(con, TYPE_TABLE, types,
+                  {'entry': text, 'synonym': text, 'code_type': text})
+
+    versions = pd.concat([synonym_table(OUTCOME_VERSIONS, 'process_outcomes', 'version'),
+                          synonym_table(SMM_VERSIONS, 'smm', 'version'),
+                          synonym_table(APO_VERSIONS, 'apo', 'version'),
+                          synonym_table(INDEX_VERSIONS, 'calc_index', 'version')],
+                         ignore_index=True)
+    _create_table(con, VERSION_TABLE, versions,
+                  {'entry': text, 'synonym': text, 'version': text})
+
+    _create_table(con, WEIGHT_TABLE, weight_table(),
+                  {'method': text, 'indicator': text,
+                   'weight': integer, 'weight_nontransfusion': integer})
+
+    return con
@@ -0,0 +1,69 @@
+"""
+Utilities to open a database for the generated SQL and read results back.
+
+Copyright (C) 2023 Dave Walsh
+
+DuckDB is used when it is installed, SQLite from the standard library is
+always available. Both connections are used through the DB-API calls they
+share so the generated SQL runs unchanged on either.
+"""
+
+import sqlite3
+import pandas as pd
+from .code_tables import create_code_tables
+
+ENGINES = ['duckdb', 'sqlite']
+
+
+def connect(database: str = ':memory:',
+            engine: str = 'duckdb'):
+    """
+    Opens a DuckDB or SQLite database and loads the pypreg lookup tables into it.
+
+    :param database: Path to the database file, defaults to an in-memory database
+    :param engine: Choice of 'duckdb' or 'sqlite'
+
+    :return: Returns the open connection
+
+    :raises: ValueError
+        Given engine does not exist
+    :raises: ImportError
+        DuckDB is requested but is not installed
+    """
+
+    engine = engine.lower()
+
+    if engine not in ENGINES:
+        raise ValueError(f'Engine must be one of {ENGINES}')
+
+    if engine == 'duckdb':
+        try:
+            import duckdb
+        except ImportError as err:
+            raise ImportError("The duckdb engine requires the duckdb package. "
+                              "Install it with 'pip install pypreg[duckdb]' "
+                              "or use engine='sqlite'.") from err
+        con = duckdb.connect(database)
+    else:
+        con = sqlite3.connect(database, check_same_thread=False)
+
+    return create_code_tables(con)
+
+
+def run_sql(con, sql: str):
+    """
+    Runs a generated statement and collects the result.
+
+    SQLite has no boolean type, boolean columns are returned as 0/1 integers.
+
+    :param con: Connection returned by connect, or any DuckDB or sqlite3
+        connection the lookup tables were loaded into
+    :param sql: SQL text
+
+    :return: Returns a pandas dataframe with the query result
+    """
+
+    cursor = con.execute(sql)
+    columns = [column[0] for column in cursor.description]
+
+    return pd.DataFrame(cursor.fetchall(), columns=columns)
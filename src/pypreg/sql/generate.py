@@ -0,0 +1,422 @@
+"""
+SQL generation for in-database execution.
+
+Copyright (C) 2023 Dave Walsh
+
+Each function mirrors one of the package entry points and returns a SELECT
+statement that produces the same output when run against a table of codes in
+DuckDB or SQLite. The statements rely on the lookup tables loaded by
+create_code_tables. Codes are matched once per distinct code: the lowest ranked
+pattern in the code's bucket is found first and its labels are then attached
+to every row carrying that code.
+
+Available functions
+outcome_sql : Classifies codes to pregnancy outcomes, the equivalent of attach_map
+smm_sql : Severe maternal morbidity and transfusion by encounter
+apo_sql : Adverse pregnancy outcomes by patient and pregnancy
+index_sql : Bateman or Leonard obstetric comorbidity scores by patient and pregnancy
+"""
+
+from .code_tables import PATTERN_TABLE, TYPE_TABLE, VERSION_TABLE, WEIGHT_TABLE
+
+
+def _quote(name: str):
+    """
+    Utility to quote a column name as an SQL identifier.
+    """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _literal(value: str):
+    """
+    Utility to quote a value as an SQL string literal.
+    """
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _match_ctes(name: str,
+                code_set: str,
+                same_type: bool = False,
+                same_version: bool = False,
+                expanded: bool = True):
+    """
+    Utility to build the common table expressions that match the distinct codes of
+    the source CTE against one code set.
+
+    {name}_hits holds the rank of the first matching pattern for each distinct code,
+    {name}_labels holds every label attached to that pattern.
+
+    :param name: Prefix for the names of the common table expressions
+    :param code_set: Code set in the pattern table to match against
+    :param same_type: Labels are only kept when the pattern has the same code type as the code
+    :param same_version: Labels are only kept when the pattern has the same version as the code
+    :param expanded: Include patterns from the EXPANDED schema
+
+    :return: Returns the SQL text of the two common table expressions
+    """
+
+    pattern_filter = f"p.code_set = {_literal(code_set)}"
+    if not expanded:
+        pattern_filter += " AND COALESCE(p.schema, '') <> 'EXPANDED'"
+
+    bucket = ("(p.bucket_type IS NULL OR p.bucket_type = {0}.code_type)"
+              " AND (p.bucket_version IS NULL OR p.bucket_version = {0}.version)")
+
+    label_filter = ''
+    if same_type:
+        label_filter += ' AND p.code_type = h.code_type'
+    if same_version:
+        label_filter += ' AND p.version = h.version'
+
+    return f"""{name}_hits AS (
+    SELECT c.code_type, c.version, c.match_code, MIN(p.pattern_rank) AS pattern_rank
+    FROM (SELECT DISTINCT code_type, version, match_code FROM source) AS c
+    JOIN {PATTERN_TABLE} AS p
+        ON {pattern_filter}
+        AND {bucket.format('c')}
+        AND SUBSTR(c.match_code, 1, LENGTH(p.prefix)) = p.prefix
+        AND regexp_full_match(c.match_code, p.pattern)
+    GROUP BY c.code_type, c.version, c.match_code
+),
+{name}_labels AS (
+    SELECT DISTINCT h.code_type, h.version, h.match_code, p.label
+    FROM {name}_hits AS h
+    JOIN {PATTERN_TABLE} AS p
+        ON {pattern_filter}
+        AND {bucket.format('h')}
+        AND p.pattern_rank = h.pattern_rank{label_filter}
+)"""
+
+
+def _standardize(entry: str, column: str, lookup: str, standard: str, case: str):
+    """
+    Utility to join a column to its table of accepted spellings.
+    """
+    return (f"JOIN {lookup} AS {standard}_match"
+            f" ON {standard}_match.entry = {_literal(entry)}"
+            f" AND {standard}_match.synonym = {case}(d.{_quote(column)})")
+
+
+def outcome_sql(table: str,
+                patient_col: str,
+                encounter_col: str,
+                admit_date_col: str,
+                version_col: str,
+                type_col: str,
+                code_col: str,
+                expanded: bool = False):
+    """
+    Generates SQL that classifies each code to a pregnancy outcome. This is the
+    matching step of process_outcomes; the longitudinal validation of the
+    outcomes is left to process_outcomes.
+
+    :param table: Table, view, or table function that holds the encounter data
+    :param patient_col: Column containing the unique patient identifier
+    :param encounter_col: Column containing the encounter identifier
+    :param admit_date_col: Column containing the admit date for the encounter
+    :param version_col: Column containing the coding system for the provided CODE
+    :param type_col: Column containing if the CODE describes a PROCEDURE, DIAGNOSIS, or DRG
+    :param code_col: Column containing the CODE
+    :param expanded: Boolean flag to include the codes added by the author
+
+    :return: Returns the SQL text. The query returns one row per distinct classified code
+    with the provided column names and the outcome classification.
+    """
+
+    return f"""WITH source AS (
+    SELECT DISTINCT
+        d.{_quote(patient_col)} AS group_id,
+        d.{_quote(encounter_col)} AS encounter_id,
+        d.{_quote(admit_date_col)} AS admit,
+        code_type_match.code_type AS code_type,
+        version_match.version AS version,
+        d.{_quote(code_col)} AS code,
+        REPLACE(d.{_quote(code_col)}, '.', '') AS match_code
+    FROM {table} AS d
+    {_standardize('process_outcomes', type_col, TYPE_TABLE, 'code_type', 'LOWER')}
+    {_standardize('process_outcomes', version_col, VERSION_TABLE, 'version', 'UPPER')}
+),
+{_match_ctes('outcome', 'outcome', expanded=expanded)}
+SELECT DISTINCT
+    s.group_id AS {_quote(patient_col)},
+    s.encounter_id AS {_quote(encounter_col)},
+    s.admit AS {_quote(admit_date_col)},
+    s.code_type AS {_quote(type_col)},
+    s.version AS {_quote(version_col)},
+    s.code AS {_quote(code_col)},
+    l.label AS outcome
+FROM source AS s
+JOIN outcome_labels AS l
+    ON l.code_type = s.code_type
+    AND l.version = s.version
+    AND l.match_code = s.match_code
+"""
+
+
+def smm_sql(table: str,
+            enc_id: str,
+            code_type: str,
+            version: str,
+            code: str,
+            indicators: bool = False):
+    """
+    Generates SQL that indicates if an encounter contained codes consistent with
+    Severe Maternal Morbidity(SMM) and transfusion.
+
+    :param table: Table, view, or table function that holds the encounter data
+    :param enc_id: Encounter identifier that contains the pregnancy outcome
+    :param code_type: One of either DX - Diagnosis or PX - Procedure
+    :param version: Only accepts CODE versions for ICD9 or ICD10
+    :param code: The DX or PX CODE assigned during that encounter
+    :param indicators: Optional boolean to return the full slate of indicators
+
+    :return: Returns the SQL text. The query returns one row for each encounter with
+    SMM or transfusion present.
+    """
+
+    from ..smm.smm_mapping import _SMM
+
+    flags = ['smm', 'transfusion']
+    labels = """
+    UNION ALL
+    SELECT s.encounter_id, l.label
+    FROM source AS s
+    JOIN smm_labels AS l
+        ON l.code_type = s.code_type AND l.version = s.version AND l.match_code = s.match_code"""
+    if indicators:
+        flags += _SMM['indicator'].drop_duplicates().to_list()
+    else:
+        labels = ''
+
+    columns = ',\n    '.join(f"MAX(CASE WHEN label = {_literal(flag)} THEN 1 ELSE 0 END) = 1"
+                             f" AS {_quote(flag)}" for flag in flags)
+
+    return f"""WITH source AS (
+    SELECT DISTINCT
+        d.{_quote(enc_id)} AS encounter_id,
+        code_type_match.code_type AS code_type,
+        version_match.version AS version,
+        UPPER(REPLACE(d.{_quote(code)}, '.', '')) AS match_code
+    FROM {table} AS d
+    {_standardize('smm', code_type, TYPE_TABLE, 'code_type', 'LOWER')}
+    {_standardize('smm', version, VERSION_TABLE, 'version', 'UPPER')}
+),
+{_match_ctes('smm', 'smm', same_type=True, same_version=True)},
+{_match_ctes('transfusion', 'transfusion')},
+flags AS (
+    SELECT s.encounter_id, 'smm' AS label
+    FROM source AS s
+    JOIN smm_hits AS h
+        ON h.code_type = s.code_type AND h.version = s.version AND h.match_code = s.match_code
+    UNION ALL
+    SELECT s.encounter_id, 'transfusion' AS label
+    FROM source AS s
+    JOIN transfusion_hits AS h
+        ON h.code_type = s.code_type AND h.version = s.version AND h.match_code = s.match_code{labels}
+)
+SELECT
+    encounter_id AS {_quote(enc_id)},
+    {columns}
+FROM flags
+GROUP BY encounter_id
+"""
+
+
+def apo_sql(table: str,
+            patient_id: str,
+            preg_id: str,
+            code_type: str,
+            version: str,
+            code: str):
+    """
+    Generates SQL that identifies the adverse pregnancy outcomes for each pregnancy.
+
+    :param table: Table, view, or table function that holds the encounter data
+    :param patient_id: Column containing the unique patient identifier
+    :param preg_id: Column containing the pregnancy identifier
+    :param code_type: Column containing if the CODE describes a procedure, diagnosis, or DRG
+    :param version: Column containing the coding system for the provided CODE
+    :param code: Column containing the CODE
+
+    :return: Returns the SQL text. The query returns one row per pregnancy with a
+    column for each adverse pregnancy outcome.
+    """
+
+    from ..adverse_pregnancy_outcomes.adverse_pregnancy_outcomes import APO_MAPS
+
+    matches = []
+    flags = []
+    for idx, apo_name in enumerate(APO_MAPS):
+        matches.append(_match_ctes(f'apo{idx}', apo_name, same_type=True, same_version=True))
+        flags.append(f"""SELECT s.patient_id, s.preg_id, l.label
+    FROM source AS s
+    JOIN apo{idx}_labels AS l
+        ON l.code_type = s.code_type AND l.version = s.version AND l.match_code = s.match_code""")
+
+    matches = ',\n'.join(matches)
+    flags = '\n    UNION ALL\n    '.join(flags)
+    columns = ',\n    '.join(f"COALESCE(MAX(CASE WHEN f.label = {_literal(apo_name)}"
+                             f" THEN 1 ELSE 0 END), 0) = 1 AS {_quote(apo_name)}"
+                             for apo_name in APO_MAPS)
+
+    return f"""WITH source AS (
+    SELECT DISTINCT
+        d.{_quote(patient_id)} AS patient_id,
+        d.{_quote(preg_id)} AS preg_id,
+        code_type_match.code_type AS code_type,
+        version_match.version AS version,
+        UPPER(REPLACE(d.{_quote(code)}, '.', '')) AS match_code
+    FROM {table} AS d
+    {_standardize('apo', code_type, TYPE_TABLE, 'code_type', 'LOWER')}
+    {_standardize('apo', version, VERSION_TABLE, 'version', 'UPPER')}
+),
+{matches},
+flags AS (
+    {flags}
+)
+SELECT
+    p.patient_id AS {_quote(patient_id)},
+    p.preg_id AS {_quote(preg_id)},
+    {columns}
+FROM (SELECT DISTINCT patient_id, preg_id FROM source) AS p
+LEFT JOIN flags AS f
+    ON f.patient_id = p.patient_id AND f.preg_id = p.preg_id
+GROUP BY p.patient_id, p.preg_id
+"""
+
+
+def _age_category(method: str):
+    """
+    Utility to build the CASE expression that assigns the age category for a method.
+    """
+
+    from ..obstetric_comorbidity.attach_map import AGE_BINS
+    from ..obstetric_comorbidity.bateman_mapping import AGE_CATEGORY as bateman_categories
+    from ..obstetric_comorbidity.leonard_mapping import AGE_CATEGORY as leonard_categories
+
+    labels = bateman_categories if method == 'bateman' else leonard_categories
+    bins = AGE_BINS[method]
+
+    cases = ' '.join(f"WHEN age > {low} AND age <= {high} THEN {_literal(label)}"
+                     for low, high, label in zip(bins[:-1], bins[1:], labels))
+
+    return f"CASE {cases} END"
+
+
+def index_sql(table: str,
+              patient_col: str,
+              pregnancy_col: str,
+              code_col: str,
+              version_col: str,
+              method: str,
+              age_col: str = None):
+    """
+    Generates SQL that calculates the Bateman or Leonard obstetric comorbidity index.
+
+    :param table: Table, view, or table function that holds the encounter data
+    :param patient_col: column that gives the patient identifier
+    :param pregnancy_col: column that gives the pregnancy identifier
+    :param code_col: column that gives the diagnostic codes
+    :param version_col: column that indicates if the given diagnostic code is ICD9 or ICD10.
+    :param method: Choice of 'leonard' or 'bateman' for obstetric index scores
+    :param age_col: Optional column that gives the age of the patient
+
+    :return: Returns the SQL text. The query returns the total index score for each
+    patient's pregnancy.
+
+    :raises: ValueError
+        Given method does not exist
+    """
+
+    from ..obstetric_comorbidity.bateman_mapping import BATEMAN_MAP
+
+    methods = ['leonard', 'bateman']
+    method = method.lower()
+
+    if method not in methods:
+        raise ValueError(f'Method must be one of {methods}')
+
+    # Bateman is scored from ICD9 codes, Leonard from ICD10 codes
+    version = 'ICD9' if method == 'bateman' else 'ICD10'
+
+    age = f"d.{_quote(age_col)}" if age_col else 'NULL'
+    age_rows = ''
+    if age_col:
+        aggregate = 'MIN' if method == 'bateman' else 'MAX'
+        age_rows = f"""
+    UNION
+    SELECT group_id, preg_num, {_age_category(method)} AS indicator
+    FROM (SELECT group_id, preg_num, {aggregate}(age) AS age
+          FROM source GROUP BY group_id, preg_num) AS ages"""
+
+    common = f"""WITH source AS (
+    SELECT
+        d.{_quote(patient_col)} AS group_id,
+        d.{_quote(pregnancy_col)} AS preg_num,
+        'DX' AS code_type,
+        version_match.version AS version,
+        REPLACE(d.{_quote(code_col)}, '.', '') AS match_code,
+        {age} AS age
+    FROM {table} AS d
+    JOIN {VERSION_TABLE} AS version_match
+        ON version_match.entry = 'calc_index'
+        AND version_match.synonym = UPPER(CAST(d.{_quote(version_col)} AS VARCHAR))
+    WHERE version_match.version = {_literal(version)}
+),
+{_match_ctes('index', method)},
+indicators AS (
+    SELECT s.group_id, s.preg_num, l.label AS indicator
+    FROM source AS s
+    JOIN index_labels AS l
+        ON l.code_type = s.code_type AND l.version = s.version AND l.match_code = s.match_code{age_rows}
+),
+weighted AS (
+    SELECT DISTINCT i.group_id, i.preg_num, i.indicator, w.weight, w.weight_nontransfusion
+    FROM indicators AS i
+    JOIN {WEIGHT_TABLE} AS w
+        ON w.method = {_literal(method)} AND w.indicator = i.indicator
+)"""
+
+    pregnancies = f"""FROM (SELECT DISTINCT group_id, preg_num FROM source) AS p
+LEFT JOIN weighted AS w
+    ON w.group_id = p.group_id AND w.preg_num = p.preg_num"""
+
+    if method == 'leonard':
+        return f"""{common}
+SELECT
+    p.group_id AS {_quote(patient_col)},
+    p.preg_num AS {_quote(pregnancy_col)},
+    COALESCE(SUM(w.weight), 0) AS leonard_smm_score,
+    COALESCE(SUM(w.weight_nontransfusion), 0) AS leonard_nontransfusion_smm_score
+{pregnancies}
+GROUP BY p.group_id, p.preg_num
+"""
+
+    # Mild preeclampsia is precluded by eclampsia, gestational hypertension is
+    # precluded by eclampsia, preeclampsia, or preexisting hypertension
+    eclampsia = BATEMAN_MAP.indicator.iloc[5]
+    preeclampsia = BATEMAN_MAP.indicator.iloc[4]
+    hypertension = BATEMAN_MAP.indicator.iloc[8]
+    gest_ht = BATEMAN_MAP.indicator.iloc[3]
+    precluding = ', '.join(_literal(term) for term in [eclampsia, preeclampsia, hypertension])
+
+    return f"""{common},
+exclusions AS (
+    SELECT group_id, preg_num,
+        MAX(CASE WHEN indicator = {_literal(eclampsia)} THEN 1 ELSE 0 END) AS eclampsia,
+        MAX(CASE WHEN indicator IN ({precluding}) THEN 1 ELSE 0 END) AS hypertension
+    FROM weighted
+    GROUP BY group_id, preg_num
+)
+SELECT
+    p.group_id AS {_quote(patient_col)},
+    p.preg_num AS {_quote(pregnancy_col)},
+    COALESCE(SUM(CASE
+        WHEN w.indicator = {_literal(preeclampsia)} AND e.eclampsia = 1 THEN 0
+        WHEN w.indicator = {_literal(gest_ht)} AND e.hypertension = 1 THEN 0
+        ELSE w.weight END), 0) AS bateman_score
+{pregnancies}
+LEFT JOIN exclusions AS e
+    ON e.group_id = p.group_id AND e.preg_num = p.preg_num
+GROUP BY p.group_id, p.preg_num
+"""
@@ -0,0 +1,272 @@
+"""
+Mergeable cohort summaries of the pypreg outputs.
+
+Copyright (C) 2023 Dave Walsh
+
+A CohortSummary holds the counts needed to report rates and distributions by
+strata such as year, facility, or age group: the number of units (deliveries
+or pregnancies) in each stratum, the number of units with each flag, and a
+histogram of each score or category. Summaries of separate partitions are
+combined by adding their counts, which is associative and commutative, so a
+cohort of any size can be summarized from per-partition results that are a
+few rows each.
+
+Available functions and classes
+CohortSummary : Counts, numerators, and histograms by strata that can be merged
+summarize : Summarizes the output of process_outcomes, smm, apo, or calc_index
+"""
+
+import pandas as pd
+
+N_COL = 'n'
+
+# How each entry point's output is summarized: flag columns become numerators,
+# histogram columns are counted by value
+ANALYSES = {'process_outcomes': 'outcome',
+            'smm': 'flags',
+            'apo': 'flags',
+            'calc_index': 'scores'}
+
+
+class CohortSummary:
+    """
+    Counts by strata that can be merged with the summary of another part of the cohort.
+
+    total = sum(summaries, CohortSummary()) or CohortSummary.combine(summaries)
+
+    :param by: Strata columns
+    :param counts: Dataframe with the strata columns, the unit count n, and a count per flag
+    :param histograms: Dataframe with the strata columns, variable, value, and count
+    """
+
+    def __init__(self,
+                 by=(),
+                 counts: pd.DataFrame = None,
+                 histograms: pd.DataFrame = None):
+        self.by = list(by)
+        self.counts = pd.DataFrame(columns=[*self.by, N_COL]) if counts is None else counts
+        self.histograms = pd.DataFrame(columns=[*self.by, 'variable', 'value', 'count']) \
+            if histograms is None else histograms
+
+    @classmethod
+    def from_frame(cls,
+                   df: pd.DataFrame,
+                   by=None,
+                   flags=None,
+                   histograms=None):
+        """
+        Summarizes a dataframe with one row per unit.
+
+        :param df: Pandas dataframe with one row per delivery, pregnancy, or other unit
+        :param by: Optional list of strata columns
+        :param flags: Boolean columns counted as numerators
+        :param histograms: Columns whose values are counted
+
+        :return: Returns a CohortSummary
+        """
+
+        by = list(by or [])
+        flags = list(flags or [])
+        histograms = list(histograms or [])
+        if not set(by + flags + histograms).issubset(df.columns):
+            raise KeyError(f"Ensure that columns {by + flags + histograms} are present in the data.")
+
+        # A constant key lets a summary without strata use the same grouping
+        keys = by or [pd.Series(0, index=df.index)]
+
+        counts = df[by].assign(**{N_COL: 1}, **{flag: df[flag].astype(bool) for flag in flags})\
+            .groupby(keys, dropna=False)[[N_COL, *flags]].sum()
+        counts = counts.reset_index(drop=not by)
+
+        hist = []
+        for variable in histograms:
+            found = df.groupby([*keys, df[variable].rename('value')], dropna=False, observed=True)\
+                .size()\
+                .rename('count')\
+                .reset_index()
+            if not by:
+                found = found.drop(columns=found.columns[0])
+            hist.append(found.assign(variable=variable))
+        hist = pd.concat(hist, ignore_index=True)[[*by, 'variable', 'value', 'count']] if hist else None
+
+        return cls(by, counts, hist)
+
+    def merge(self, other):
+        """
+        Adds the counts of another summary with the same strata.
+
+        :param other: CohortSummary of another part of the cohort
+
+        :return: Returns a new CohortSummary
+
+        :raises: ValueError
+            If the summaries have different strata
+        """
+
+        if self.by != other.by:
+            raise ValueError(f'Summaries must have the same strata, got {self.by} and {other.by}')
+
+        return CohortSummary(self.by,
+                             _add([self.counts, other.counts], self.by),
+                             _add([self.histograms, other.histograms], [*self.by, 'variable', 'value']))
+
+    def __add__(self, other):
+        return self.merge(other)
+
+    def __radd__(self, other):
+        # Lets sum() start from 0
+        if isinstance(other, int) and other == 0:
+            return self
+        return self.merge(other)
+
+    @classmethod
+    def combine(cls, summaries):
+        """
+        Merges any number of summaries in a single step.
+
+        :param summaries: Iterable of CohortSummary with the same strata
+
+        :return: Returns a CohortSummary
+        """
+
+        summaries = list(summaries)
+        if not summaries:
+            return cls()
+
+        by = summaries[0].by
+        if any(summary.by != by for summary in summaries):
+            raise ValueError('Summaries must have the same strata')
+
+        return cls(by,
+                   _add([summary.counts for summary in summaries], by),
+                   _add([summary.histograms for summary in summaries], [*by, 'variable', 'value']))
+
+    def rates(self, per: int = 1):
+        """
+        :param per: Units the rate is expressed per, for example 10000 for SMM per 10,000 deliveries
+
+        :return: Returns a pandas dataframe with the strata, measure, numerator, denominator, and rate
+        """
+
+        flags = [col for col in self.counts.columns if col not in [*self.by, N_COL]]
+        output = self.counts.melt(id_vars=[*self.by, N_COL],
+                                  value_vars=flags,
+                                  var_name='measure',
+                                  value_name='numerator')\
+            .rename(columns={N_COL: 'denominator'})
+        output = output[[*self.by, 'measure', 'numerator', 'denominator']]
+        output['rate'] = output['numerator'] / output['denominator'] * per
+
+        return output
+
+    def histogram(self, variable: str):
+        """
+        :param variable: Histogram column, such as bateman_score or outcome
+
+        :return: Returns a pandas dataframe with the strata, value, and count
+        """
+
+        found = self.histograms[self.histograms['variable'] == variable]
+
+        return found.drop(columns='variable').reset_index(drop=True)
+
+    def to_dict(self):
+        """
+        :return: Returns the summary as a dictionary of plain lists, for JSON or sending between processes
+        """
+
+        return {'by': self.by,
+                'counts': self.counts.to_dict(orient='list'),
+                'histograms': self.histograms.to_dict(orient='list')}
+
+    @classmethod
+    def from_dict(cls, summary: dict):
+        """
+        :param summary: Dictionary written by to_dict
+
+        :return: Returns a CohortSummary
+        """
+
+        return cls(summary['by'],
+                   pd.DataFrame(summary['counts']),
+                   pd.DataFrame(summary['histograms']))
+
+
+def _add(frames: list,
+         keys: list):
+    """
+    Utility to add count tables row by row on their keys.
+    """
+
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return pd.DataFrame(columns=list(keys))
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+
+    combined = pd.concat(frames, ignore_index=True)
+    value_cols = [col for col in combined.columns if col not in keys]
+    combined[value_cols] = combined[value_cols].fillna(0).astype('int64')
+    if not keys:
+        return combined[value_cols].sum().to_frame().T
+
+    return combined.groupby(keys, dropna=False, sort=False)[value_cols].sum().reset_index()
+
+
+def summarize(output: pd.DataFrame,
+              analysis: str,
+              by=None,
+              population: pd.DataFrame = None,
+              on=None):
+    """
+    Summarizes the output of an entry point. Flags of smm and apo are counted as numerators,
+    the scores of calc_index and the outcomes of process_outcomes as histograms.
+
+    smm only returns encounters with SMM or transfusion, and calc_index only pregnancies with
+    a score, so the units without them are supplied by population: one row per delivery or
+    pregnancy with the key columns and strata. Missing flags count as False and missing scores as 0.
+
+    :param output: Output of process_outcomes, smm, apo, or calc_index
+    :param analysis: Name of the entry point that produced the output
+    :param by: Optional list of strata columns, in the output or in population
+    :param population: Optional pandas dataframe of every unit the rates are computed over
+    :param on: Key columns joining the output to population, such as the encounter identifier
+
+    :return: Returns a CohortSummary
+
+    :raises: ValueError
+        If the analysis does not exist, or population is given without on
+    """
+
+    if analysis not in ANALYSES:
+        raise ValueError(f'Analysis must be one of {list(ANALYSES)}')
+
+    by = list(by or [])
+    kind = ANALYSES[analysis]
+
+    # Batches of process_outcomes are summarized per configuration and selection
+    if analysis == 'process_outcomes':
+        by = [col for col in ['config_id', 'schema_id'] if col in output.columns and col not in by] + by
+
+    if kind == 'flags':
+        value_cols = list(output.columns[output.dtypes == bool])
+    elif kind == 'scores':
+        value_cols = [col for col in output.columns if col.endswith('_score')]
+    else:
+        value_cols = ['outcome']
+
+    if population is not None:
+        if not on:
+            raise ValueError('on is required with population')
+        on = [on] if isinstance(on, str) else list(on)
+        units = population[on + [col for col in by if col not in on]].drop_duplicates(on)
+        output = units.merge(output[on + value_cols], how='left', on=on)
+        if kind == 'flags':
+            output[value_cols] = output[value_cols].astype('boolean').fillna(False).astype(bool)
+        elif kind == 'scores':
+            output[value_cols] = output[value_cols].fillna(0).astype('int64')
+
+    if kind == 'flags':
+        return CohortSummary.from_frame(output, by, flags=value_cols)
+
+    return CohortSummary.from_frame(output, by, histograms=value_cols)
@@ -0,0 +1,408 @@
+"""
+Synthetic claims generator.
+
+Copyright (C) 2023 Dave Walsh
+
+Produces a seeded, reproducible dataframe of coded encounters that looks like
+a general claims extract: most patients only have background encounters while
+a controllable share of patients have one or more pregnancies. Each pregnancy
+has prenatal visits, an outcome encounter, and postpartum visits carrying
+pregnancy outcome, adverse pregnancy outcome, comorbidity, and SMM codes.
+Encounters before October 2015 are coded in ICD9, later encounters in ICD10.
+
+The output is meant for benchmarking and verification. The codes are real
+codes, but the data is not meant to be clinically realistic.
+
+Edge case generators build small cohorts around the decisions of the outcome
+algorithm that are easiest to get wrong: several outcome encounters on the
+same day, encounters carrying codes of competing outcomes, outcome pairs
+spaced one day either side of the minimum gap between them, and encounters
+with missing identifiers.
+
+Available functions
+synthetic_claims : Returns a pandas dataframe of coded encounters
+edge_case_claims : Returns a pandas dataframe of coded encounters for one edge case
+"""
+
+import numpy as np
+import pandas as pd
+
+from .pregnancy_outcome.process_outcome import gap_matrix
+
+# Date ICD10 replaced ICD9
+ICD10_START = pd.Timestamp('2015-10-01')
+
+# Pregnancy outcome mix and the length of gestation in days for each outcome
+OUTCOME_MIX = {'LIVE_BIRTH': (0.70, 273),
+               'STILLBIRTH': (0.01, 196),
+               'DELIVERY': (0.04, 273),
+               'TROPHOBLASTIC': (0.01, 84),
+               'ECTOPIC': (0.02, 56),
+               'THERAPEUTIC_ABORTION': (0.10, 70),
+               'SPONTANEOUS_ABORTION': (0.12, 63)}
+
+# Code pools as (code_type, code_version, code) for the ICD9 and ICD10 eras
+CODE_POOLS = {
+    'LIVE_BIRTH': ([('DX', '9', 'V27.0'), ('DX', '9', '650'), ('DX', '9', 'V30.00')],
+                   [('DX', '10', 'Z37.0'), ('DX', '10', 'O80')]),
+    'STILLBIRTH': ([('DX', '9', 'V27.1'), ('DX', '9', '656.41')],
+                   [('DX', '10', 'Z37.1'), ('DX', '10', 'O36.4XX0')]),
+    'DELIVERY': ([('DX', '9', '652.21'), ('DX', '9', '669.71'), ('PX', '9', '73.59'),
+                  ('PX', 'CPT', '59409'), ('DRG', 'DRG', '775')],
+                 [('DX', '10', 'O75.9'), ('DX', '10', 'O70.1'), ('PX', '10', '10E0XZZ'),
+                  ('PX', 'CPT', '59514'), ('DRG', 'DRG', '766')]),
+    'TROPHOBLASTIC': ([('DX', '9', '631.8'), ('DX', '9', '630')],
+                      [('DX', '10', 'O01.9'), ('DX', '10', 'O02.0')]),
+    'ECTOPIC': ([('DX', '9', '633.10'), ('DX', '9', '633.1')],
+                [('DX', '10', 'O00.10'), ('DX', '10', 'O00.90'), ('PX', '10', '10D27ZZ')]),
+    'THERAPEUTIC_ABORTION': ([('DX', '9', '635.92'), ('DX', '9', '635.91')],
+                             [('DX', '10', 'O04.89'), ('DX', '10', 'Z33.2')]),
+    'SPONTANEOUS_ABORTION': ([('DX', '9', '632'), ('DX', '9', '634.91')],
+                             [('DX', '10', 'O03.9'), ('DX', '10', 'O02.1')]),
+    'prenatal': ([('DX', '9', 'V22.1'), ('DX', '9', 'V22.0'), ('DX', '9', 'V23.9'),
+                  ('DX', '9', '648.93')],
+                 [('DX', '10', 'Z34.80'), ('DX', '10', 'Z34.90'), ('DX', '10', 'O09.90'),
+                  ('DX', '10', 'O99.89'), ('DX', '10', 'Z3A.32')]),
+    'comorbidity': ([('DX', '9', '642.39'), ('DX', '9', '642.49'), ('DX', '9', '642.59'),
+                     ('DX', '9', '648.83'), ('DX', '9', '656.53'), ('DX', '9', '250.00'),
+                     ('DX', '9', '493.90'), ('DX', '9', '401.9'), ('DX', '9', '654.21'),
+                     ('DX', '9', '649.03'), ('DX', '9', '641.01'), ('DX', '9', '651.03')],
+                    [('DX', '10', 'O13.3'), ('DX', '10', 'O14.14'), ('DX', '10', 'O24.419'),
+                     ('DX', '10', 'O36.5930'), ('DX', '10', 'J45.909'), ('DX', '10', 'O10.019'),
+                     ('DX', '10', 'O34.21'), ('DX', '10', 'E66.9'), ('DX', '10', 'O99.214'),
+                     ('DX', '10', 'O44.03'), ('DX', '10', 'O30.009'), ('DX', '10', 'E05.90')]),
+    'cesarean': ([('PX', '9', '74.1'), ('PX', 'CPT', '59510')],
+                 [('PX', '10', '10D00Z1'), ('PX', 'CPT', '59510')]),
+    'smm': ([('DX', '9', '584.9'), ('DX', '9', '666.12'), ('DX', '9', '286.6'),
+             ('PX', '9', '99.04'), ('PX', '9', '68.79'), ('PX', '9', '96.71'),
+             ('DX', '9', '998.0'), ('DX', '9', '518.4')],
+            [('DX', '10', 'N17.9'), ('DX', '10', 'O72.3'), ('DX', '10', 'R57.0'),
+             ('PX', '10', '30233N1'), ('PX', '10', '0UT90ZZ'), ('PX', '10', '5A1955Z'),
+             ('DX', '10', 'O15.02'), ('DX', '10', 'I50.9')]),
+    'background': ([('DX', '9', '401.9'), ('DX', '9', '272.4'), ('DX', '9', 'V70.0'),
+                    ('DX', '9', '780.79'), ('DX', '9', '466.0'), ('DX', '9', '530.81'),
+                    ('DX', '9', '724.2'), ('DX', '9', '311'), ('PX', 'CPT', '99213'),
+                    ('PX', 'CPT', '99214'), ('PX', 'CPT', '80053'), ('PX', 'CPT', '85025')],
+                   [('DX', '10', 'I10'), ('DX', '10', 'E78.5'), ('DX', '10', 'E11.9'),
+                    ('DX', '10', 'Z00.00'), ('DX', '10', 'R53.83'), ('DX', '10', 'J20.9'),
+                    ('DX', '10', 'K21.9'), ('DX', '10', 'M54.5'), ('PX', 'CPT', '99213'),
+                    ('PX', 'CPT', '99214'), ('PX', 'CPT', '80053'), ('PX', 'CPT', '85025')]),
+}
+
+# Leading characters for the high cardinality background codes
+_NOISE_LETTERS = np.array(list('ABCDEFGHIJKLMNPQRSTUWXY'))
+
+COLUMNS = ['patient_id',
+           'encounter_id',
+           'admit_date',
+           'code_type',
+           'code_version',
+           'code',
+           'preg_id',
+           'age']
+
+
+def _draw(rng: np.random.Generator,
+          pool: str,
+          icd10: np.ndarray):
+    """
+    Utility to draw one code per row from a code pool based on the coding era of the row.
+
+    :param rng: numpy random generator
+    :param pool: Key of CODE_POOLS to draw from
+    :param icd10: Boolean array, True where the row is in the ICD10 era
+
+    :return: Returns 3 arrays for the code type, code version, and code
+    """
+
+    output = np.empty((len(icd10), 3), dtype=object)
+    for era, codes in enumerate(CODE_POOLS[pool]):
+        mask = icd10 == bool(era)
+        codes = np.array(codes, dtype=object)
+        output[mask] = codes[rng.integers(len(codes), size=mask.sum())]
+
+    return output[:, 0], output[:, 1], output[:, 2]
+
+
+def _noise(rng: np.random.Generator,
+           icd10: np.ndarray):
+    """
+    Utility to draw random diagnosis codes so that the extract has a realistic
+    number of distinct codes. ICD9 era codes are numeric, ICD10 era codes start with a letter.
+    """
+
+    size = len(icd10)
+
+    # Pregnancy chapter of ICD9 (630-679) is skipped, ICD10 letters exclude O, V, and Z
+    number = rng.integers(1, 950, size=size)
+    number = np.where(number >= 630, number + 50, number)
+    extension = rng.integers(0, 10, size=size).astype('U1')
+    letters = _NOISE_LETTERS[rng.integers(len(_NOISE_LETTERS), size=size)]
+
+    stem = np.char.zfill(number.astype('U3'), 3)
+    icd9_codes = np.char.add(np.char.add(stem, '.'), extension)
+
+    category = np.char.add(letters, np.char.zfill((number // 10).astype('U2'), 2))
+    subcategory = np.char.add((number % 10).astype('U1'), extension)
+    icd10_codes = np.char.add(np.char.add(category, '.'), subcategory)
+
+    codes = np.where(icd10, icd10_codes, icd9_codes).astype(object)
+    versions = np.where(icd10, '10', '9').astype(object)
+
+    return np.full(size, 'DX', dtype=object), versions, codes
+
+
+def synthetic_claims(n_rows: int = 10_000,
+                     pregnancy_density: float = 0.3,
+                     seed: int = 0,
+                     start: str = '2013-01-01',
+                     years: int = 6,
+                     encounters_per_patient: int = 12,
+                     codes_per_encounter: int = 4,
+                     smm_rate: float = 0.02,
+                     comorbidity_rate: float = 0.3):
+    """
+    Generates a seeded synthetic claims extract.
+
+    :param n_rows: Approximate number of code rows to generate
+    :param pregnancy_density: Share of patients with at least one pregnancy
+    :param seed: Seed for the random generator, the same seed gives the same data
+    :param start: First admit date in the data
+    :param years: Number of years covered by the data
+    :param encounters_per_patient: Mean number of background encounters per patient
+    :param codes_per_encounter: Mean number of codes per background encounter
+    :param smm_rate: Share of pregnancy outcome encounters with an SMM code
+    :param comorbidity_rate: Share of prenatal and outcome encounters with a
+        comorbidity or adverse pregnancy outcome code
+
+    :return: Returns a pandas dataframe with the columns patient_id, encounter_id,
+    admit_date, code_type, code_version, code, preg_id, and age. preg_id is the
+    generated pregnancy the encounter belongs to, 0 for background encounters.
+
+    :raises: ValueError
+        If the pregnancy density is not between 0 and 1
+    """
+
+    if not 0 <= pregnancy_density <= 1:
+        raise ValueError(f'pregnancy_density must be between 0 and 1, got {pregnancy_density}.')
+
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    span = int(years * 365.25)
+
+    # Expected rows per patient decide how many patients are needed
+    rows_per_patient = encounters_per_patient * codes_per_encounter + pregnancy_density * 2 * 12
+    n_patients = max(1, int(round(n_rows / rows_per_patient)))
+
+    birth_age = rng.integers(15, 45, size=n_patients)
+
+    # Pregnancies, each patient with pregnancies has 1 to 3 of them at least 300 days apart
+    n_pregs = np.where(rng.random(n_patients) < pregnancy_density,
+                       rng.integers(1, 4, size=n_patients), 0)
+    preg_patient = np.repeat(np.arange(n_patients), n_pregs)
+    preg_num = np.arange(len(preg_patient)) - np.repeat(np.cumsum(n_pregs) - n_pregs, n_pregs) + 1
+    gaps = rng.integers(300, 720, size=len(preg_patient))
+    first = np.repeat(np.cumsum(n_pregs) - n_pregs, n_pregs)
+    outcome_day = np.cumsum(gaps) - np.concatenate([[0], np.cumsum(gaps)])[first]
+    outcome_day = outcome_day + rng.integers(0, max(span - 720, 1), size=n_patients)[preg_patient]
+
+    outcomes = list(OUTCOME_MIX)
+    share = np.array([OUTCOME_MIX[outcome][0] for outcome in outcomes])
+    outcome = rng.choice(len(outcomes), size=len(preg_patient), p=share / share.sum())
+    gestation = np.array([OUTCOME_MIX[outcomes[idx]][1] for idx in range(len(outcomes))])[outcome]
+    term = gestation >= 180
+
+    # Encounters as (patient, day, pregnancy number, kind)
+    #     kind 0: background, 1: prenatal, 2: outcome, 3: postpartum
+    n_background = rng.poisson(encounters_per_patient, size=n_patients)
+    n_prenatal = np.where(term, rng.integers(4, 11, size=len(preg_patient)),
+                          rng.integers(1, 4, size=len(preg_patient)))
+    n_postpartum = rng.integers(0, 3, size=len(preg_patient))
+
+    prenatal_preg = np.repeat(np.arange(len(preg_patient)), n_prenatal)
+    postpartum_preg = np.repeat(np.arange(len(preg_patient)), n_postpartum)
+
+    enc_patient = np.concatenate([np.repeat(np.arange(n_patients), n_background),
+                                  preg_patient[prenatal_preg],
+                                  preg_patient,
+                                  preg_patient[postpartum_preg]])
+    enc_day = np.concatenate([rng.integers(0, span, size=n_background.sum()),
+                              outcome_day[prenatal_preg]
+                              - (rng.random(len(prenatal_preg))
+                                 * gestation[prenatal_preg]).astype(int) - 1,
+                              outcome_day,
+                              outcome_day[postpartum_preg]
+                              + rng.integers(1, 43, size=len(postpartum_preg))])
+    enc_preg = np.concatenate([np.full(n_background.sum(), -1),
+                               prenatal_preg,
+                               np.arange(len(preg_patient)),
+                               postpartum_preg])
+    enc_kind = np.concatenate([np.zeros(n_background.sum(), dtype=int),
+                               np.ones(len(prenatal_preg), dtype=int),
+                               np.full(len(preg_patient), 2),
+                               np.full(len(postpartum_preg), 3)])
+
+    # Number the encounters in patient and date order
+    order = np.lexsort((enc_day, enc_patient))
+    enc_patient = enc_patient[order]
+    enc_day = enc_day[order]
+    enc_preg = enc_preg[order]
+    enc_kind = enc_kind[order]
+    # Index -1 selects the trailing placeholder for background encounters
+    enc_outcome = np.append(outcome, -1)[enc_preg]
+    n_encounters = len(order)
+
+    # Codes per encounter: background codes everywhere, one pregnancy code
+    # for prenatal and outcome encounters, and optional clinical codes
+    n_codes = 1 + rng.poisson(max(codes_per_encounter - 1, 0), size=n_encounters)
+    row_enc = np.repeat(np.arange(n_encounters), n_codes)
+    icd10 = (start + pd.to_timedelta(enc_day[row_enc], unit='D')) >= ICD10_START
+    code_type, code_version, code = _noise(rng, np.asarray(icd10))
+
+    background = rng.random(len(row_enc)) < 0.6
+    bg_type, bg_version, bg_code = _draw(rng, 'background', np.asarray(icd10))
+    code_type = np.where(background, bg_type, code_type)
+    code_version = np.where(background, bg_version, code_version)
+    code = np.where(background, bg_code, code)
+
+    extra_enc = []
+    extra_pool = []
+    for kind, pool, rate in [(1, 'prenatal', 1.0),
+                             (1, 'comorbidity', comorbidity_rate),
+                             (2, 'comorbidity', comorbidity_rate),
+                             (2, 'smm', smm_rate),
+                             (3, 'smm', smm_rate / 2)]:
+        selected = np.flatnonzero((enc_kind == kind) & (rng.random(n_encounters) < rate))
+        extra_enc.append(selected)
+        extra_pool.append(np.full(len(selected), pool, dtype=object))
+
+    # Outcome encounters carry 1 or 2 codes for their outcome, term outcomes may be cesareans
+    outcome_enc = np.flatnonzero(enc_kind == 2)
+    outcome_enc = np.concatenate([outcome_enc,
+                                  outcome_enc[rng.random(len(outcome_enc)) < 0.5]])
+    extra_enc.append(outcome_enc)
+    extra_pool.append(np.array(outcomes, dtype=object)[enc_outcome[outcome_enc]])
+    cesarean_enc = np.flatnonzero((enc_kind == 2) & (rng.random(n_encounters) < 0.3))
+    cesarean_enc = cesarean_enc[term[enc_preg[cesarean_enc]]]
+    extra_enc.append(cesarean_enc)
+    extra_pool.append(np.full(len(cesarean_enc), 'cesarean', dtype=object))
+
+    extra_enc = np.concatenate(extra_enc)
+    extra_pool = np.concatenate(extra_pool)
+    extra_icd10 = np.asarray((start + pd.to_timedelta(enc_day[extra_enc], unit='D')) >= ICD10_START)
+    extra_type = np.empty(len(extra_enc), dtype=object)
+    extra_version = np.empty(len(extra_enc), dtype=object)
+    extra_code = np.empty(len(extra_enc), dtype=object)
+    for pool in np.unique(extra_pool):
+        mask = extra_pool == pool
+        drawn = _draw(rng, pool, extra_icd10[mask])
+        extra_type[mask], extra_version[mask], extra_code[mask] = drawn
+
+    row_enc = np.concatenate([row_enc, extra_enc])
+    output = pd.DataFrame({'patient_id': enc_patient[row_enc] + 1,
+                           'encounter_id': row_enc + 1,
+                           'admit_date': start + pd.to_timedelta(enc_day[row_enc], unit='D'),
+                           'code_type': np.concatenate([code_type, extra_type]),
+                           'code_version': np.concatenate([code_version, extra_version]),
+                           'code': np.concatenate([code, extra_code]),
+                           'preg_id': np.append(preg_num, 0)[enc_preg[row_enc]],
+                           'age': birth_age[enc_patient[row_enc]]
+                           + enc_day[row_enc] // 365})
+
+    output = output.sort_values(['patient_id', 'encounter_id'], kind='stable')\
+        .head(n_rows)\
+        .reset_index(drop=True)
+
+    return output[COLUMNS]
+
+
+EDGE_CASES = ['same_day', 'hierarchy_ties', 'boundary_spacing', 'missing_ids']
+
+
+def edge_case_claims(case: str,
+                     n_patients: int = 100,
+                     seed: int = 0,
+                     start: str = '2016-01-01'):
+    """
+    Generates a seeded cohort where every patient exercises one edge case of the outcome
+    algorithm. All encounters are in the ICD10 era.
+
+        same_day: 2 to 4 outcome encounters of random outcomes on the same day, twice per
+            patient, with repeated code rows
+        hierarchy_ties: 1 to 3 encounters each carrying 2 or 3 codes of random outcomes
+        boundary_spacing: a pair of outcomes spaced at the minimum gap of NEXT_OUTCOME
+            between them, one day less, or one day more
+        missing_ids: the encounters of hierarchy_ties with the patient identifier missing
+            for about a quarter of the patients, and the encounter and pregnancy identifiers
+            missing for about a tenth of the encounters
+
+    :param case: One of EDGE_CASES
+    :param n_patients: Number of patients
+    :param seed: Seed for the random generator, the same seed gives the same data
+    :param start: First admit date in the data
+
+    :return: Returns a pandas dataframe with the columns of synthetic_claims
+
+    :raises: ValueError
+        If the case does not exist
+    """
+
+    if case not in EDGE_CASES:
+        raise ValueError(f'case must be one of {EDGE_CASES}')
+
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start)
+    outcomes = list(OUTCOME_MIX)
+    patients = np.arange(n_patients)
+    first_day = rng.integers(0, 3 * 365, size=n_patients)
+
+    # Encounters as (patient, day, pregnancy number) and the number of codes of each
+    if case == 'same_day':
+        per_cluster = rng.integers(2, 5, size=(n_patients, 2))
+        enc_patient = np.repeat(np.repeat(patients, 2), per_cluster.ravel())
+        enc_preg = np.repeat(np.tile([1, 2], n_patients), per_cluster.ravel())
+        enc_day = first_day[enc_patient] + (enc_preg - 1) * 400
+        n_codes = 1 + (rng.random(len(enc_patient)) < 0.3)
+        row_outcome = np.repeat(rng.integers(len(outcomes), size=len(enc_patient)), n_codes)
+    elif case in ['hierarchy_ties', 'missing_ids']:
+        n_encounters = rng.integers(1, 4, size=n_patients)
+        enc_patient = np.repeat(patients, n_encounters)
+        enc_preg = np.arange(len(enc_patient)) - np.repeat(np.cumsum(n_encounters) - n_encounters, n_encounters) + 1
+        enc_day = first_day[enc_patient] + (enc_preg - 1) * 400
+        n_codes = rng.integers(2, 4, size=len(enc_patient))
+        row_outcome = rng.integers(len(outcomes), size=n_codes.sum())
+    else:
+        pair = rng.integers(len(outcomes), size=(n_patients, 2))
+        gap = gap_matrix()[pair[:, 0], pair[:, 1]]
+        enc_patient = np.repeat(patients, 2)
+        enc_preg = np.tile([1, 2], n_patients)
+        enc_day = np.column_stack([first_day, first_day + gap + rng.integers(-1, 2, size=n_patients)]).ravel()
+        n_codes = np.ones(len(enc_patient), dtype=int)
+        row_outcome = pair.ravel()
+
+    row_enc = np.repeat(np.arange(len(enc_patient)), n_codes)
+    codes = np.empty((len(row_enc), 3), dtype=object)
+    for idx, outcome in enumerate(outcomes):
+        mask = row_outcome == idx
+        pool = np.array(CODE_POOLS[outcome][1], dtype=object)
+        codes[mask] = pool[rng.integers(len(pool), size=mask.sum())]
+
+    birth_age = rng.integers(15, 45, size=n_patients)
+    output = pd.DataFrame({'patient_id': enc_patient[row_enc] + 1,
+                           'encounter_id': row_enc + 1,
+                           'admit_date': start + pd.to_timedelta(enc_day[row_enc], unit='D'),
+                           'code_type': codes[:, 0],
+                           'code_version': codes[:, 1],
+                           'code': codes[:, 2],
+                           'preg_id': enc_preg[row_enc],
+                           'age': birth_age[enc_patient[row_enc]] + enc_day[row_enc] // 365})
+
+    # Identifiers missing from the extract, the rows are kept with empty identifiers
+    if case == 'missing_ids':
+        no_patient = rng.random(n_patients) < 0.25
+        no_encounter = rng.random(len(enc_patient)) < 0.1
+        output['patient_id'] = output['patient_id'].where(~no_patient[enc_patient[row_enc]])
+        output['encounter_id'] = output['encounter_id'].where(~no_encounter[row_enc])
+        output['preg_id'] = output['preg_id'].where(~no_encounter[row_enc])
+
+    return output[COLUMNS]
@@ -0,0 +1,314 @@
+"""
+Differential verification of the pypreg engines.
+
+Copyright (C) 2023 Dave Walsh
+
+The reference engine is the frozen copy of the entry points in the reference
+module, the published pipeline without the later optimizations. The package
+entry points run in memory are the 'in_memory' engine, and the partitioned,
+shared memory, and chunked execution paths are engines beside it, so every
+fast path is checked against code it does not share. An engine is any
+function called as engine(analysis, df, **kwargs) that should return the
+same rows as the reference.
+
+verify runs the reference and the engines on the same data and reports the
+row-level differences between them. Both results are sorted on their unit
+keys and merged, so large cohorts are compared column by column rather than
+row by row. Repeated keys are told apart by their occurrence in key order.
+
+Available functions
+register_engine : Adds an engine to compare against the reference
+diff_frames : Returns the row-level differences between two results
+verify : Compares engines against the reference on one dataset
+verify_synthetic : Compares engines against the reference on seeded synthetic and edge case cohorts
+"""
+
+import pandas as pd
+
+from .partition import ENTRY_POINTS, UNITS, _entry_point
+
+REFERENCE = 'reference'
+
+OCCURRENCE = '_pypreg_occurrence'
+
+DIFFERENCE_COLUMNS = ['engine', 'kind', 'column', 'reference', 'candidate']
+
+# Synthetic claims column names for the arguments of each entry point
+SYNTHETIC_ARGS = {'process_outcomes': {'patient_col': 'patient_id',
+                                       'encounter_col': 'encounter_id',
+                                       'admit_date_col': 'admit_date',
+                                       'version_col': 'code_version',
+                                       'type_col': 'code_type',
+                                       'code_col': 'code'},
+                  'smm': {'enc_id': 'encounter_id',
+                          'code_type': 'code_type',
+                          'version': 'code_version',
+                          'code': 'code',
+                          'indicators': True},
+                  'apo': {'patient_id': 'patient_id',
+                          'preg_id': 'preg_id',
+                          'code_type': 'code_type',
+                          'version': 'code_version',
+                          'code': 'code'},
+                  'calc_index': {'patient_col': 'patient_id',
+                                 'pregnancy_col': 'preg_id',
+                                 'code_col': 'code',
+                                 'version_col': 'code_version',
+                                 'method': 'bateman',
+                                 'age_col': 'age'}}
+
+
+class EngineMismatch(AssertionError):
+    """
+    Raised when an engine does not return the rows of the reference.
+
+    :param differences: Dataframe of the differences, see verify
+    """
+
+    def __init__(self, differences: pd.DataFrame):
+        self.differences = differences
+        counts = differences.groupby(['engine', 'kind']).size()
+        super().__init__(f'Engines differ from the reference: {counts.to_dict()}')
+
+
+def _reference(analysis: str,
+               df: pd.DataFrame,
+               **kwargs):
+    import warnings
+    from . import reference
+
+    # The frozen copy is not updated for pandas deprecations, only its results are compared
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        return getattr(reference, analysis)(df, **kwargs)
+
+
+def _in_memory(analysis: str,
+               df: pd.DataFrame,
+               **kwargs):
+    return _entry_point(analysis)(df, **kwargs)
+
+
+def _partitioned(analysis: str,
+                 df: pd.DataFrame,
+                 **kwargs):
+    from .partition import run_partitioned
+    return run_partitioned(analysis, df, n_partitions=4, **kwargs)
+
+
+def _shared(analysis: str,
+            df: pd.DataFrame,
+            **kwargs):
+    from .shared import run_shared
+    return run_shared(analysis, df, workers=1, n_ranges=4, **kwargs)
+
+
+def _chunked(analysis: str,
+             df: pd.DataFrame,
+             **kwargs):
+    from .budget import estimate_memory, run_within
+    limit = max(max(estimate_memory(analysis, df, **kwargs).values(), default=0) // 3, 1)
+    return run_within(analysis, df, limit, **kwargs)
+
+
+ENGINES = {REFERENCE: _reference,
+           'in_memory': _in_memory,
+           'partitioned': _partitioned,
+           'shared': _shared,
+           'chunked': _chunked}
+
+
+def register_engine(name: str,
+                    function):
+    """
+    Adds an engine that verify compares against the reference.
+
+    :param name: Name of the engine in the reports
+    :param function: Function called as function(analysis, df, **kwargs)
+
+    :raises: ValueError
+        If the name is the reference
+    """
+
+    if name == REFERENCE:
+        raise ValueError('The reference engine cannot be replaced')
+
+    ENGINES[name] = function
+
+
+def _keys(analysis: str,
+          output: pd.DataFrame,
+          kwargs: dict):
+    """
+    Utility to list the columns identifying the output rows of an entry point.
+    """
+
+    if analysis == 'process_outcomes':
+        batch = [col for col in ENTRY_POINTS[analysis][1][:-1] if col in output.columns]
+        return batch + [kwargs['patient_col'], kwargs['encounter_col']]
+
+    return [kwargs[arg] for arg in UNITS[analysis]]
+
+
+def _occurrence(df: pd.DataFrame,
+                keys: list):
+    """
+    Utility to sort on the keys and number repeated keys so every row has a unique merge key.
+    """
+
+    df = df.sort_values(keys, kind='stable')
+    return df.assign(**{OCCURRENCE: df.groupby(keys, sort=False, dropna=False).cumcount()})
+
+
+def diff_frames(reference: pd.DataFrame,
+                candidate: pd.DataFrame,
+                keys: list):
+    """
+    Compares two results on their keys. Rows only in the reference are 'missing', rows only
+    in the candidate are 'extra', and every differing value of a shared row is a 'value'
+    difference. Columns only in one of the results are reported once as 'missing_column'
+    or 'extra_column'. Missing values are equal to each other, the index is ignored.
+
+    :param reference: Result of the reference engine
+    :param candidate: Result to compare
+    :param keys: Columns identifying the rows
+
+    :return: Returns a pandas dataframe with the keys, kind, column, and the reference and
+    candidate values, empty when the results are the same
+
+    :raises: KeyError
+        If a key column is not present in both results
+    """
+
+    keys = list(keys)
+    if not set(keys).issubset(reference.columns) or not set(keys).issubset(candidate.columns):
+        raise KeyError(f"Ensure that columns {keys} are present in both results.")
+
+    merge_keys = [*keys, OCCURRENCE]
+    merged = _occurrence(reference, keys).merge(_occurrence(candidate, keys),
+                                                how='outer',
+                                                on=merge_keys,
+                                                suffixes=('_reference', '_candidate'),
+                                                indicator=True,
+                                                sort=True)
+    side = merged.pop('_merge')
+
+    found = []
+    for kind, rows in [('missing', side == 'left_only'), ('extra', side == 'right_only')]:
+        if rows.any():
+            found.append(merged.loc[rows, keys].assign(kind=kind, column=None, reference=None, candidate=None))
+
+    both = (side == 'both').to_numpy()
+    shared_cols = [col for col in reference.columns if col in candidate.columns and col not in keys]
+    for col in shared_cols:
+        left = merged[f'{col}_reference']
+        right = merged[f'{col}_candidate']
+        left_values = left.astype(object).to_numpy()
+        right_values = right.astype(object).to_numpy()
+        missing = pd.isna(left).to_numpy() & pd.isna(right).to_numpy()
+        rows = both & ~missing & (left_values != right_values)
+        if rows.any():
+            found.append(merged.loc[rows, keys].assign(kind='value',
+                                                       column=col,
+                                                       reference=left_values[rows],
+                                                       candidate=right_values[rows]))
+
+    for kind, cols in [('missing_column', reference.columns.difference(candidate.columns)),
+                       ('extra_column', candidate.columns.difference(reference.columns))]:
+        for col in cols:
+            found.append(pd.DataFrame({key: [None] for key in keys})
+                         .assign(kind=kind, column=col, reference=None, candidate=None))
+
+    columns = [*keys, *DIFFERENCE_COLUMNS[1:]]
+    if not found:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(found, ignore_index=True)[columns]
+
+
+def verify(analysis: str,
+           df: pd.DataFrame,
+           engines=None,
+           strict: bool = True,
+           **kwargs):
+    """
+    Runs the reference and the engines on the same data and compares their results.
+
+    :param analysis: Name of the entry point: 'process_outcomes', 'smm', 'apo', or 'calc_index'
+    :param df: Pandas dataframe passed to the entry point
+    :param engines: Optional list of engine names, defaults to every registered engine
+    :param strict: Raise EngineMismatch when any engine differs from the reference
+    :param kwargs: Arguments of the entry point other than the dataframe
+
+    :return: Returns a pandas dataframe with the engine, the keys, kind, column, and the
+    reference and candidate values of every difference, empty when the engines agree
+
+    :raises: EngineMismatch
+        If strict and an engine differs from the reference
+    :raises: ValueError
+        If the analysis or an engine does not exist
+    """
+
+    _entry_point(analysis)
+    engines = [name for name in ENGINES if name != REFERENCE] if engines is None else list(engines)
+    unknown = set(engines) - set(ENGINES)
+    if unknown:
+        raise ValueError(f'Unknown engines {unknown}, registered engines are {list(ENGINES)}')
+
+    reference = ENGINES[REFERENCE](analysis, df, **kwargs)
+    keys = _keys(analysis, reference, kwargs)
+
+    found = [diff_frames(reference, ENGINES[name](analysis, df, **kwargs), keys).assign(engine=name)
+             for name in engines]
+    columns = ['engine', *keys, *DIFFERENCE_COLUMNS[1:]]
+    differences = pd.concat(found, ignore_index=True)[columns] if found else pd.DataFrame(columns=columns)
+
+    if strict and len(differences):
+        raise EngineMismatch(differences)
+
+    return differences
+
+
+def verify_synthetic(n_rows: int = 100_000,
+                     seed: int = 0,
+                     analyses=None,
+                     engines=None,
+                     edge_patients: int = 1_000,
+                     strict: bool = True):
+    """
+    Compares engines against the reference on a seeded synthetic cohort and on each edge case
+    cohort of edge_case_claims.
+
+    :param n_rows: Approximate number of rows of the synthetic cohort
+    :param seed: Seed of the cohorts
+    :param analyses: Optional list of entry points, defaults to all of them
+    :param engines: Optional list of engine names, defaults to every registered engine
+    :param edge_patients: Number of patients in each edge case cohort
+    :param strict: Raise EngineMismatch when any engine differs from the reference
+
+    :return: Returns a pandas dataframe of the differences with the cohort and analysis
+    of each, see verify
+
+    :raises: EngineMismatch
+        If strict and an engine differs from the reference
+    """
+
+    from .synthetic import synthetic_claims, edge_case_claims, EDGE_CASES
+
+    cohorts = {'synthetic': synthetic_claims(n_rows, pregnancy_density=0.5, seed=seed)}
+    for case in EDGE_CASES:
+        cohorts[case] = edge_case_claims(case, edge_patients, seed=seed)
+
+    found = []
+    for cohort, df in cohorts.items():
+        for analysis in analyses or list(SYNTHETIC_ARGS):
+            differences = verify(analysis, df, engines, strict=False, **SYNTHETIC_ARGS[analysis])
+            found.append(differences.assign(cohort=cohort, analysis=analysis))
+
+    differences = pd.concat(found, ignore_index=True)
+    differences = differences[['cohort', 'analysis',
+                               *[col for col in differences.columns if col not in ['cohort', 'analysis']]]]
+    if strict and len(differences):
+        raise EngineMismatch(differences)
+
+    return differences
@@ -364,7 +364,7 @@ if __name__  == "__main__":
         print(out[3][out[3].outcome == 'THERAPEUTIC_ABORTION'].code.str.cat(sep='|'))
 
     def test_basic_preg_outcomes():
-        from src.pypreg import process_outcomes, OUTCOME_LIST
+        from src.pypreg import process_outcomes, OUTCOME_LIST, OUTCOME_DTYPE
 
         basic_date = pd.to_datetime('2010-01-01')
 
@@ -414,6 +414,7 @@ if __name__  == "__main__":
                          'preg_num']
 
         expected_df = pd.DataFrame(expected, columns=expected_cols)
+        expected_df['outcome'] = expected_df['outcome'].astype(OUTCOME_DTYPE)
         outcome = outcome[[x for x in outcome.columns if x in expected_cols]].reset_index(drop=True)
 
         outcome['start_window'] = pd.to_datetime(outcome['start_window'])
@@ -422,7 +423,7 @@ if __name__  == "__main__":
         assert_frame_equal(outcome, expected_df)
 
     def test_preg_hierarchy():
-        from src.pypreg import process_outcomes, OUTCOME_LIST
+        from src.pypreg import process_outcomes, OUTCOME_LIST, OUTCOME_DTYPE
 
         basic_date = pd.to_datetime('2010-01-01')
 
@@ -490,6 +491,7 @@ if __name__  == "__main__":
                          'preg_num']
 
         expected_df = pd.DataFrame(expected, columns=expected_cols)
+        expected_df['outcome'] = expected_df['outcome'].astype(OUTCOME_DTYPE)
         outcome = outcome[[x for x in outcome.columns if x in expected_cols]].reset_index(drop=True)
 
         outcome['start_window'] = pd.to_datetime(outcome['start_window'])
@@ -498,7 +500,7 @@ if __name__  == "__main__":
         assert_frame_equal(outcome, expected_df)
 
     def test_multiple_pregs():
-        from src.pypreg import process_outcomes, OUTCOME_LIST
+        from src.pypreg import process_outcomes, OUTCOME_LIST, OUTCOME_DTYPE
 
         data = [[1, 1, pd.to_datetime('2010-01-01'), 'DX', '9', '633.1'],
                 [1, 8, pd.to_datetime('2010-01-05'), 'DX', '9', '632.5'],
@@ -547,6 +549,7 @@ if __name__  == "__main__":
                          'preg_num']
 
         expected_df = pd.DataFrame(expected, columns=expected_cols)
+        expected_df['outcome'] = expected_df['outcome'].astype(OUTCOME_DTYPE)
         outcome = outcome[[x for x in outcome.columns if x in expected_cols]].reset_index(drop=True)
 
         outcome['start_window'] = pd.to_datetime(outcome['start_window'])
@@ -555,6 +558,1035 @@ if __name__  == "__main__":
         assert_frame_equal(outcome, expected_df)
     
 
+    def test_sql_generation():
+        import sqlite3
+        from src.pypreg import smm, calc_index
+        from src.pypreg.sql import create_code_tables, run_sql, smm_sql, index_sql
+
+        con = create_code_tables(sqlite3.connect(':memory:'))
+
+        smm_data = [[1, 'DX', '9', '410.12'],
+                    [1, 'PX', '10', '30230H0'],
+                    [2, 'PX', '9', '96.72'],
+                    [3, 'PX', '9', '0000'],
+                    [4, 'PX', '10', '30230H0']]
+        smm_cols = ['encounter_id', 'code_type', 'code_version', 'code']
+        smm_df = pd.DataFrame(smm_data, columns=smm_cols)
+        smm_df.to_sql('smm_codes', con, index=False)
+
+        expected = smm(smm_df.copy(), *smm_cols, indicators=True)
+        result = run_sql(con, smm_sql('smm_codes', *smm_cols, indicators=True))
+        result = result[expected.columns].astype(expected.dtypes.to_dict())
+
+        assert_frame_equal(result.sort_values(smm_cols[0]).reset_index(drop=True),
+                           expected.sort_values(smm_cols[0]).reset_index(drop=True))
+
+        index_data = [[1, 1, '416.09', '9', 45],
+                      [1, 1, '642.39', '9', 45],
+                      [1, 1, '642.49', '9', 45],
+                      [1, 1, '642.59', '9', 45],
+                      [1, 2, '642.39', '9', 30],
+                      [1, 3, 'O24.49', '10', 36]]
+        index_cols = ['patient_id', 'preg_num', 'code', 'version', 'age']
+        index_df = pd.DataFrame(index_data, columns=index_cols)
+        index_df.to_sql('index_codes', con, index=False)
+
+        for method in ['bateman', 'leonard']:
+            expected = calc_index(index_df.copy(), *index_cols[:-1], method=method, age_col='age')
+            result = run_sql(con, index_sql('index_codes', *index_cols[:-1],
+                                            method=method, age_col='age'))
+
+            assert_frame_equal(result.sort_values(index_cols[:2]).reset_index(drop=True),
+                               expected, check_dtype=False)
+
+
+    def test_sql_equivalence():
+        from src.pypreg import apo, process_outcomes
+        from src.pypreg.pregnancy_outcome.attach_map import attach_map
+        from src.pypreg.pregnancy_outcome.process_outcome import standardize_type_and_version
+        from src.pypreg.sql import connect, run_sql, apo_sql, outcome_sql
+        from src.pypreg.synthetic import synthetic_claims
+
+        # DuckDB is optional, the SQLite run always happens
+        engines = ['sqlite']
+        try:
+            import duckdb
+            engines.append('duckdb')
+        except ImportError:
+            pass
+
+        df = synthetic_claims(3000, pregnancy_density=0.8, seed=11)
+        pregnancies = process_outcomes(df.copy(), 'patient_id', 'encounter_id', 'admit_date', 'code_version',
+                                       'code_type', 'code')
+
+        # The dates are loaded as text, SQLite has no date type
+        df['admit_date'] = df['admit_date'].astype(str)
+        preg = df[df['preg_id'] > 0].reset_index(drop=True)
+        apo_cols = ['patient_id', 'preg_id', 'code_type', 'code_version', 'code']
+        outcome_cols = ['patient_id', 'encounter_id', 'admit_date', 'code_version', 'code_type', 'code']
+
+        expected_apo = apo(preg.copy(), *apo_cols).sort_values(apo_cols[:2]).reset_index(drop=True)
+        standard = standardize_type_and_version(df.rename(columns={'code_version': 'version'}),
+                                                'code_type', 'version')
+        classified = attach_map(standard, 'code', 'code_type', 'version')
+        expected_outcomes = set(classified[['encounter_id', 'code', 'outcome']].itertuples(index=False))
+
+        for engine in engines:
+            con = connect(engine=engine)
+            if engine == 'duckdb':
+                con.register('claims', df)
+                con.register('preg', preg)
+            else:
+                df.to_sql('claims', con, index=False)
+                preg.to_sql('preg', con, index=False)
+
+            result = run_sql(con, apo_sql('preg', *apo_cols))
+            result = result[expected_apo.columns].astype(expected_apo.dtypes.to_dict())
+            assert_frame_equal(result.sort_values(apo_cols[:2]).reset_index(drop=True), expected_apo)
+
+            # The classification matches attach_map, and holds every outcome process_outcomes keeps
+            result = run_sql(con, outcome_sql('claims', *outcome_cols))
+            found = set(result[['encounter_id', 'code', 'outcome']].itertuples(index=False))
+            assert found == expected_outcomes
+            assert set(pregnancies[['encounter_id', 'outcome']].astype({'outcome': str}).itertuples(index=False)) \
+                <= {(encounter, outcome) for encounter, _, outcome in found}
+
+            con.close()
+
+
+    def test_synthetic_claims():
+        from src.pypreg import process_outcomes
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(5000, pregnancy_density=0.5, seed=7)
+
+        assert len(df) == 5000
+        assert_frame_equal(df, synthetic_claims(5000, pregnancy_density=0.5, seed=7))
+        assert not df.equals(synthetic_claims(5000, pregnancy_density=0.5, seed=8))
+        assert (synthetic_claims(5000, pregnancy_density=0, seed=7)['preg_id'] == 0).all()
+
+        outcomes = process_outcomes(df[df['code_type'] != 'DRG'].copy(), 'patient_id', 'encounter_id',
+                                    'admit_date', 'code_version', 'code_type', 'code')
+        assert len(outcomes) > 0
+        assert set(outcomes['patient_id']) <= set(df.loc[df['preg_id'] > 0, 'patient_id'])
+
+
+    def test_instrument():
+        from src.pypreg import calc_index, smm, instrument, StageReport
+
+        index_df = pd.DataFrame([[1, 1, '642.39', '9'],
+                                 [1, 1, '642.49', '9'],
+                                 [1, 2, 'O24.49', '10']],
+                                columns=['patient_id', 'preg_num', 'code', 'version'])
+        smm_df = pd.DataFrame([[1, 'DX', '9', '410.12']],
+                              columns=['encounter_id', 'code_type', 'code_version', 'code'])
+
+        report = StageReport()
+        with instrument(report, memory=True):
+            output = calc_index(index_df, 'patient_id', 'preg_num', 'code', 'version', method='bateman')
+        smm(smm_df, 'encounter_id', 'code_type', 'code_version', 'code')
+
+        events = report.to_frame()
+        assert events['entry'].unique().tolist() == ['calc_index']
+        assert events['stage'].to_list() == ['standardize', 'assign_weights', 'score']
+        assert events['rows_in'].iloc[0] == 3
+        assert events['rows_out'].iloc[-1] == len(output)
+        assert (events['rows_in'].iloc[1:].values == events['rows_out'].iloc[:-1].values).all()
+        assert (events['seconds'] >= 0).all()
+        assert events['peak_memory_delta'].notna().all()
+        assert report.to_csv().startswith(','.join(events.columns))
+
+        # Memory tracing belongs to one context, another thread is refused while it runs
+        import threading
+        refused = []
+
+        def trace_elsewhere():
+            try:
+                with instrument(StageReport(), memory=True):
+                    pass
+            except RuntimeError:
+                refused.append(True)
+
+        with instrument(StageReport(), memory=True):
+            with instrument(report, memory=True):
+                calc_index(index_df, 'patient_id', 'preg_num', 'code', 'version', method='bateman')
+            thread = threading.Thread(target=trace_elsewhere)
+            thread.start()
+            thread.join()
+        assert refused == [True]
+        assert report.to_frame()['peak_memory_delta'].notna().all()
+
+
+    def test_concurrent_entry_points():
+        import warnings
+        from concurrent.futures import ThreadPoolExecutor
+        from src.pypreg import process_outcomes, smm, apo, calc_index
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(4000, pregnancy_density=0.6, seed=3, smm_rate=0.3)
+        df = df[df['code_type'] != 'DRG'].reset_index(drop=True)
+        pregnancies = df[df['preg_id'] > 0].reset_index(drop=True)
+        original = df.copy()
+        original_pregnancies = pregnancies.copy()
+
+        calls = [lambda: process_outcomes(df, 'patient_id', 'encounter_id', 'admit_date',
+                                          'code_version', 'code_type', 'code'),
+                 lambda: smm(df, 'encounter_id', 'code_type', 'code_version', 'code', indicators=True),
+                 lambda: apo(pregnancies, 'patient_id', 'preg_id', 'code_type', 'code_version', 'code'),
+                 lambda: calc_index(pregnancies, 'patient_id', 'preg_id', 'code', 'code_version',
+                                    method='bateman', age_col='age')]
+
+        filters = list(warnings.filters)
+        chained_assignment = pd.options.mode.chained_assignment
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            expected = [call() for call in calls]
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                results = list(pool.map(lambda i: (i % len(calls), calls[i % len(calls)]()),
+                                        range(8 * len(calls))))
+
+        for i, result in results:
+            assert_frame_equal(result.sort_index(axis=1), expected[i].sort_index(axis=1))
+
+        # Inputs and global state are untouched
+        assert_frame_equal(df, original)
+        assert_frame_equal(pregnancies, original_pregnancies)
+        assert warnings.filters == filters
+        assert pd.options.mode.chained_assignment == chained_assignment
+
+
+    def test_assign_pregnancy():
+        from src.pypreg import assign_pregnancy
+
+        pregnancies = pd.DataFrame([[1, 1, '2020-01-01', '2020-09-01'],
+                                    [1, 2, '2020-09-20', '2021-06-01'],
+                                    [2, 1, '2020-03-01', '2020-05-01']],
+                                   columns=['patient_id', 'preg_num', 'start_window', 'event_date'])
+        encounters = pd.DataFrame([[1, '2019-12-31'],
+                                   [1, '2020-01-01'],
+                                   [1, '2020-09-01'],
+                                   [1, '2020-09-10'],
+                                   [1, '2020-09-25'],
+                                   [1, '2021-07-01'],
+                                   [2, '2020-04-01'],
+                                   [3, '2020-04-01'],
+                                   [2, None]],
+                                  columns=['patient_id', 'admit_date'])
+        encounters['admit_date'] = pd.to_datetime(encounters['admit_date'])
+
+        output = assign_pregnancy(encounters, pregnancies, 'patient_id', 'admit_date')
+        assert output.index.to_list() == [1, 2, 4, 6]
+        assert output['preg_num'].to_list() == [1, 1, 2, 1]
+
+        # The postpartum span of the first pregnancy reaches into the second window
+        output = assign_pregnancy(encounters, pregnancies, 'patient_id', 'admit_date',
+                                  postpartum=42, how='left')
+        assert output['preg_num'].to_list() == [pd.NA, 1, 1, 1, 2, 2, 1, pd.NA, pd.NA]
+        assert 'preg_num' not in encounters.columns
+
+
+    def test_spacing_configs():
+        from src.pypreg import process_outcomes
+
+        data = [[1, 1, '2020-01-01', '10', 'dx', 'Z37.0'],
+                [1, 2, '2020-05-01', '10', 'dx', 'O03.9'],
+                [1, 3, '2020-09-01', '10', 'dx', 'O03.9']]
+        cols = ['patient_id', 'encounter_id', 'admit_date', 'version', 'code_type', 'code']
+        df = pd.DataFrame(data, columns=cols)
+        df['admit_date'] = pd.to_datetime(df['admit_date'])
+
+        configs = {'moll': {},
+                   'long gaps': {'next_outcome': {'LIVE_BIRTH': [365] * 7,
+                                                  'SPONTANEOUS_ABORTION': [365] * 7}}}
+        output = process_outcomes(df, *cols, spacing_configs=configs)
+
+        assert_frame_equal(output[output['config_id'] == 'moll']
+                           .drop(columns='config_id')
+                           .reset_index(drop=True),
+                           process_outcomes(df, *cols).reset_index(drop=True))
+        assert output.groupby('config_id').size().to_dict() == {'long gaps': 1, 'moll': 3}
+
+        # Identifiers of different types are kept apart without being compared
+        mixed = process_outcomes(df, *cols, spacing_configs={'long gaps': configs['long gaps'], 0: {}})
+        assert mixed['config_id'].value_counts().to_dict() == {0: 3, 'long gaps': 1}
+
+        try:
+            process_outcomes(df, *cols, spacing_configs=[{'max_term': [301]}])
+            assert False
+        except ValueError:
+            pass
+
+
+    def test_schema_selections():
+        from src.pypreg import process_outcomes
+        from src.pypreg.synthetic import synthetic_claims
+
+        cols = ['patient_id', 'encounter_id', 'admit_date', 'code_version', 'code_type', 'code']
+        df = synthetic_claims(3000, pregnancy_density=0.8, seed=11)
+
+        selections = {'moll': ['MOLL', 'CROSSWALK'],
+                      'expanded': ['MOLL', 'CROSSWALK', 'EXPANDED']}
+        output = process_outcomes(df, *cols, schemas=selections)
+
+        for schema_id, expanded in [('moll', False), ('expanded', True)]:
+            assert_frame_equal(output[output['schema_id'] == schema_id]
+                               .drop(columns='schema_id')
+                               .reset_index(drop=True),
+                               process_outcomes(df, *cols, expanded=expanded).reset_index(drop=True))
+
+
+    def test_partitioned():
+        from src.pypreg import process_outcomes, smm, apo, calc_index
+        from src.pypreg.partition import run_partitioned
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(3000, pregnancy_density=0.8, seed=5)
+        preg = df[df['preg_id'] > 0]
+
+        cases = [(process_outcomes, df, {'patient_col': 'patient_id',
+                                         'encounter_col': 'encounter_id',
+                                         'admit_date_col': 'admit_date',
+                                         'version_col': 'code_version',
+                                         'type_col': 'code_type',
+                                         'code_col': 'code'}),
+                 (smm, df, {'enc_id': 'encounter_id',
+                            'code_type': 'code_type',
+                            'version': 'code_version',
+                            'code': 'code',
+                            'indicators': True}),
+                 (apo, preg, {'patient_id': 'patient_id',
+                              'preg_id': 'preg_id',
+                              'code_type': 'code_type',
+                              'version': 'code_version',
+                              'code': 'code'}),
+                 (calc_index, preg, {'patient_col': 'patient_id',
+                                     'pregnancy_col': 'preg_id',
+                                     'code_col': 'code',
+                                     'version_col': 'code_version',
+                                     'method': 'bateman',
+                                     'age_col': 'age'})]
+
+        for function, data, kwargs in cases:
+            expected = function(data, **kwargs).reset_index(drop=True)
+            for workers in [1, 2]:
+                assert_frame_equal(run_partitioned(function.__name__, data, n_partitions=4,
+                                                   workers=workers, **kwargs),
+                                   expected)
+
+            # Inputs without rows give the empty result, an empty chunk iterator included
+            empty = function(data.head(0), **kwargs).reset_index(drop=True)
+            assert_frame_equal(run_partitioned(function.__name__, iter([data.head(0)]), **kwargs), empty)
+            assert run_partitioned(function.__name__, iter([]), **kwargs).empty
+
+        import tempfile
+        from pathlib import Path
+        from src.pypreg.partition import partition_data
+        with tempfile.TemporaryDirectory() as directory:
+            # A file with a missing identifier reads it as float, its patients stay in one partition
+            Path(f'{directory}/in').mkdir()
+            pd.DataFrame({'pid': [5, 6], 'x': [1, 2]}).to_csv(f'{directory}/in/a.csv', index=False)
+            pd.DataFrame({'pid': [5, None], 'x': [3, 4]}).to_csv(f'{directory}/in/b.csv', index=False)
+            for part in partition_data(f'{directory}/in', 'pid', f'{directory}/parts', 16):
+                rows = pd.concat([pd.read_parquet(file) for file in Path(part).glob('*.parquet')])
+                assert rows['pid'].nunique() == 0 or (rows['pid'] == 5).sum() in [0, 2]
+
+            # Codes in CSV files are read as text, ICD9 650 is not a number
+            pd.DataFrame({'enc': [1, 2], 'code_type': ['DX', 'DX'], 'version': ['9', '9'],
+                          'code': ['669.1', '650']}).to_csv(f'{directory}/codes.csv', index=False)
+            output = run_partitioned('smm', f'{directory}/codes.csv', enc_id='enc', code_type='code_type',
+                                     version='version', code='code')
+            assert output['enc'].tolist() == [1] and output['smm'].tolist() == [True]
+
+
+    def test_cli():
+        import json
+        import tempfile
+        from pathlib import Path
+        from src.pypreg import smm
+        from src.pypreg.cli import main
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(2000, pregnancy_density=0.8, seed=3)
+        with tempfile.TemporaryDirectory() as directory:
+            df.to_csv(f'{directory}/claims.csv', index=False)
+            args = [f'{directory}/claims.csv', f'{directory}/out',
+                    '--analyses', 'smm',
+                    '--columns', 'encounter=encounter_id', 'version=code_version',
+                    'patient=patient_id',
+                    '--partitions', '3']
+            assert main(args) == 0
+
+            files = sorted(Path(directory, 'out', 'smm').glob('*.parquet'))
+            output = pd.concat([pd.read_parquet(file) for file in files])\
+                .sort_values('encounter_id')\
+                .reset_index(drop=True)
+            assert_frame_equal(output,
+                               smm(df, 'encounter_id', 'code_type', 'code_version', 'code').reset_index(drop=True),
+                               check_dtype=False)
+
+            # A partition missing from the manifest is the only one run again
+            manifest_path = Path(directory, 'out', 'manifest.json')
+            manifest = json.loads(manifest_path.read_text())
+            missing = manifest['done']['smm'].pop()
+            Path(directory, 'out', 'smm', f'{missing}.parquet').unlink()
+            manifest_path.write_text(json.dumps(manifest))
+            assert main(args) == 0
+            assert len(json.loads(manifest_path.read_text())['done']['smm']) == len(files)
+            assert Path(directory, 'out', 'smm', f'{missing}.parquet').exists()
+
+
+    def test_provenance():
+        from src.pypreg import process_outcomes, smm, pattern_table
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(3000, pregnancy_density=0.8, seed=2)
+        patterns = pattern_table()
+
+        cols = ['patient_id', 'encounter_id', 'admit_date', 'code_version', 'code_type', 'code']
+        outcomes = process_outcomes(df, *cols, provenance=True)
+        assert_frame_equal(outcomes.drop(columns='pattern_id'), process_outcomes(df, *cols))
+
+        # Each id points to an outcome pattern for the outcome that was reported
+        audit = outcomes.merge(patterns, how='left', on='pattern_id')
+        assert (audit['code_set'] == 'outcome').all()
+        assert (audit['label'] == audit['outcome']).all()
+
+        smm_df = smm(df, 'encounter_id', 'code_type', 'code_version', 'code', provenance=True)
+        assert_frame_equal(smm_df.drop(columns=['smm_pattern_id', 'transfusion_pattern_id']),
+                           smm(df, 'encounter_id', 'code_type', 'code_version', 'code'))
+        assert (smm_df['smm'] == smm_df['smm_pattern_id'].notna()).all()
+        assert (smm_df['transfusion'] == smm_df['transfusion_pattern_id'].notna()).all()
+        flagged = smm_df['smm_pattern_id'].dropna().astype(int)
+        assert (patterns.set_index('pattern_id').loc[flagged, 'code_set'] == 'smm').all()
+
+
+    def test_cohort_summary():
+        from src.pypreg import smm, calc_index, summarize, CohortSummary
+        from src.pypreg.partition import run_partitioned
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(4000, pregnancy_density=0.8, seed=4)
+        df['year'] = pd.to_datetime(df['admit_date']).dt.year
+        preg = df[df['preg_id'] > 0]
+
+        def rates(summary):
+            return summary.rates().sort_values(['year', 'measure']).reset_index(drop=True)
+
+        smm_cols = ['encounter_id', 'code_type', 'code_version', 'code']
+        whole = summarize(smm(df, *smm_cols), 'smm', by=['year'], population=df, on='encounter_id')
+        assert whole.counts['n'].sum() == df['encounter_id'].nunique()
+
+        # Summaries of parts merge to the summary of the whole, in any grouping
+        parts = [df[df['patient_id'] % 3 == i] for i in range(3)]
+        summaries = [summarize(smm(part, *smm_cols), 'smm', by=['year'], population=part, on='encounter_id')
+                     for part in parts]
+        assert_frame_equal(rates((summaries[0] + summaries[1]) + summaries[2]), rates(whole), check_dtype=False)
+        assert_frame_equal(rates(summaries[0] + (summaries[2] + summaries[1])), rates(whole), check_dtype=False)
+        assert_frame_equal(rates(CohortSummary.from_dict(whole.to_dict())), rates(whole), check_dtype=False)
+
+        index_kwargs = {'patient_col': 'patient_id',
+                        'pregnancy_col': 'preg_id',
+                        'code_col': 'code',
+                        'version_col': 'code_version',
+                        'method': 'bateman'}
+        scores = summarize(calc_index(preg, **index_kwargs), 'calc_index',
+                           population=preg, on=['patient_id', 'preg_id'])
+        partitioned = run_partitioned('calc_index', preg, n_partitions=3, summary={}, **index_kwargs)
+        assert_frame_equal(partitioned.histogram('bateman_score').sort_values('value').reset_index(drop=True),
+                           scores.histogram('bateman_score').sort_values('value').reset_index(drop=True),
+                           check_dtype=False)
+        assert scores.histogram('bateman_score')['count'].sum() == preg.groupby(['patient_id', 'preg_id']).ngroups
+
+
+    def test_shared_memory():
+        from multiprocessing.shared_memory import SharedMemory
+        import numpy as np
+        from src.pypreg import process_outcomes, calc_index
+        from src.pypreg.shared import run_shared, SharedColumns, attach_shared
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(3000, pregnancy_density=0.8, seed=6)
+        df['patient_id'] = 'P' + df['patient_id'].astype(str)
+
+        cols = {'patient_col': 'patient_id',
+                'encounter_col': 'encounter_id',
+                'admit_date_col': 'admit_date',
+                'version_col': 'code_version',
+                'type_col': 'code_type',
+                'code_col': 'code'}
+        expected = process_outcomes(df, **cols).reset_index(drop=True)
+        for workers in [1, 2]:
+            assert_frame_equal(run_shared('process_outcomes', df, workers=workers, n_ranges=3, **cols), expected)
+
+        # A missing identifier comes back missing rather than as another patient
+        from src.pypreg import apo
+        missing = pd.DataFrame({'pid': ['a', None, 'b', 'b'], 'preg': [1, 1, 1, 2],
+                                'code_type': ['DX'] * 4, 'version': ['10'] * 4,
+                                'code': ['O80', 'O24.4', 'O80', 'O14.0']})
+        apo_cols = {'patient_id': 'pid', 'preg_id': 'preg', 'code_type': 'code_type',
+                    'version': 'version', 'code': 'code'}
+        shared_apo = run_shared('apo', missing, workers=1, n_ranges=2, **apo_cols)
+        assert shared_apo['pid'].isna().sum() == 1
+        assert shared_apo.loc[shared_apo['pid'].isna(), 'gest diabetes mellitus'].tolist() == [True]
+        assert not shared_apo.loc[shared_apo['pid'] == 'b', 'gest diabetes mellitus'].any()
+        assert len(shared_apo) == len(apo(missing, **apo_cols))
+
+        # Workers read views of the blocks rather than copies of their rows
+        with SharedColumns({'values': np.arange(10)}) as shared:
+            with attach_shared(shared.spec, 2, 5) as columns:
+                assert columns['values'].tolist() == [2, 3, 4]
+                assert not columns['values'].flags.owndata
+                frame = pd.DataFrame(columns, copy=False)
+                assert np.shares_memory(frame['values'].to_numpy(), columns['values'])
+                del frame
+
+        # Blocks are removed when the context exits with an error
+        try:
+            with SharedColumns({'values': np.arange(10)}) as shared:
+                name = shared.spec['values'][0]
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        try:
+            SharedMemory(name=name).close()
+            assert False
+        except FileNotFoundError:
+            pass
+
+        # Errors raised in a worker reach the caller
+        try:
+            run_shared('calc_index', df, workers=2, patient_col='patient_id', pregnancy_col='preg_id',
+                       code_col='code', version_col='code_version', method='unknown')
+            assert False
+        except ValueError:
+            pass
+
+
+    def test_result_cache():
+        import tempfile
+        from pathlib import Path
+        from src.pypreg import process_outcomes, ResultCache
+        from src.pypreg.partition import run_partitioned
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(3000, pregnancy_density=0.8, seed=8)
+        cols = {'patient_col': 'patient_id',
+                'encounter_col': 'encounter_id',
+                'admit_date_col': 'admit_date',
+                'version_col': 'code_version',
+                'type_col': 'code_type',
+                'code_col': 'code'}
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ResultCache(directory)
+
+            def cached():
+                return {path.name for path in Path(directory).glob('*.pkl')}
+
+            expected = process_outcomes(df, **cols).reset_index(drop=True)
+            assert_frame_equal(run_partitioned('process_outcomes', df, n_partitions=4, cache=cache, **cols), expected)
+            first = cached()
+            assert len(first) == 4
+
+            # An unchanged rerun is served from the cache
+            assert_frame_equal(run_partitioned('process_outcomes', df, n_partitions=4, cache=cache, **cols), expected)
+            assert cached() == first
+
+            # Changing one patient only recomputes that patient's partition
+            changed = df.copy()
+            changed.loc[changed.index[0], 'code'] = 'Z3A.39'
+            assert_frame_equal(run_partitioned('process_outcomes', changed, n_partitions=4, cache=cache, **cols),
+                               process_outcomes(changed, **cols).reset_index(drop=True))
+            assert len(cached() - first) == 1
+
+            assert ResultCache(directory, max_files=2).evict() == 3
+            assert len(cached()) == 2
+
+
+    def test_memory_limit():
+        from src.pypreg import process_outcomes, apo, estimate_memory, run_within
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(5000, pregnancy_density=0.8, seed=9)
+        cols = {'patient_col': 'patient_id',
+                'encounter_col': 'encounter_id',
+                'admit_date_col': 'admit_date',
+                'version_col': 'code_version',
+                'type_col': 'code_type',
+                'code_col': 'code'}
+
+        limit = max(estimate_memory('process_outcomes', df, **cols).values()) // 4
+        output = process_outcomes(df, **cols, memory_limit=limit)
+        assert_frame_equal(output, process_outcomes(df, **cols).reset_index(drop=True))
+        assert output.attrs['memory']['chunks'] > 1
+        assert output.attrs['memory']['peak'] is None
+        rss = output.attrs['memory']['rss']
+        assert len(rss) == output.attrs['memory']['chunks'] and 0 < rss[0] <= rss[-1]
+
+        # The peak is only traced on request, and tracing started elsewhere is left running
+        import tracemalloc
+        output = run_within('process_outcomes', df, limit, trace_memory=True, **cols)
+        assert 0 < output.attrs['memory']['peak']
+        assert 0 < process_outcomes(df, **cols, memory_limit=limit, trace_memory=True).attrs['memory']['peak']
+        assert not tracemalloc.is_tracing()
+        tracemalloc.start()
+        try:
+            output = run_within('process_outcomes', df, limit, trace_memory=True, **cols)
+            assert output.attrs['memory']['peak'] is None
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
+
+        # Chunking can't bring an input that is over the limit on its own under it
+        import warnings
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            process_outcomes(df, **cols, memory_limit=1000)
+        assert any('input alone' in str(warning.message) for warning in caught)
+
+        apo_cols = ['patient_id', 'preg_id', 'code_type', 'code_version', 'code']
+        output = apo(df, *apo_cols, memory_limit=limit)
+        assert_frame_equal(output, apo(df, *apo_cols).reset_index(drop=True))
+
+        # A limit above the estimate runs in a single call
+        assert apo(df, *apo_cols, memory_limit=2 ** 40).attrs['memory']['chunks'] == 1
+
+
+    def test_verify_engines():
+        from src.pypreg.verify import verify, diff_frames, register_engine, ENGINES, EngineMismatch, SYNTHETIC_ARGS
+        from src.pypreg.synthetic import edge_case_claims, EDGE_CASES
+
+        for case in EDGE_CASES:
+            df = edge_case_claims(case, 20, seed=3)
+            assert len(verify('process_outcomes', df, ['in_memory', 'partitioned', 'shared'],
+                              **SYNTHETIC_ARGS['process_outcomes'])) == 0
+
+        # The reference is the frozen copy, not the entry point it checks
+        from src.pypreg import reference, process_outcomes
+        assert reference.process_outcomes is not process_outcomes
+        assert reference.process_outcomes.__module__.endswith('reference.process_outcome')
+
+        reference = pd.DataFrame({'id': [1, 2, 2, 3], 'flag': [True, False, None, True]})
+        candidate = pd.DataFrame({'id': [4, 2, 2, 1], 'flag': [True, None, True, True]})
+        found = diff_frames(reference, candidate, ['id'])
+        assert found[['id', 'kind', 'column']].values.tolist() == [[3, 'missing', None],
+                                                                  [4, 'extra', None],
+                                                                  [2, 'value', 'flag'],
+                                                                  [2, 'value', 'flag']]
+
+        # An engine that drops a row fails verification
+        register_engine('dropped', lambda analysis, df, **kwargs: ENGINES['reference'](analysis, df, **kwargs).iloc[1:])
+        try:
+            df = edge_case_claims('hierarchy_ties', 20, seed=3)
+            verify('apo', df, ['dropped'], **SYNTHETIC_ARGS['apo'])
+            raise AssertionError('The mismatch was not detected')
+        except EngineMismatch as err:
+            assert err.differences['kind'].tolist() == ['missing']
+        finally:
+            del ENGINES['dropped']
+
+
+    def test_scoring_service():
+        import asyncio
+        import json
+        from src.pypreg.service import ScoringService, MicroBatcher
+
+        async def post(port, target, payload):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            body = json.dumps(payload).encode()
+            writer.write(f'POST {target} HTTP/1.1\r\nContent-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode() + body)
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b'\r\n\r\n')
+            return int(head.split()[1]), json.loads(body)
+
+        async def run():
+            service = ScoringService(max_batch=50, max_delay=0.05)
+            server = await service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                codes = [[{'code_type': 'DX', 'version': '10', 'code': 'O72.3'}],
+                         [{'code_type': 'DX', 'version': '10', 'code': 'O80'}],
+                         [{'code_type': 'PX', 'version': '10', 'code': '30233N1'}]]
+                responses = await asyncio.gather(*[post(port, '/smm', {'encounters': [{'encounter_id': 'E1',
+                                                                                      'codes': codes[idx % 3]}]})
+                                                   for idx in range(30)])
+                status, apo_response = await post(port, '/apo', {'pregnancies': [{'patient_id': 1, 'preg_id': 1,
+                                                                                  'codes': []}]})
+                bad, _ = await post(port, '/smm', {'encounters': [{'codes': []}]})
+                wrong, _ = await post(port, '/smm', {'encounters': [{'encounter_id': 'E2', 'codes': [
+                    {'code_type': 'DX', 'version': '10', 'code': 123}]}]})
+                return responses, apo_response, (bad, wrong), service.metrics()
+            finally:
+                await service.close()
+
+        responses, apo_response, bad, metrics = asyncio.run(run())
+        results = [payload['results'][0] for _, payload in responses]
+        assert [(result['smm'], result['transfusion']) for result in results[:3]] == [(True, False),
+                                                                                      (False, False),
+                                                                                      (False, True)]
+        assert all(result['encounter_id'] == 'E1' for result in results)
+        assert not any(apo_response['results'][0][col] for col in ['cesarean', 'preeclampsia'])
+        assert bad == (400, 400)
+
+        # Concurrent requests share batches
+        assert metrics['smm']['requests'] == 30
+        assert metrics['smm']['batches'] < 30
+        assert metrics['smm']['queue_depth'] == 0
+
+        # A request that fails its batch fails alone, the others in the batch are still scored
+        def score(requests):
+            if any(unit == 'bad' for request in requests for unit in request):
+                raise ValueError('bad unit')
+            return [[unit.upper() for unit in request] for request in requests]
+
+        async def batch():
+            batcher = MicroBatcher(score, max_batch=10, max_delay=0.05)
+            task = asyncio.create_task(batcher.run())
+            try:
+                return await asyncio.gather(batcher.submit(['a']), batcher.submit(['bad']), batcher.submit(['c']),
+                                            return_exceptions=True), batcher.metrics()
+            finally:
+                task.cancel()
+
+        results, metrics = asyncio.run(batch())
+        assert results[0] == ['A'] and isinstance(results[1], ValueError) and results[2] == ['C']
+        assert (metrics['requests'], metrics['errors'], metrics['batches']) == (2, 1, 1)
+
+
+    def test_smm_postpartum():
+        from src.pypreg import smm_postpartum
+
+        pregnancies = pd.DataFrame({'patient_id': [1, 2],
+                                    'encounter_id': [10, 20],
+                                    'preg_num': [1, 1],
+                                    'outcome': ['LIVE_BIRTH', 'LIVE_BIRTH'],
+                                    'event_date': pd.to_datetime(['2020-01-01', '2020-01-01'])})
+        df = pd.DataFrame({'patient_id': [1, 1, 2, 2, 2],
+                           'encounter_id': [10, 11, 20, 21, 22],
+                           'admit_date': pd.to_datetime(['2020-01-01', '2020-02-12', '2020-01-01',
+                                                         '2020-02-13', '2019-12-31']),
+                           'code_type': ['DX', 'DX', 'DX', 'DX', 'DX'],
+                           'code_version': ['10', '10', '10', '10', '10'],
+                           'code': ['O80', 'N17.9', 'O80', 'N17.9', 'I50.9']})
+
+        # The readmission on day 42 counts, the one on day 43 and the one before the delivery do not
+        output = smm_postpartum(df, pregnancies, 'patient_id', 'encounter_id', 'admit_date',
+                                'code_type', 'code_version', 'code')
+        assert output[['patient_id', 'preg_num', 'encounter_id', 'smm']].values.tolist() == [[1, 1, 10, True]]
+
+        output = smm_postpartum(df, pregnancies, 'patient_id', 'encounter_id', 'admit_date',
+                                'code_type', 'code_version', 'code', window=43)
+        assert output['patient_id'].tolist() == [1, 2]
+
+
+    def test_index_flags():
+        from src.pypreg import calc_index, decode_flags, index_indicators
+
+        df = pd.DataFrame({'patient_id': [1, 1, 2, 3],
+                           'preg_id': [1, 1, 1, 1],
+                           'code': ['642.41', '642.61', '416.0', 'V22.0'],
+                           'code_version': ['9', '9', '9', '9']})
+        output = calc_index(df, 'patient_id', 'preg_id', 'code', 'code_version', 'bateman', flags='bitmask')
+        indicators = index_indicators('bateman')
+
+        # Mild preeclampsia is flagged even though eclampsia excludes it from the score
+        assert output['bateman_score'].tolist() == [5, 4, 0]
+        assert output['bateman_flags'].tolist() == [(1 << indicators.index('mild preeclampsia'))
+                                                    | (1 << indicators.index('eclampsia')),
+                                                    1 << indicators.index('pulmonary hypertension'),
+                                                    0]
+
+        sparse = calc_index(df, 'patient_id', 'preg_id', 'code', 'code_version', 'bateman', flags='sparse')
+        assert list(sparse.columns[3:]) == indicators
+        assert_frame_equal(sparse, decode_flags(output, 'bateman'))
+        assert sparse['eclampsia'].sparse.to_dense().tolist() == [True, False, False]
+
+
+    def test_collapse_encounters():
+        from src.pypreg import process_outcomes, instrument, StageReport
+        from src.pypreg.pregnancy_outcome.process_outcome import collapse_encounters
+
+        classified = pd.DataFrame({'patient': [1, 1, 1, 1, 2],
+                                   'encounter': [10, 10, 10, 10, 20],
+                                   'code': ['Z37.0', 'O80', 'O03.9', 'Z37.0', 'O80'],
+                                   'outcome': ['LIVE_BIRTH', 'LIVE_BIRTH', 'SPONTANEOUS_ABORTION',
+                                               'LIVE_BIRTH', 'LIVE_BIRTH'],
+                                   'note': ['a', 'b', 'c', 'd', 'e']})
+        collapsed = collapse_encounters(classified, ['patient', 'encounter'], 'outcome', ['code'])
+        assert collapsed.index.tolist() == [0, 2, 4]
+        assert collapsed['note'].tolist() == ['a', 'c', 'e']
+        assert collapsed['outcome'].tolist() == ['LIVE_BIRTH', 'SPONTANEOUS_ABORTION', 'LIVE_BIRTH']
+
+        # The copies are removed before spacing and validation
+        df = pd.DataFrame({'patient_id': [1, 1, 1],
+                           'encounter_id': [10, 10, 10],
+                           'admit_date': pd.to_datetime(['2020-01-01'] * 3),
+                           'code_type': ['DX', 'DX', 'DX'],
+                           'code_version': ['10', '10', '10'],
+                           'code': ['Z37.0', 'O80', 'Z37.0']})
+        report = StageReport()
+        with instrument(report):
+            output = process_outcomes(df, 'patient_id', 'encounter_id', 'admit_date',
+                                      'code_version', 'code_type', 'code')
+        events = report.to_frame().set_index('stage')
+        assert events.loc['collapse', 'rows_out'] == 1
+        assert output['outcome'].tolist() == ['LIVE_BIRTH']
+
+
+    def test_categorical_dtypes():
+        from src.pypreg import process_outcomes, OUTCOME_DTYPE, CODE_TYPE_DTYPE
+        from src.pypreg.dtypes import standard_labels
+
+        labels = pd.Series(['dx', 'DX', 'px', 'lab', 'dx'])
+        standard, unknown = standard_labels(labels, {'DX': ('dx',), 'PX': ('px',)}, CODE_TYPE_DTYPE,
+                                            lambda values: values.str.lower())
+        assert standard.dtype == CODE_TYPE_DTYPE
+        assert standard.tolist()[:3] == ['DX', 'DX', 'PX'] and pd.isna(standard[3])
+        assert unknown == {'lab'}
+
+        # Outputs of separate calls concatenate without losing the categories
+        df = pd.DataFrame({'patient_id': [1, 2],
+                           'encounter_id': [10, 20],
+                           'admit_date': pd.to_datetime(['2020-01-01', '2020-02-01']),
+                           'code_type': ['DX', 'dx'],
+                           'code_version': ['10', 'ICD10'],
+                           'code': ['Z37.0', 'O03.9']})
+        cols = ['patient_id', 'encounter_id', 'admit_date', 'code_version', 'code_type', 'code']
+        first = process_outcomes(df[df['patient_id'] == 1], *cols)
+        second = process_outcomes(df[df['patient_id'] == 2], *cols)
+        combined = pd.concat([first, second], ignore_index=True)
+        assert combined['outcome'].dtype == OUTCOME_DTYPE
+        assert combined['outcome'].tolist() == ['LIVE_BIRTH', 'SPONTANEOUS_ABORTION']
+
+
+    def test_prefix_screen():
+        from src.pypreg import smm, instrument, StageReport
+        from src.pypreg.screen import code_prefixes, screen_codes
+
+        assert code_prefixes(['^O0[08].*', '^O0.*', '^Z37.*']) == ('O0', 'Z37')
+        assert code_prefixes(['^O0.*', '6423.*']) is None
+        kept = screen_codes(pd.Series(['O08.1', 'J45.909', None, 'Z37.0']), ('O0', 'Z37'), strip='.')
+        assert kept.tolist() == [True, False, False, True]
+
+        # Codes no pattern can match are pruned before the regex, the flags are unchanged
+        df = pd.DataFrame({'encounter_id': [1, 1, 2, 3],
+                           'code_type': ['DX', 'DX', 'DX', 'PX'],
+                           'code_version': ['10', '10', '10', '10'],
+                           'code': ['I21.4', 'J45.909', 'E11.9', '30233N1']})
+        report = StageReport()
+        with instrument(report):
+            output = smm(df, 'encounter_id', 'code_type', 'code_version', 'code')
+        events = report.to_frame().set_index('stage')
+        assert events.loc['screen', 'rows_in'] == 4
+        assert events.loc['screen', 'rows_out'] == 2
+        assert output[['encounter_id', 'smm', 'transfusion']].values.tolist() == [[1, True, False], [3, False, True]]
+
+
+    def test_arrow_input():
+        import os
+        import tempfile
+        import pyarrow as pa
+        from src.pypreg import smm, apo, instrument, StageReport
+        from src.pypreg.synthetic import synthetic_claims
+
+        df = synthetic_claims(2000, seed=4)
+        expected_smm = smm(df, 'encounter_id', 'code_type', 'code_version', 'code', indicators=True)
+        expected_apo = apo(df, 'patient_id', 'preg_id', 'code_type', 'code_version', 'code')
+
+        # An IPC file is memory mapped and screened by code prefix before the dataframe is made
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'claims.arrow')
+            df.to_feather(path)
+            report = StageReport()
+            with instrument(report):
+                output = smm(path, 'encounter_id', 'code_type', 'code_version', 'code', indicators=True)
+            assert_frame_equal(output, expected_smm)
+            events = report.to_frame().set_index('stage')
+            assert events.loc['read_arrow', 'rows_in'] == len(df)
+            assert events.loc['read_arrow', 'rows_out'] < len(df)
+
+            # Every pregnancy is listed by apo, including those without a screened code
+            output = apo(path, 'patient_id', 'preg_id', 'code_type', 'code_version', 'code')
+            assert_frame_equal(output, expected_apo)
+
+        table = pa.Table.from_pandas(df)
+        output = smm(table, 'encounter_id', 'code_type', 'code_version', 'code', indicators=True)
+        assert_frame_equal(output, expected_smm)
+
+
+    def test_registered_code_sets():
+        from src.pypreg import apo, smm, register_code_set, unregister_code_set, registered_code_sets
+
+        df = pd.DataFrame({'patient_id': [1, 1, 2, 3],
+                           'preg_id': [1, 1, 1, 1],
+                           'encounter_id': [10, 11, 20, 30],
+                           'code_type': ['DX', 'DX', 'DX', 'PX'],
+                           'code_version': ['10', '10', '9', '10'],
+                           'code': ['O72.0', 'O82', '666.1', '30233N1']})
+        pph = {'DX': {'ICD10': {'code': ("^O72.*",)},
+                      'ICD9': {'code': ("^666.*",)}}}
+
+        try:
+            register_code_set('postpartum hemorrhage', pph)
+            register_code_set('postpartum hemorrhage', pph, entry='smm')
+            assert list(registered_code_sets()) == ['postpartum hemorrhage']
+
+            # The registered set is matched with the APOs, the built-in flags are unchanged
+            output = apo(df, 'patient_id', 'preg_id', 'code_type', 'code_version', 'code')
+            assert output.columns[-1] == 'postpartum hemorrhage'
+            assert output['postpartum hemorrhage'].tolist() == [True, True, False]
+            assert output['cesarean'].tolist() == [True, False, False]
+
+            # Encounters flagged only by a registered set are added to the smm output
+            output = smm(df, 'encounter_id', 'code_type', 'code_version', 'code')
+            assert output[['encounter_id', 'smm', 'transfusion', 'postpartum hemorrhage']].values.tolist() == \
+                [[10, False, False, True], [20, False, False, True], [30, False, True, False]]
+
+            # The indicators and pattern ids come from the same pass as the registered flags
+            dic = pd.DataFrame({'patient_id': [1], 'preg_id': [1], 'encounter_id': [10],
+                                'code_type': ['DX'], 'code_version': ['10'], 'code': ['O72.3']})
+            output = smm(pd.concat([df, dic], ignore_index=True), 'encounter_id', 'code_type', 'code_version', 'code',
+                         indicators=True, provenance=True)
+            assert output.columns[-3:].tolist() == ['postpartum hemorrhage', 'smm_pattern_id', 'transfusion_pattern_id']
+            assert output[['smm', 'disseminated_intravascular_coagulation', 'transfusion',
+                           'postpartum hemorrhage']].values.tolist() == \
+                [[True, True, False, True], [False, False, False, True], [False, False, True, False]]
+            assert output.smm_pattern_id.notna().tolist() == [True, False, False]
+            assert output.transfusion_pattern_id.notna().tolist() == [False, False, True]
+
+            for name, code_set, entry in [('cesarean', pph, 'apo'),
+                                          ('bad type', {'RX': pph['DX']}, 'apo'),
+                                          ('bad pattern', {'DX': {'ICD10': {'code': ("^O72(",)}}}, 'apo'),
+                                          ('pph', pph, 'calc_index')]:
+                try:
+                    register_code_set(name, code_set, entry=entry)
+                    assert False
+                except ValueError:
+                    pass
+        finally:
+            for entry in ['apo', 'smm']:
+                for name in registered_code_sets(entry):
+                    unregister_code_set(name, entry=entry)
+
+        assert apo(df, 'patient_id', 'preg_id', 'code_type', 'code_version', 'code').shape[1] == 7
+
+
+    def test_window_flags():
+        from src.pypreg import window_join, window_flags
+
+        pregnancies = pd.DataFrame({'patient_id': [1, 1],
+                                    'preg_num': [1, 2],
+                                    'start_window': pd.to_datetime(['2020-01-01', '2021-03-01']),
+                                    'event_date': pd.to_datetime(['2020-09-01', '2021-11-01'])})
+        df = pd.DataFrame({'patient_id': [1, 1, 1, 1],
+                           'admit_date': pd.to_datetime(['2020-08-15', '2020-09-01', '2021-02-01', '2021-11-01']),
+                           'code_type': ['DX', 'PX', 'DX', 'DX'],
+                           'code_version': ['10', '10', '9', '9'],
+                           'code': ['O24.410', '10D00Z1', '401.9', '650'],
+                           'age': [30, 30, 31, 31]})
+
+        # A lookback reaching into the previous pregnancy gives the row to both
+        joined = window_join(df, pregnancies, 'patient_id', 'admit_date', lookback=365)
+        assert joined['preg_num'].tolist() == [1, 2, 1, 2, 2, 2]
+        joined = window_join(df, pregnancies, 'patient_id', 'admit_date')
+        assert joined['preg_num'].tolist() == [1, 1, 2]
+
+        # Codes before the start only count toward the score
+        output = window_flags(df, pregnancies, 'patient_id', 'admit_date', 'code_type', 'code_version',
+                              'code', method='bateman', age_col='age', lookback=60)
+        assert output[['patient_id', 'preg_num']].values.tolist() == [[1, 1], [1, 2]]
+        assert output['cesarean'].tolist() == [True, False]
+        assert output['gest diabetes mellitus'].tolist() == [True, False]
+        assert output['gest hypertension'].tolist() == [False, False]
+        without = window_flags(df, pregnancies, 'patient_id', 'admit_date', 'code_type', 'code_version',
+                               'code', method='bateman', age_col='age')
+        assert output['bateman_score'].iloc[1] > without['bateman_score'].iloc[1]
+
+        # A procedure code is not scored even when it matches a diagnosis pattern,
+        # ICD9 PX 49.39 would match the asthma pattern 493
+        procedure = pd.DataFrame({'patient_id': [1],
+                                  'admit_date': pd.to_datetime(['2020-05-01']),
+                                  'code_type': ['px'],
+                                  'code_version': ['9'],
+                                  'code': ['49.39']})
+        output = window_flags(procedure, pregnancies, 'patient_id', 'admit_date', 'code_type', 'code_version',
+                              'code', method='bateman')
+        assert output['bateman_score'].isna().all()
+        output = window_flags(procedure.assign(code_type='dx'), pregnancies, 'patient_id', 'admit_date',
+                              'code_type', 'code_version', 'code', method='bateman')
+        assert output['bateman_score'].tolist()[0] == 1
+
+
+    def test_next_event_valid_array():
+        import numpy as np
+        from src.pypreg.pregnancy_outcome.process_outcome import next_event_valid, next_event_valid_array, \
+            validate_outcomes, validate_outcomes_array, spacing, gap_matrix, BAD_DATE, BAD_DAY
+        from src.pypreg.pregnancy_outcome.outcome_map import OUTCOME_LIST
+
+        assert gap_matrix().shape == (7, 7)
+        assert pd.Timestamp(0) + pd.Timedelta(days=BAD_DAY) == BAD_DATE
+
+        # Every pair of outcomes at and around the gap agrees with next_event_valid
+        df = pd.DataFrame({'patient_id': 1,
+                           'encounter_id': range(len(OUTCOME_LIST)),
+                           'admit': pd.Timestamp('2020-01-01'),
+                           'outcome': OUTCOME_LIST})
+        events = spacing(df, patient_col='patient_id', outcome_col='outcome', admit_col='admit')\
+            .set_index('outcome').loc[OUTCOME_LIST]
+        gaps = gap_matrix()
+        for first in range(len(OUTCOME_LIST)):
+            for second in range(len(OUTCOME_LIST)):
+                for offset in (-1, 0, 1):
+                    second_event = events.iloc[second].copy()
+                    second_event['admit'] = second_event['admit'] + pd.Timedelta(days=gaps[first, second] + offset)
+                    second_event.name = OUTCOME_LIST[second]
+                    second_event['outcome'] = OUTCOME_LIST[second]
+                    first_event = events.iloc[first]
+                    for base in (0, 1):
+                        valid, event_date = next_event_valid(first_event, second_event, base)
+                        first_day = (first_event['admit'] - pd.Timestamp(0)).days
+                        second_day = (second_event['admit'] - pd.Timestamp(0)).days
+                        valid_array, event_day = next_event_valid_array(np.array([first]), np.array([first_day]),
+                                                                        np.array([second]), np.array([second_day]),
+                                                                        base)
+                        assert valid == valid_array[0] == (offset >= 0)
+                        assert event_date == pd.Timestamp(0) + pd.Timedelta(days=int(event_day[0]))
+
+        # The batch selects the same outcomes as validating each patient in turn
+        df = pd.DataFrame({'patient_id': [1, 1, 1, 1, 2, 2, 2],
+                           'encounter_id': [1, 2, 3, 3, 4, 5, 6],
+                           'admit': pd.to_datetime(['2020-01-01', '2020-03-01', '2020-10-01', '2020-10-01',
+                                                    '2020-01-01', '2020-02-01', '2021-01-01']),
+                           'outcome': [OUTCOME_LIST[6], OUTCOME_LIST[4], OUTCOME_LIST[0], OUTCOME_LIST[5],
+                                       OUTCOME_LIST[5], OUTCOME_LIST[0], OUTCOME_LIST[2]]})
+        df = spacing(df, patient_col='patient_id', outcome_col='outcome', admit_col='admit')\
+            .assign(outcome_valid=False, event_date=BAD_DATE)
+        expected = df.groupby(['patient_id'], group_keys=True)\
+            .apply(validate_outcomes, outcome_col='outcome', admit_col='admit', encounter_col='encounter_id',
+                   include_groups=False)\
+            .reset_index(level=[0], names=['patient_id'])\
+            .reset_index(drop=True)
+        output = validate_outcomes_array(df, ['patient_id'], 'outcome', 'admit', 'encounter_id')
+        assert_frame_equal(output, expected)
+        assert output['outcome_valid'].tolist() == [True, True, True, False, False, True, True]
+
+        # Rows of a patient with a missing identifier are left out, as groupby leaves them out
+        missing = df.assign(patient_id=df['patient_id'].where(df['patient_id'] == 2))
+        output = validate_outcomes_array(missing, ['patient_id'], 'outcome', 'admit', 'encounter_id')
+        assert output['patient_id'].tolist() == [2, 2, 2]
+        assert output['outcome_valid'].tolist() == [False, True, True]
+
+        try:
+            next_event_valid_array(np.array([0]), np.array([0]), np.array([0]), np.array([0]), base=2)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('next_event_valid_array accepted an unknown base')
+
+
     test_smm()
     test_outcome_map_split()
     test_basic_preg_outcomes()
@@ -564,3 +1596,29 @@ if __name__  == "__main__":
     test_leonard_score()
     test_outcomes_output()
     test_outcome_list_output()
+    test_sql_generation()
+    test_sql_equivalence()
+    test_synthetic_claims()
+    test_instrument()
+    test_concurrent_entry_points()
+    test_assign_pregnancy()
+    test_spacing_configs()
+    test_schema_selections()
+    test_partitioned()
+    test_cli()
+    test_provenance()
+    test_cohort_summary()
+    test_shared_memory()
+    test_result_cache()
+    test_memory_limit()
+    test_verify_engines()
+    test_scoring_service()
+    test_smm_postpartum()
+    test_index_flags()
+    test_collapse_encounters()
+    test_categorical_dtypes()
+    test_prefix_screen()
+    test_arrow_input()
+    test_registered_code_sets()
+    test_window_flags()
+    test_next_event_valid_array()